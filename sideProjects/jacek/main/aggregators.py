@@ -0,0 +1,540 @@
+import calendar
+import itertools
+import time
+from collections import Counter
+import numpy as np
+import config as config
+import external as external
+import ipset as ipset
+import mirai_cache as mirai_cache
+import sketches as sketches
+
+
+class MiraiAggregator(object):
+    """
+    Base class for statistics collected during a single pass over the mirai csv.
+    loaders.scan_mirai calls update for every row (or update_table once when the
+    columnar cache of the csv is used), result is called once the set of
+    infected ips is known.
+    """
+    # if True, only rows with an ip from the candidates set are passed to update
+    candidates_only = True
+
+    def update(self, row, index):
+        """
+
+        :param row: list of strings, a row of the mirai csv
+        :param index: position of the row in the csv
+        :return: void
+        """
+        raise NotImplementedError
+
+    def update_table(self, table, positions):
+        """
+        Columnar counterpart of update, the default passes rebuilt rows to update.
+
+        :param table: mirai_cache.MiraiTable
+        :param positions: array of positions of the rows to aggregate, in order
+        :return: void
+        """
+        for position, row in table.iter_rows(positions):
+            self.update(row, position)
+
+    def result(self, infected_ips):
+        """
+
+        :param infected_ips: set of infected ips
+        :return: statistics limited to the infected ips
+        """
+        raise NotImplementedError
+
+
+def _first_rows(keys):
+    """
+
+    :param keys: array of keys (e.g. ips) of rows
+    :return: positions in keys of the first row of every distinct key, in order of appearance
+    """
+    unique_keys, first = np.unique(keys, return_index=True)
+    return np.sort(first)
+
+
+def _is_port_23(ports):
+    return np.isin(ports, [23, 2323])
+
+
+class MiraiIpFilter(MiraiAggregator):
+    """
+    Collects ips matching the port and date filters,
+    see loaders.load_mirai_ips_filter_date_port.
+    Rows are buffered and filtered in chunks: ports and timestamps of a whole
+    chunk are parsed at once and combined into a boolean mask.
+    """
+    candidates_only = False
+
+    def __init__(self, date_limit="2018-12-04T00:00:00Z", seen="fseen", filter_port=False, filter_date=False,
+                 compact=False, ports=None, date_until=None, chunk_size=1 << 16):
+        """
+
+        :param date_limit: string in format %Y-%m-%dT%H:%M:%SZ, the oldest date to look for
+        :param seen: fseen or lseen
+        :param filter_port: Boolean, if filter by ports
+        :param filter_date: Boolean, if True use only rows on or after date_limit
+        :param compact: Boolean, if True collect ips into an ipset.IPSet
+        :param ports: list of ports used by filter_port, 23 and 2323 by default
+        :param date_until: optional string in format %Y-%m-%dT%H:%M:%SZ, use only rows before that date
+        :param chunk_size: number of rows filtered at once
+        """
+        self.compact = compact
+        self.ips = ipset.IPSetBuilder() if compact else set()
+        # timestamps are compared in UTC, as they are stored in the csv
+        self.start_date = calendar.timegm(time.strptime(date_limit, "%Y-%m-%dT%H:%M:%SZ"))
+        self.end_date = None
+        if date_until is not None:
+            self.end_date = calendar.timegm(time.strptime(date_until, "%Y-%m-%dT%H:%M:%SZ"))
+        self.index = config.FSEEN
+        if seen == "lseen":
+            self.index = config.LSEEN
+        self.filter_port = filter_port
+        self.filter_date = filter_date
+        self.ports = [23, 2323] if ports is None else [int(p) for p in ports]
+        self.chunk_size = chunk_size
+        self._ips = []
+        self._ports = []
+        self._seen = []
+
+    def update(self, row, index):
+        self._ips.append(row[config.IP])
+        if self.filter_port:
+            self._ports.append(row[config.DST_PORT])
+        if self.filter_date or self.end_date is not None:
+            self._seen.append(row[self.index])
+        if len(self._ips) >= self.chunk_size:
+            self._flush()
+
+    def _flush(self):
+        if len(self._ips) == 0:
+            return
+        self._collect(self._mask())
+        self._ips = []
+        self._ports = []
+        self._seen = []
+
+    def _mask(self):
+        """
+
+        :return: boolean array, True for the buffered rows matching the filters
+        """
+        mask = np.ones(len(self._ips), dtype=bool)
+        if self._seen:
+            seen = mirai_cache.parse_times(self._seen, strict=True)
+            mask &= self._date_mask(seen)
+        if self.filter_port:
+            mask &= np.isin(np.array(self._ports).astype(np.int64), self.ports)
+        return mask
+
+    def _collect(self, mask):
+        """
+
+        :param mask: boolean array, True for the buffered rows matching the filters
+        :return: void
+        """
+        if self.compact:
+            for ip in itertools.compress(self._ips, mask.tolist()):
+                self.ips.add(ip)
+        else:  # rows stay in order, so the set is filled as when adding row by row
+            self.ips.update(itertools.compress(self._ips, mask.tolist()))
+
+    def _date_mask(self, seen):
+        """
+
+        :param seen: int64 array of timestamps
+        :return: boolean array, True for timestamps in the requested window
+        """
+        mask = seen != mirai_cache.TIME_MISSING
+        if self.filter_date:
+            mask &= seen >= self.start_date
+        if self.end_date is not None:
+            mask &= seen < self.end_date
+        return mask
+
+    def _table_mask(self, table, positions):
+        """
+
+        :param table: mirai_cache.MiraiTable
+        :param positions: array of row positions
+        :return: boolean array, True for the rows matching the filters
+        """
+        mask = np.ones(len(positions), dtype=bool)
+        if self.filter_date or self.end_date is not None:
+            mask &= self._date_mask(table["lseen" if self.index == config.LSEEN else "fseen"][positions])
+        if self.filter_port:
+            mask &= np.isin(table["port"][positions], self.ports)
+        return mask
+
+    def update_table(self, table, positions):
+        values = table["ip"][positions[self._table_mask(table, positions)]]
+        if self.compact:
+            self.ips.add_ints(np.unique(values))
+        else:  # same order of insertion as when reading the csv
+            self.ips.update(ipset.int_to_ip(v) for v in values[_first_rows(values)].tolist())
+
+    def result(self, infected_ips=None):
+        """
+
+        :param infected_ips: ignored, the filter runs over all rows
+        :return: set of ips, or ipset.IPSet if compact
+        """
+        self._flush()
+        if self.compact:
+            return self.ips.build()
+        return self.ips
+
+
+class ApproxCounts(MiraiIpFilter):
+    """
+    Approximate counterpart of a report (see process_data.generate_approx_report) in fixed
+    memory: rows matching the filters whose ip is in the Bloom filter of censys ips count as
+    infected. Distinct infected ips and ips per port are HyperLogLog counts, the top prefixes,
+    countries and asns (first matching row of every ip, found with a Bloom filter of seen ips)
+    come from Count-Min sketches. A false positive of the Bloom filter of seen ips drops the
+    first row of an ip, so these counts can also be too low, by about seen_false_positive_rate
+    of the count (reported as <name>_undercount_rate). The candidates of the top keys also have
+    a HyperLogLog of their distinct ips over all matching rows (<name>_distinct), which counts
+    only the rows after the key became a candidate.
+
+    Unlike the exact report, the first matching row of an ip is used instead of its first row,
+    and ports are numbers of distinct infected ips per port over the matching rows,
+    not numbers of rows.
+    """
+
+    def __init__(self, censys, date_limit="2018-12-04T00:00:00Z", seen="fseen", filter_port=False,
+                 filter_date=False, top=10, capacity=config.APPROX_CAPACITY, error_rate=config.APPROX_ERROR,
+                 precision=config.APPROX_PRECISION, port_precision=10, chunk_size=1 << 16):
+        """
+
+        :param censys: sketches.CensysSketch, see loaders.load_censys_sketch
+        :param date_limit: see MiraiIpFilter
+        :param seen: see MiraiIpFilter
+        :param filter_port: see MiraiIpFilter
+        :param filter_date: see MiraiIpFilter
+        :param top: number of most common prefixes, countries and asns
+        :param capacity: expected number of distinct infected ips
+        :param error_rate: false positive rate of the Bloom filter of seen ips
+        :param precision: precision of the HyperLogLog count of infected ips
+        :param port_precision: precision of the HyperLogLog count of every port and of every top key
+        :param chunk_size: number of rows filtered at once
+        """
+        MiraiIpFilter.__init__(self, date_limit=date_limit, seen=seen, filter_port=filter_port,
+                               filter_date=filter_date, chunk_size=chunk_size)
+        self.censys = censys
+        self.infected = sketches.HyperLogLog(precision)
+        self.seen_ips = sketches.BloomFilter(capacity, error_rate)
+        self.top = dict((name, sketches.TopKeys(top)) for name in ("prefix", "country", "asn"))
+        self.distinct = dict((name, dict()) for name in self.top)  # name --> candidate key --> HyperLogLog
+        self.port_precision = port_precision
+        self.ports_count = dict()  # port --> HyperLogLog
+        self._all_ports = []
+        self._keys = []  # (prefix, country, asn)
+
+    def update(self, row, index):
+        self._all_ports.append(row[config.DST_PORT])
+        self._keys.append((row[config.PREFIX], row[config.COUNTRY], row[config.ASN]))
+        MiraiIpFilter.update(self, row, index)
+
+    def _collect(self, mask):
+        ips = ipset.ips_to_array(self._ips, strict=False)
+        ports = np.array([int(p) for p in self._all_ports], dtype=np.int64)  # raises as parse_rows
+        self._add(ips, ports, mask, lambda positions: [self._keys[i] for i in positions.tolist()])
+        self._all_ports = []
+        self._keys = []
+
+    def update_table(self, table, positions):
+        for start in range(0, len(positions), self.chunk_size):
+            chunk = positions[start:start + self.chunk_size]
+
+            def keys(selected, chunk=chunk):
+                rows = chunk[selected]
+                return list(zip(table.decode("prefix", table["prefix"][rows]),
+                                table.decode("country", table["country"][rows]),
+                                table.decode("asn", table["asn"][rows])))
+
+            self._add(table["ip"][chunk].astype(np.int64), table["port"][chunk].astype(np.int64),
+                      self._table_mask(table, chunk), keys)
+
+    def _add(self, ips, ports, mask, keys):
+        """
+
+        :param ips: int64 array of ips of a chunk of rows, -1 where not ipv4
+        :param ports: int64 array of ports of the rows
+        :param mask: boolean array, True for rows matching the filters
+        :param keys: function giving (prefix, country, asn) of rows at given positions of the chunk
+        :return: void
+        """
+        hashes = sketches.hash_ips(ips)
+        mask = mask & (ips >= 0)
+        mask[mask] = self.censys.ips.contains_hashes(hashes[mask])
+        selected = np.nonzero(mask)[0]
+        if len(selected) == 0:
+            return
+        self.infected.add_hashes(hashes[selected])
+        for port in np.unique(ports[selected]).tolist():
+            counter = self.ports_count.get(port)
+            if counter is None:
+                counter = self.ports_count[port] = sketches.HyperLogLog(self.port_precision)
+            counter.add_hashes(hashes[selected[ports[selected] == port]])
+
+        # first matching row of every ip: first in the chunk and not seen in earlier chunks
+        first = _first_rows(ips[selected])  # positions in selected
+        first = first[~self.seen_ips.contains_hashes(hashes[selected[first]])]
+        self.seen_ips.add_hashes(hashes[selected[first]])
+        rows = keys(selected)
+        for i, name in enumerate(("prefix", "country", "asn")):
+            top = self.top[name]
+            top.add([rows[j][i] for j in first.tolist()])
+            distinct = self.distinct[name]
+            for key in [key for key in distinct if key not in top.candidates]:
+                del distinct[key]  # pruned from the candidates
+            positions = dict()  # candidate key --> positions in selected
+            for j, row in enumerate(rows):
+                if row[i] in top.candidates:
+                    positions.setdefault(row[i], []).append(j)
+            for key, js in positions.items():
+                counter = distinct.get(key)
+                if counter is None:
+                    counter = distinct[key] = sketches.HyperLogLog(self.port_precision)
+                counter.add_hashes(hashes[selected[js]])
+
+    def result(self, infected_ips=None):
+        """
+
+        :param infected_ips: ignored, infected ips are found with the Bloom filter of censys ips
+        :return: dict with the estimates and their error bounds
+        """
+        self._flush()
+        result = {
+            "infected": self.infected.count(),
+            "infected_relative_error": self.infected.relative_error(),
+            "censys_false_positive_rate": self.censys.ips.false_positive_rate(),
+            "seen_false_positive_rate": self.seen_ips.false_positive_rate(),
+            "ports": Counter(dict((port, counter.count()) for port, counter in self.ports_count.items())),
+            "ports_relative_error": 1.04 / np.sqrt(1 << self.port_precision),
+        }
+        for name, top in self.top.items():
+            bound, confidence = top.sketch.error_bound()
+            result[name] = top.top()
+            result[name + "_error"] = bound  # overestimate of the Count-Min sketch
+            result[name + "_confidence"] = confidence
+            # an ip is dropped with at most the final false positive rate (bits are only ever set),
+            # so in expectation a count is at most this fraction of itself too low
+            result[name + "_undercount_rate"] = result["seen_false_positive_rate"]
+            result[name + "_distinct"] = [(key, self.distinct[name][key].count() if key in self.distinct[name] else 0)
+                                          for key, count in result[name]]
+        result["distinct_relative_error"] = 1.04 / np.sqrt(1 << self.port_precision)
+        return result
+
+
+class FirstRowCounts(MiraiAggregator):
+    """
+    Counts infected ips by prefix, country and asn using only
+    the first row of every ip, see process_data.get_counts.
+    """
+
+    def __init__(self, filter_by_port=False):
+        self.filter_by_port = filter_by_port
+        self.first = dict()  # ip --> (prefix, country, asn), in order of appearance
+
+    def update(self, row, index):
+        if self.filter_by_port and int(row[config.DST_PORT]) != 23 and int(row[config.DST_PORT]) != 2323:
+            return
+        if row[config.IP] not in self.first:
+            self.first[row[config.IP]] = (row[config.PREFIX], row[config.COUNTRY], row[config.ASN])
+
+    def update_table(self, table, positions):
+        if self.filter_by_port:
+            positions = positions[_is_port_23(table["port"][positions])]
+        positions = positions[_first_rows(table["ip"][positions])]
+        ips = [ipset.int_to_ip(v) for v in table["ip"][positions].tolist()]
+        for ip, prefix, country, asn in zip(ips, table.decode("prefix", table["prefix"][positions]),
+                                            table.decode("country", table["country"][positions]),
+                                            table.decode("asn", table["asn"][positions])):
+            if ip not in self.first:
+                self.first[ip] = (prefix, country, asn)
+
+    def result(self, infected_ips):
+        """
+
+        :param infected_ips: set of ips
+        :return: prefix_count, country_count, asn_count of type Counter
+        """
+        prefix_count = Counter()
+        country_count = Counter()
+        asn_count = Counter()
+        members = ipset.isin(list(self.first), infected_ips)
+        for (ip, (prefix, country, asn)), infected in zip(self.first.items(), members):
+            if infected:
+                prefix_count[prefix] += 1
+                country_count[country] += 1
+                asn_count[asn] += 1
+        return prefix_count, country_count, asn_count
+
+
+class PortCounts(MiraiAggregator):
+    """
+    Counts rows of infected ips per destination port, see process_data.count_ports.
+    """
+
+    def __init__(self):
+        self.ports = dict()  # ip --> {port: [index of the first row, number of rows]}
+
+    def update(self, row, index):
+        ip_ports = self.ports.get(row[config.IP])
+        if ip_ports is None:
+            ip_ports = self.ports[row[config.IP]] = dict()
+        port = ip_ports.get(row[config.DST_PORT])
+        if port is None:
+            ip_ports[row[config.DST_PORT]] = [index, 1]
+        else:
+            port[1] += 1
+
+    def update_table(self, table, positions):
+        # (ip, port) pairs as a single 64-bit key
+        keys = (table["ip"][positions].astype(np.uint64) << np.uint64(32)) | \
+            table["port"][positions].astype(np.uint32).astype(np.uint64)
+        unique_keys, first, counts = np.unique(keys, return_index=True, return_counts=True)
+        order = np.argsort(first, kind="stable")
+        for key, first_row, count in zip(unique_keys[order].tolist(), positions[first[order]].tolist(),
+                                         counts[order].tolist()):
+            port = key & 0xFFFFFFFF
+            port = str(port) if port != 0xFFFFFFFF else ""  # PORT_MISSING
+            ip_ports = self.ports.setdefault(ipset.int_to_ip(key >> 32), dict())
+            if port in ip_ports:
+                ip_ports[port][1] += count
+            else:
+                ip_ports[port] = [first_row, count]
+
+    def result(self, infected_ips):
+        """
+
+        :param infected_ips: set of ips
+        :return: Counter port --> number of rows, ports ordered by their first appearance
+        """
+        first_seen = dict()
+        totals = Counter()
+        members = ipset.isin(list(self.ports), infected_ips)
+        for (ip, ip_ports), infected in zip(self.ports.items(), members):
+            if infected:
+                for port, (first, count) in ip_ports.items():
+                    if port not in first_seen or first < first_seen[port]:
+                        first_seen[port] = first
+                    totals[port] += count
+        port_count = Counter()
+        for port in sorted(first_seen, key=first_seen.get):
+            port_count[port] = totals[port]
+        return port_count
+
+
+class GroupBy(MiraiAggregator):
+    """
+    Collects distinct values of a column (ASN, country, ...) per ip, see process_data.group_by.
+    With a memory budget the pairs (ip, value) are spilled to disk (see external.py).
+    """
+
+    def __init__(self, by=config.ASN, memory_budget=config.GROUP_MEMORY_BUDGET):
+        """
+
+        :param by: index of the column
+        :param memory_budget: approximate number of bytes kept in memory, None keeps all groups in memory
+        """
+        self.by = by
+        self.groups = dict()  # ip --> set of values, in order of appearance
+        self.spilled = None
+        if memory_budget is not None:
+            self.spilled = external.PartitionedGroups(memory_budget, distinct=True, dir_path=config.SPILL_DIR)
+
+    def update(self, row, index):
+        if self.spilled is not None:
+            self.spilled.add(index, row[config.IP], row[self.by])
+            return
+        values = self.groups.get(row[config.IP])
+        if values is None:
+            values = self.groups[row[config.IP]] = set()
+        values.add(row[self.by])
+
+    def update_table(self, table, positions):
+        name = mirai_cache.BY_INDEX.get(self.by)
+        if name not in mirai_cache.TEXT_COLUMNS:
+            MiraiAggregator.update_table(self, table, positions)  # column not encoded in the cache
+            return
+        # distinct (ip, value) pairs as a single 64-bit key, added in order of appearance
+        keys = (table["ip"][positions].astype(np.uint64) << np.uint64(32)) | \
+            table[name][positions].astype(np.uint64)
+        first = _first_rows(keys)
+        unique_keys = keys[first]
+        if self.spilled is not None:
+            orders = positions[first].tolist()
+            for start in range(0, len(unique_keys), self.spilled.buffer_limit):
+                chunk = unique_keys[start:start + self.spilled.buffer_limit]
+                ips = [ipset.int_to_ip(v) for v in (chunk >> np.uint64(32)).tolist()]
+                values = table.decode(name, chunk & np.uint64(0xFFFFFFFF))
+                for order, ip, value in zip(orders[start:start + len(chunk)], ips, values):
+                    self.spilled.add(order, ip, value)
+            return
+        ips = [ipset.int_to_ip(v) for v in (unique_keys >> np.uint64(32)).tolist()]
+        values = table.decode(name, unique_keys & np.uint64(0xFFFFFFFF))
+        for ip, value in zip(ips, values):
+            self.groups.setdefault(ip, set()).add(value)
+
+    def result(self, infected_ips):
+        """
+
+        :param infected_ips: set of ips
+        :return: dict ip --> set of values, or with a memory budget a generator of
+            (ip, list of values) already sorted for process_data.export_group_by
+        """
+        if self.spilled is not None:
+            return self.spilled.sorted_groups(keep=infected_ips)
+        members = ipset.isin(list(self.groups), infected_ips)
+        return dict((ip, values) for (ip, values), infected in zip(self.groups.items(), members) if infected)
+
+
+class FirstSeenDuration(MiraiAggregator):
+    """
+    Keeps fseen and lseen of the first row of every ip, see plot_methods.plot_duration.
+    """
+
+    def __init__(self):
+        self.seen = dict()  # ip --> (fseen, lseen)
+
+    def update(self, row, index):
+        if row[config.IP] not in self.seen:
+            self.seen[row[config.IP]] = (row[config.FSEEN], row[config.LSEEN])
+
+    def update_table(self, table, positions):
+        positions = positions[_first_rows(table["ip"][positions])]
+        ips = [ipset.int_to_ip(v) for v in table["ip"][positions].tolist()]
+        for ip, fseen, lseen in zip(ips, mirai_cache.format_times(table["fseen"][positions]),
+                                    mirai_cache.format_times(table["lseen"][positions])):
+            if ip not in self.seen:
+                self.seen[ip] = (fseen, lseen)
+
+    def result(self, infected_ips):
+        """
+
+        :param infected_ips: set of ips
+        :return: list of (ip, fseen, lseen) tuples
+        """
+        members = ipset.isin(list(self.seen), infected_ips)
+        return [(ip, fseen, lseen) for (ip, (fseen, lseen)), infected in zip(self.seen.items(), members) if infected]
+
+    def durations(self, infected_ips):
+        """
+
+        :param infected_ips: set of ips
+        :return: timedelta64 array of lseen - fseen of the first row of every infected ip, in the order of result
+        :raises ValueError: if a time is not in format %Y-%m-%dT%H:%M:%SZ, as when the columnar cache is built
+        """
+        first_seen = self.result(infected_ips)
+        fseen = mirai_cache.parse_times([fseen for ip, fseen, lseen in first_seen], strict=True)
+        lseen = mirai_cache.parse_times([lseen for ip, fseen, lseen in first_seen], strict=True)
+        return lseen.astype("datetime64[s]") - fseen.astype("datetime64[s]")
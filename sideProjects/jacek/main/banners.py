@@ -0,0 +1,123 @@
+from collections.abc import MutableMapping
+import numpy as np
+import config as config
+import external as external
+import ipset as ipset
+
+
+class BannerStore(MutableMapping):
+    """
+    Mapping ip --> banner which keeps every distinct banner text once.
+    Banners get integer ids, the ips are mapped to ids, so repeated banners
+    cost an int per ip instead of a long string. With compact=True the keys are
+    python ints instead of strings (the ipv4 addresses of ipset.ip_to_int), which
+    saves the string of an ip (about 30 bytes) but not the dict entry; the map is
+    still a dict, about 100 bytes per ip.
+    """
+
+    def __init__(self, compact=False):
+        self.compact = compact
+        self.ids = dict()  # banner --> id
+        self.texts = []  # id --> banner
+        self.ip_banner = dict()  # ip --> id, in order of first appearance of the ip
+
+    def intern(self, banner):
+        """
+
+        :param banner: banner text
+        :return: id of the banner
+        """
+        banner_id = self.ids.get(banner)
+        if banner_id is None:
+            banner_id = self.ids[banner] = len(self.texts)
+            self.texts.append(banner)
+        return banner_id
+
+    def text(self, banner_id):
+        """
+
+        :param banner_id:
+        :return: banner text
+        """
+        return self.texts[banner_id]
+
+    def _key(self, ip):
+        if not self.compact:
+            return ip
+        try:
+            return ipset.ip_to_int(ip)
+        except ValueError:
+            return ip  # not ipv4, kept as a string as by ipset.IPSet
+
+    def _ip(self, key):
+        return ipset.int_to_ip(key) if self.compact and isinstance(key, int) else key
+
+    def __setitem__(self, ip, banner):
+        self.ip_banner[self._key(ip)] = self.intern(banner)
+
+    def __getitem__(self, ip):
+        return self.texts[self.ip_banner[self._key(ip)]]
+
+    def __delitem__(self, ip):
+        del self.ip_banner[self._key(ip)]
+
+    def __iter__(self):
+        for key in self.ip_banner:
+            yield self._ip(key)
+
+    def __len__(self):
+        return len(self.ip_banner)
+
+    def __contains__(self, ip):
+        return self._key(ip) in self.ip_banner
+
+    def update(self, other=(), **kwargs):
+        """
+        Same as dict.update, banners of other override existing ones.
+
+        :param other: BannerStore or mapping ip --> banner
+        :return: void
+        """
+        if isinstance(other, BannerStore):
+            ids = [self.intern(text) for text in other.texts]  # ids of other --> ids of self
+            if other.compact == self.compact:
+                for key, banner_id in other.ip_banner.items():
+                    self.ip_banner[key] = ids[banner_id]
+            else:
+                for key, banner_id in other.ip_banner.items():
+                    self.ip_banner[self._key(other._ip(key))] = ids[banner_id]
+        else:
+            MutableMapping.update(self, other, **kwargs)
+
+    def group_ids(self, infected_ips, memory_budget=None):
+        """
+        Groups infected ips by banner id, see process_data.group_by_banners.
+
+        :param infected_ips: set (or ipset.IPSet) of infected ips
+        :param memory_budget: approximate number of bytes kept in memory, None keeps all groups in memory
+        :return: dict banner id --> list of ips, in order of appearance; with a memory budget
+            a generator of (banner id, list of ips) sorted by the number of ips (see external.py)
+        """
+        keys = list(self.ip_banner)
+        if self.compact and isinstance(infected_ips, ipset.IPSet):
+            members = infected_ips.isin(np.array([key if isinstance(key, int) else -1 for key in keys],
+                                                 dtype=np.int64)).tolist()
+            for i, key in enumerate(keys):
+                if not isinstance(key, int):
+                    members[i] = key in infected_ips.others
+        else:
+            members = ipset.isin([self._ip(key) for key in keys] if self.compact else keys, infected_ips)
+        if memory_budget is not None:
+            groups = external.PartitionedGroups(memory_budget, distinct=False, dir_path=config.SPILL_DIR)
+            for position, ((key, banner_id), infected) in enumerate(zip(self.ip_banner.items(), members)):
+                if infected:
+                    groups.add(position, banner_id, self._ip(key))
+            return groups.sorted_groups()
+        result = dict()
+        for (key, banner_id), infected in zip(self.ip_banner.items(), members):
+            if infected:
+                ips = result.get(banner_id)
+                if ips is None:
+                    ips = result[banner_id] = []
+                ips.append(self._ip(key))
+        return result
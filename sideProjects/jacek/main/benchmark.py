@@ -0,0 +1,218 @@
+"""
+Benchmarks of the loading and processing functions on synthetic data (see synthetic.py).
+Every case runs in a separate process, so the peak RSS is measured per case.
+
+    python benchmark.py --mirai-rows 1e6 --out results.json
+    python benchmark.py --mirai-rows 1e6 --out new.json --compare results.json
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import tempfile
+import time
+from queue import Empty
+import config as config
+import instrument as instrument
+import mirai_cache as mirai_cache
+import synthetic as synthetic
+
+CASES = ["load_censys_ips", "load_mirai_ips_filter_date_port", "get_counts", "group_by", "count_devices",
+         "generate_report"]
+DATE_LIMIT = "2018-12-04T00:00:00Z"
+
+
+def prepare_data(data_dir, params):
+    """
+    Generates the synthetic datasets, reusing them if they were generated with the same parameters.
+
+    :param data_dir: directory for the data
+    :param params: dict with mirai_rows, censys_records, censys_files, population, seed
+    :return: path to the mirai csv, path to the censys directory
+    """
+    mirai_path = data_dir + "/mirai.csv"
+    censys_dir = data_dir + "/censys"
+    params_path = data_dir + "/params.json"
+    if os.path.exists(params_path):
+        with open(params_path) as params_file:
+            if json.load(params_file) == params:
+                return mirai_path, censys_dir
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+    print("Generating %d mirai rows and %d censys records in %s" %
+          (params["mirai_rows"], params["censys_records"], data_dir))
+    synthetic.write_mirai_csv(mirai_path, params["mirai_rows"], params["population"], seed=params["seed"])
+    if os.path.exists(censys_dir):
+        for f in os.listdir(censys_dir):
+            os.remove(censys_dir + "/" + f)
+    synthetic.write_censys_dir(censys_dir, params["censys_records"], params["censys_files"], params["population"],
+                               seed=params["seed"])
+    with open(params_path, "w") as params_file:
+        json.dump(params, params_file)
+    return mirai_path, censys_dir
+
+
+def _infected(loaders, process_data, mirai_path, censys_dir):
+    censys_ips = loaders.load_censys_ips(censys_dir)[0]
+    mirai_ips = loaders.load_mirai_ips_filter_date_port(mirai_path, date_limit=DATE_LIMIT,
+                                                        filter_port=True, filter_date=True)
+    return process_data.match_mirai_censys(mirai_ips, censys_ips)
+
+
+def _run_case(name, mirai_path, censys_dir, params, queue):
+    """
+    Runs a single case, executed in a child process. A failed case puts its error on the queue.
+    """
+    workdir = tempfile.mkdtemp(prefix="bench_")
+    try:
+        queue.put(_measure_case(name, mirai_path, censys_dir, params, workdir))
+    except Exception as e:
+        queue.put({"error": "%s: %s" % (type(e).__name__, e)})
+    finally:
+        os.chdir(tempfile.gettempdir())
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _measure_case(name, mirai_path, censys_dir, params, workdir):
+    import loaders as loaders
+    import process_data as process_data
+
+    os.chdir(workdir)  # count_devices and the reports write into the working directory
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        infected = None
+        censys = None
+        if name in ("get_counts", "group_by", "count_devices"):
+            infected = _infected(loaders, process_data, mirai_path, censys_dir)
+        if name == "generate_report":
+            censys = loaders.load_censys_ips(censys_dir)
+        rss_before = instrument.peak_rss_mb()
+
+        start = time.perf_counter()
+        if name == "load_censys_ips":
+            loaders.load_censys_ips(censys_dir)
+            rows = params["censys_records"]
+        elif name == "load_mirai_ips_filter_date_port":
+            loaders.load_mirai_ips_filter_date_port(mirai_path, date_limit=DATE_LIMIT,
+                                                    filter_port=True, filter_date=True)
+            rows = params["mirai_rows"]
+        elif name == "get_counts":
+            process_data.get_counts(infected, mirai_path)
+            rows = params["mirai_rows"]
+        elif name == "group_by":
+            process_data.group_by(mirai_path, workdir + "/ips2asn.csv", infected, by=config.ASN)
+            rows = params["mirai_rows"]
+        elif name == "count_devices":
+            process_data.count_devices(censys_dir, infected)
+            rows = params["censys_records"]
+        else:
+            process_data.generate_report(censys[0], censys[1], censys[2], censys[3], mirai_path,
+                                         _date_limit=DATE_LIMIT, _seen="fseen", _filter_port=True,
+                                         _filter_date=True, outfile_base_name=workdir + "/report")
+            rows = params["mirai_rows"]
+        wall = time.perf_counter() - start
+
+    return {
+        "wall_seconds": wall,
+        "rows": rows,
+        "rows_per_second": rows / wall if wall > 0 else None,
+        "peak_rss_mb": instrument.peak_rss_mb(),
+        "peak_rss_before_mb": rss_before,
+        "stages": instrument.summary()["totals"],  # includes the setup of the case
+    }
+
+
+def run_case(name, mirai_path, censys_dir, params):
+    """
+
+    :param name: one of CASES
+    :param mirai_path:
+    :param censys_dir:
+    :param params: parameters of the synthetic data
+    :return: dict with wall time, rows/sec and peak RSS, or with the error if the case failed
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_case, args=(name, mirai_path, censys_dir, params, queue))
+    process.start()
+    result = None
+    while result is None:
+        try:
+            result = queue.get(timeout=1)
+        except Empty:
+            if not process.is_alive() and queue.empty():
+                # killed (e.g. out of memory) before putting a result
+                result = {"error": "process exited with code %s" % process.exitcode}
+    process.join()
+    return result
+
+
+def compare(results, baseline):
+    """
+    Prints speedups of results against a previous results file.
+
+    :param results: results of this run
+    :param baseline: results loaded from a previous run
+    :return: void
+    """
+    print("\n%-35s %12s %12s %9s %12s" % ("case", "before [s]", "after [s]", "speedup", "RSS [MB]"))
+    for name, result in results["cases"].items():
+        before = baseline["cases"].get(name)
+        if before is None or "error" in before or "error" in result:
+            continue
+        print("%-35s %12.3f %12.3f %8.2fx %5.0f->%5.0f" %
+              (name, before["wall_seconds"], result["wall_seconds"],
+               before["wall_seconds"] / result["wall_seconds"], before["peak_rss_mb"], result["peak_rss_mb"]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks on synthetic Mirai/Censys data")
+    parser.add_argument("--mirai-rows", type=float, default=1e5, help="number of mirai rows, 1e5 .. 1e8")
+    parser.add_argument("--censys-records", type=float, default=None, help="default: same as mirai rows")
+    parser.add_argument("--censys-files", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", default="../bench_data")
+    parser.add_argument("--cases", nargs="*", default=CASES, choices=CASES)
+    parser.add_argument("--mirai-cache", action="store_true", help="build the columnar cache of the mirai csv first")
+    parser.add_argument("--out", default="bench_results.json")
+    parser.add_argument("--compare", default=None, help="results file of a previous run")
+    args = parser.parse_args()
+
+    data_params = {
+        "mirai_rows": int(args.mirai_rows),
+        "censys_records": int(args.censys_records if args.censys_records is not None else args.mirai_rows),
+        "censys_files": args.censys_files,
+        "population": max(1, int(args.mirai_rows) // 4),
+        "seed": args.seed,
+    }
+    data_dir = os.path.abspath(args.data_dir)
+    mirai, censys = prepare_data(data_dir, data_params)
+    if args.mirai_cache and not mirai_cache.is_fresh(mirai):
+        mirai_cache.build_cache(mirai)
+
+    summary = {
+        "created": datetime.datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": multiprocessing.cpu_count(),
+        "data": data_params,
+        "mirai_cache": mirai_cache.is_fresh(mirai),
+        "cases": dict(),
+    }
+    for case in args.cases:
+        summary["cases"][case] = run_case(case, mirai, censys, data_params)
+        if "error" in summary["cases"][case]:
+            print("%-35s failed: %s" % (case, summary["cases"][case]["error"]))
+            continue
+        print("%-35s %10.3f s %14.0f rows/s %8.0f MB" % (case, summary["cases"][case]["wall_seconds"],
+                                                         summary["cases"][case]["rows_per_second"],
+                                                         summary["cases"][case]["peak_rss_mb"]))
+    with open(args.out, "w") as outfile:
+        json.dump(summary, outfile, indent=2)
+    print("Results saved in %s" % args.out)
+
+    if args.compare is not None:
+        with open(args.compare) as baseline_file:
+            compare(summary, json.load(baseline_file))
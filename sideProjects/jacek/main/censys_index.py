@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+
+
+class CensysIndex(object):
+    """
+    On-disk (SQLite) index of censys files already loaded by loaders.load_censys_ips.
+    Keeps the partial result of every file together with its size, mtime and sha1,
+    so later runs only load files which are new or changed. The merged result of the
+    files listed so far is pickled into a file next to the database (<path>.merged),
+    not into the database, which would hit the size limit of a BLOB.
+    """
+
+    def __init__(self, path, params):
+        """
+
+        :param path: path to the sqlite file, created if missing
+        :param params: parameters of load_censys_file (version, compact, ...), cached
+            results loaded with other parameters are not used
+        """
+        self.params = json.dumps(params)
+        self.state_path = path + ".merged"
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS files ("
+                                "name TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, sha1 TEXT, "
+                                "params TEXT, partial BLOB)")
+        self.connection.execute("DROP TABLE IF EXISTS state")  # merged result of previous versions
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def signature(self, file_path):
+        """
+
+        :param file_path: path to a censys file
+        :return: [name, size, mtime_ns] of the file
+        """
+        stat = os.stat(file_path)
+        return [os.path.basename(file_path), stat.st_size, stat.st_mtime_ns]
+
+    def is_current(self, file_path):
+        """
+        A file is current if its size and mtime did not change since it was loaded,
+        or if only the mtime changed but the content (sha1) is the same.
+
+        :param file_path: path to a censys file
+        :return: True if the cached partial result of the file can be used
+        """
+        name, size, mtime_ns = self.signature(file_path)
+        row = self.connection.execute("SELECT size, mtime_ns, sha1 FROM files WHERE name = ? AND params = ?",
+                                      (name, self.params)).fetchone()
+        if row is None or row[0] != size:
+            return False
+        if row[1] == mtime_ns:
+            return True
+        if row[2] == file_sha1(file_path):  # touched or copied, same content
+            self.connection.execute("UPDATE files SET mtime_ns = ? WHERE name = ?", (mtime_ns, name))
+            self.connection.commit()
+            return True
+        return False
+
+    def lookup(self, file_path):
+        """
+
+        :param file_path: path to a censys file
+        :return: cached partial result of the file (see loaders.load_censys_file)
+        """
+        row = self.connection.execute("SELECT partial FROM files WHERE name = ? AND params = ?",
+                                      (os.path.basename(file_path), self.params)).fetchone()
+        return pickle.loads(row[0])
+
+    def store(self, file_path, partial):
+        """
+
+        :param file_path: path to a censys file
+        :param partial: result of loaders.load_censys_file for that file
+        :return: void
+        """
+        name, size, mtime_ns = self.signature(file_path)
+        self.connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                                (name, size, mtime_ns, file_sha1(file_path), self.params,
+                                 pickle.dumps(partial, protocol=pickle.HIGHEST_PROTOCOL)))
+        self.connection.commit()
+
+    def load_state(self, signatures):
+        """
+
+        :param signatures: signatures of the files to load, in order of loading (sorted by name)
+        :return: (number of files, merged result) for the longest prefix of signatures
+            merged before, or None
+        """
+        if not os.path.exists(self.state_path):
+            return None
+        with open(self.state_path, "rb") as state_file:
+            params, merged_files = pickle.load(state_file)
+            if params != self.params or merged_files != signatures[:len(merged_files)]:
+                return None
+            return len(merged_files), pickle.load(state_file)
+
+    def save_state(self, signatures, merged):
+        """
+        Writes the merged result to <path>.merged.part and renames it, so an interrupted
+        run leaves the previous state.
+
+        :param signatures: signatures of the merged files, in order of loading
+        :param merged: merged result of these files
+        :return: void
+        """
+        with open(self.state_path + ".part", "wb") as state_file:
+            pickle.dump((self.params, signatures), state_file, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(merged, state_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(self.state_path + ".part", self.state_path)
+
+
+def file_sha1(file_path, block_size=1 << 20):
+    """
+
+    :param file_path:
+    :param block_size: number of bytes read at once
+    :return: hex sha1 of the content of the file
+    """
+    sha1 = hashlib.sha1()
+    with open(file_path, "rb") as data_file:
+        for block in iter(lambda: data_file.read(block_size), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
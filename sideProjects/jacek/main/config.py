@@ -1,7 +1,69 @@
+import os
+
 JSON_DATA_DIR = "../json_data2"
 JSON_TEST_DIR = "../json_test"
 MIRAI_PATH = "../mirai_enriched_2018_07_03_2019.csv"
 
+# number of processes used to read censys files, 1 reads them one by one
+CENSYS_WORKERS = 1
+# number of processes parsing the mirai csv when it has no up to date cache, 1 reads it in this process
+MIRAI_WORKERS = 1
+# approximate size in bytes of the parts of the mirai csv parsed by these processes
+MIRAI_CHUNK_BYTES = 64 * 1024 * 1024
+# number of censys files read (and decompressed) in background threads ahead of the file being processed
+PREFETCH_FILES = 2
+# number of processes rendering the plots of a report, 1 renders them one by one
+PLOT_WORKERS = 4
+# keep sets of ips as sorted arrays of integers (ipset.IPSet) instead of python sets of strings
+COMPACT_IPS = False
+# sqlite file keeping results of censys files loaded by previous runs, e.g. "../censys_index.sqlite"; None disables it
+CENSYS_INDEX_PATH = None
+# approximate number of bytes for group_by and group_by_banners, larger groupings are spilled to disk
+# (see external.py), e.g. 2 * 1024 ** 3; None keeps them in memory
+GROUP_MEMORY_BUDGET = None
+# directory for the spilled files, None uses the system temp directory
+SPILL_DIR = None
+# format of the exported statistics: csv, ndjson or parquet (needs pyarrow), see exports.py
+EXPORT_FORMAT = "csv"
+# None or gzip (.gz is added to the names), parquet files use it for their columns
+EXPORT_COMPRESSION = None
+# size in bytes of the write buffer of every exported file
+EXPORT_BUFFER_BYTES = 1024 * 1024
+# number of rows of the exported counters and groupings (the largest ones), None exports all rows
+EXPORT_TOP_K = None
+# number of threads writing the files of a report (overlaps gzip and disk writes), 1 writes them one by one
+EXPORT_WORKERS = 4
+# approximate number of bytes for each side of the sort-merge join of mirai and censys (see join.py)
+JOIN_MEMORY_BUDGET = 1024 * 1024 * 1024
+# approximate mode (see sketches.py): expected number of distinct censys ips, false positive rate of the
+# censys membership test and precision of the HyperLogLog counts (relative error 1.04 / sqrt(2 ** precision))
+APPROX_CAPACITY = 50 * 1000 * 1000
+APPROX_ERROR = 0.01
+APPROX_PRECISION = 14
+# port of server.py on localhost, and time in seconds between two checks for new censys files
+SERVER_PORT = 8765
+SERVER_RELOAD_SECONDS = 10
+# number of filters whose results are kept by server.py, the least recently used are dropped
+SERVER_MAX_FILTERS = 64
+# checkpoints of the stages of pipeline.py
+PIPELINE_DIR = "../pipeline_cache"
+# sha1 of the data of every rendered plot, plots whose data did not change are skipped; None renders all plots
+PLOT_DIGESTS_PATH = os.path.join(PIPELINE_DIR, "plot_digests.json")
+# length of a bucket of timeline.Timeline in seconds, a day by default
+TIMELINE_BUCKET_SECONDS = 24 * 3600
+# asns whose devices are listed separately by count_devices
+DEVICE_TOP_ASNS = [12389, 4837, 4134, 8452, 3462, 4766, 18403, 8376, 24444, 9121]
+
+# instrumentation of the stages of the pipeline, see instrument.py; set from the environment
+# so a run can be profiled without editing the code
+PRINT_STAGES = bool(os.environ.get("MIRAI_STAGES"))
+RUN_SUMMARY_PATH = os.environ.get("MIRAI_RUN_SUMMARY")
+PROFILE_DIR = os.environ.get("MIRAI_PROFILE_DIR")
+PROFILE_STAGES = os.environ["MIRAI_PROFILE_STAGES"].split(",") if os.environ.get("MIRAI_PROFILE_STAGES") else None
+TRACEMALLOC_DIR = os.environ.get("MIRAI_TRACEMALLOC_DIR")
+# number of finished stages kept for the summary (the oldest are dropped), totals per stage count all of them
+STAGE_RECORDS = 10000
+
 
 # indices
 IP = 0
@@ -1,5 +1,13 @@
+import argparse
+import gzip
 import json
+import multiprocessing
 import os
+import loaders as loaders
+
+# fields of censys records used by loaders.load_censys_ips and count_devices
+FIELDS = ("ip", "ports", "banner", "description", "asn", "country_code")
+PORTS = ("23", "2323")
 
 
 def get_filenames(path):
@@ -14,17 +22,129 @@ def get_filenames(path):
 def to_json(file_path, filename):
     data = []
     print("Processing: %s" % file_path)
-    with open(file_path) as data_file:
+    with loaders.open_scan(file_path) as data_file:
         for line in data_file:
             data.append(line)
     filename = filename.replace(".txt", "")
     with open(filename+".json", 'w') as outfile:
         json.dump(data, outfile)
 
+
+def ndjson_name(filename):
+    """
+
+    :param filename: name of a raw censys file
+    :return: name of the converted file
+    """
+    for suffix in (".gz", ".GZ", ".txt"):
+        if filename.endswith(suffix):
+            filename = filename[:-len(suffix)]
+    return filename + ".ndjson.gz"
+
+
+def to_ndjson(file_path, out_path, ports_only=False, project=False, compresslevel=6):
+    """
+    Streams a raw censys file (one json record per line, optionally gzip compressed)
+    into a gzip compressed line delimited json file, read by loaders.iter_scan.
+    The output is written to out_path.part and renamed when complete, so an
+    existing out_path is always a complete file.
+
+    :param file_path: raw censys file
+    :param out_path: output file
+    :param ports_only: if True keep only records with port 23 or 2323; note that records
+        with other ports are then not counted by load_censys_ips nor seen by count_devices
+    :param project: if True keep only the fields in FIELDS
+    :param compresslevel: gzip compression level
+    :return: number of records read, number of records written
+    """
+    read = 0
+    written = 0
+    part_path = out_path + ".part"
+    with loaders.open_scan(file_path) as data_file, \
+            gzip.open(part_path, "wt", compresslevel=compresslevel) as outfile:
+        for line in data_file:
+            line = line.strip()
+            if not line:
+                continue
+            read += 1
+            if ports_only or project:
+                d = json.loads(line)
+                if ports_only and not any(str(p) in PORTS for p in d.get('ports', ())):
+                    continue
+                if project:
+                    d = dict((f, d[f]) for f in FIELDS if f in d)
+                line = json.dumps(d)
+            outfile.write(line + "\n")
+            written += 1
+    os.replace(part_path, out_path)
+    return read, written
+
+
+def _to_ndjson_args(args):
+    file_path, out_path, ports_only, project, remove_source = args
+    read, written = to_ndjson(file_path, out_path, ports_only=ports_only, project=project)
+    if remove_source:
+        os.remove(file_path)
+    return file_path, read, written
+
+
+def convert_dir(src_dir, dst_dir, workers=1, ports_only=False, project=False, remove_source=False):
+    """
+    Converts all raw censys files of a directory with to_ndjson, in a pool of processes.
+    Files already converted are skipped, so an interrupted conversion is resumed by
+    running it again.
+
+    :param src_dir: directory with raw censys files
+    :param dst_dir: output directory, created if missing
+    :param workers: number of processes
+    :param ports_only: see to_ndjson
+    :param project: see to_ndjson
+    :param remove_source: if True remove every raw file once it is converted
+    :return: void
+    """
+    if not os.path.exists(dst_dir):
+        os.makedirs(dst_dir)
+    todo = []
+    for file_path, filename in get_filenames(src_dir):
+        out_path = dst_dir + "/" + ndjson_name(filename)
+        if os.path.exists(out_path):
+            print("Already converted: %s" % file_path)
+            continue
+        todo.append((file_path, out_path, ports_only, project, remove_source))
+
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            for file_path, read, written in pool.imap_unordered(_to_ndjson_args, todo):
+                print("Converted %s: %d records, %d written" % (file_path, read, written))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for args in todo:
+            file_path, read, written = _to_ndjson_args(args)
+            print("Converted %s: %d records, %d written" % (file_path, read, written))
+
+
 if __name__ == '__main__':
-    PATH = "/Users/daniel/Desktop/sideProjects/jacek/new_censys/FormatGZ.GZ"
-    filenames = get_filenames(path=PATH)
-    print(filenames)
-    for f in filenames:
-        to_json(f[0], "json_data2/"+f[1])
-        os.remove(f[0])
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Convert raw censys files")
+    parser.add_argument("--src", default="/Users/daniel/Desktop/sideProjects/jacek/new_censys/FormatGZ.GZ")
+    parser.add_argument("--dst", default="json_data2")
+    parser.add_argument("--ndjson", action="store_true",
+                        help="write gzip compressed line delimited json instead of json arrays")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--ports-only", action="store_true", help="keep only records with port 23 or 2323")
+    parser.add_argument("--project", action="store_true", help="keep only the fields used by the analysis")
+    parser.add_argument("--keep-source", action="store_true", help="do not remove the converted raw files")
+    args = parser.parse_args()
+
+    if args.ndjson:
+        convert_dir(args.src, args.dst, workers=args.workers, ports_only=args.ports_only, project=args.project,
+                    remove_source=not args.keep_source)
+    else:
+        filenames = get_filenames(path=args.src)
+        print(filenames)
+        for f in filenames:
+            to_json(f[0], args.dst + "/" + f[1])
+            if not args.keep_source:
+                os.remove(f[0])
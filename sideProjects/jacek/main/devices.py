@@ -0,0 +1,231 @@
+from collections import Counter
+import config as config
+import ipset as ipset
+
+ASN_TOP10 = config.DEVICE_TOP_ASNS
+
+# fields of a censys record used to count devices
+FIELDS = ('ip', 'description', 'asn', 'country_code')
+
+_NOT_PARSED = object()
+_MISSING = object()  # field missing from a censys record
+
+
+def parse_description(description):
+    """
+    Devices named by a censys description, e.g. "mikrotik, mikrotik" --> ["mikrotik"].
+
+    :param description: description field of a censys record
+    :return: (list of devices, True if every device counts as one of several devices of the ip),
+        or None if the description does not name a device
+    """
+    if ',' in description:
+        devices = description.split(',')
+        if devices[0] == devices[1]:  # repetitions mikrotik, mikrotik ...
+            return [devices[0]], False
+        return devices, True
+    if ' ' in description:
+        split_ = description.split(' ')
+        if len(split_) == 2:
+            return [description], False
+        return [split_[0]], False  # length longer than 3, expect repetition
+    return None
+
+
+class DeviceStats(object):
+    """
+    Counters filled by count_devices, one censys record at a time.
+    Descriptions repeat a lot, so every distinct description is parsed once.
+    A shard of the records can be counted on its own (see classify) and the
+    results merged in order of the records; an ip and device already counted by
+    an earlier shard are not counted again.
+    """
+
+    def __init__(self, top_asns=None):
+        """
+
+        :param top_asns: list of asns whose devices are counted separately, config.DEVICE_TOP_ASNS by default
+        """
+        # to find devices for given most common asns
+        self.asn_device_map = dict()
+        for a in (ASN_TOP10 if top_asns is None else top_asns):
+            self.asn_device_map[a] = Counter()
+        self.devices_counter = Counter()  # count devices
+        self.found = set()  # helper to keep devices unique, (ip as integer, device id)
+        self.multi_device_ips = set()  # get ips with multiple devices
+        self.multi_device_asn = set()  # get asns with multiple devices
+        self.multi_country_counter = Counter()  # count countries with multiple devices
+        self.no_description = 0
+        self._parsed = dict()  # description --> (list of (device id, device), multi) or None
+        self._device_ids = dict()  # device --> id
+        # records which counted a device: (ip as integer, devices, multi, ip, asn, country code), see merge
+        self._counted = []
+        self._incomplete = 0  # records of _counted with a missing field, part of no_description
+
+    def _parse(self, description):
+        parsed = parse_description(description)
+        if parsed is not None:
+            devices, multi = parsed
+            parsed = ([(self._device_ids.setdefault(dev, len(self._device_ids)), dev) for dev in devices], multi)
+        self._parsed[description] = parsed
+        return parsed
+
+    def add(self, d):
+        """
+
+        :param d: censys record of an infected ip
+        :return: void
+        """
+        try:
+            description = d['description']
+            parsed = self._parsed.get(description, _NOT_PARSED)
+            if parsed is _NOT_PARSED:
+                parsed = self._parse(description)
+            if parsed is None:
+                return
+            devices, multi = parsed
+            ip = d['ip']
+            try:
+                ip_key = ipset.ip_to_int(ip)
+            except ValueError:
+                ip_key = ip  # not ipv4, kept as it is
+            self._add_record((ip_key, devices, multi, ip, d.get('asn', _MISSING), d.get('country_code', _MISSING)))
+        except KeyError as ke:  # that entry does not have description field
+            self.no_description += 1
+
+    def _add_record(self, record):
+        counted, complete = self._count(*record)
+        if counted:
+            self._counted.append(record)
+        if not complete:  # stops at the missing field, as a KeyError in add
+            self.no_description += 1
+            self._incomplete += 1
+
+    def _count(self, ip_key, devices, multi, ip, asn, country_code):
+        found = self.found
+        counted = False
+        for device_id, dev in devices:
+            key = (ip_key, device_id)
+            if key in found:  # don't count repetitions
+                continue
+            counted = True
+            self.devices_counter[dev] += 1
+            found.add(key)
+            if asn is _MISSING:
+                return counted, False
+            asn_devices = self.asn_device_map.get(int(asn))
+            if asn_devices is not None:
+                asn_devices[dev] += 1
+            if multi:
+                self.multi_device_ips.add(ip)
+                self.multi_device_asn.add(asn)
+                if country_code is _MISSING:
+                    return counted, False
+                self.multi_country_counter[country_code] += 1
+        return counted, True
+
+    def merge(self, other):
+        """
+        Adds the records of a later shard; devices of an ip counted by this one are
+        not counted again, so the result is the same as when all records are added
+        to one DeviceStats.
+
+        :param other: DeviceStats with the same top asns
+        :return: void
+        """
+        ids = dict((device_id, self._device_ids.setdefault(dev, len(self._device_ids)))
+                   for dev, device_id in other._device_ids.items())
+        self.no_description += other.no_description - other._incomplete
+        for ip_key, devices, multi, ip, asn, country_code in other._counted:
+            self._add_record((ip_key, [(ids[device_id], dev) for device_id, dev in devices], multi, ip, asn,
+                              country_code))
+
+
+def classify(records, infected_ips=None, top_asns=None):
+    """
+    Counts devices of one shard of censys records, e.g. one censys file in a worker
+    process; results of the shards are combined with DeviceStats.merge, in order of the records.
+
+    :param records: iterable of censys records
+    :param infected_ips: optional set of infected ips, records of other ips are skipped
+    :param top_asns: see DeviceStats
+    :return: DeviceStats
+    """
+    stats = DeviceStats(top_asns)
+    for d in records:
+        if infected_ips is None or d['ip'] in infected_ips:
+            stats.add(d)
+    return stats
+
+
+class DeviceIndex(object):
+    """
+    Compact projection of censys records (ip, description, asn, country_code) kept
+    during ingestion, so devices can be counted without reading the censys files again.
+    Records which can not change DeviceStats (no ',' or ' ' in the description) are
+    dropped, repeated records are kept once since DeviceStats ignores repetitions.
+    """
+
+    def __init__(self):
+        self.records = dict()  # projected record --> None, in order of appearance
+        self.no_description = Counter()  # ip --> number of records without description
+        self.strings = dict()  # interned descriptions, asns and country codes
+
+    def add(self, d):
+        """
+
+        :param d: censys record
+        :return: void
+        """
+        if 'description' not in d:
+            self.no_description[d['ip']] += 1
+            return
+        description = d['description']
+        if ',' not in description and ' ' not in description:
+            return
+        values = tuple(self._intern(d[f]) if f in d else None for f in FIELDS)
+        missing = tuple(f not in d for f in FIELDS)
+        if any(missing):
+            # DeviceStats stops in the middle of such a record, so a repetition may count again
+            self.records[values + (missing, len(self.records))] = None
+        else:
+            self.records.setdefault(values + (missing, 0), None)
+
+    def _intern(self, value):
+        if isinstance(value, str):
+            return self.strings.setdefault(value, value)
+        return value
+
+    def merge(self, other):
+        """
+        Appends records of other (e.g. of a later file).
+
+        :param other: DeviceIndex
+        :return: void
+        """
+        for key in other.records:
+            values, missing = key[:len(FIELDS)], key[len(FIELDS)]
+            values = tuple(self._intern(v) for v in values)
+            if any(missing):
+                self.records[values + (missing, len(self.records))] = None
+            else:
+                self.records.setdefault(values + (missing, 0), None)
+        self.no_description.update(other.no_description)
+
+    def iter_records(self, infected_ips):
+        """
+
+        :param infected_ips: set of infected ips
+        :return: generator of records (dict) of infected ips, in order of appearance
+        """
+        for key in self.records:
+            if key[0] in infected_ips:
+                yield dict((f, v) for f, v, missing in zip(FIELDS, key, key[len(FIELDS)]) if not missing)
+
+    def count_no_description(self, infected_ips):
+        """
+
+        :param infected_ips: set of infected ips
+        :return: number of records of infected ips without description
+        """
+        return sum(count for ip, count in self.no_description.items() if ip in infected_ips)
@@ -0,0 +1,225 @@
+"""
+Writers of the exported statistics (see loaders.export_counters, export_banners,
+export_general and process_data.export_report).
+
+A file is written to <path>.part through a large buffer (or gzip) and renamed when
+it is complete, so a run which dies while exporting never leaves a truncated file
+under the final name. Besides csv (the default, same bytes as csv.writer), files
+can be written as line delimited json or parquet (only if pyarrow is installed),
+see EXPORT_FORMAT and EXPORT_COMPRESSION in config.py.
+"""
+import concurrent.futures
+import csv
+import gzip
+import heapq
+import itertools
+import json
+import os
+from collections import namedtuple
+import config as config
+
+try:
+    import pyarrow as pyarrow
+    import pyarrow.parquet as parquet
+except ImportError:  # parquet is optional
+    pyarrow = None
+
+FORMATS = ("csv", "ndjson", "parquet")
+EXTENSIONS = {"csv": ".csv", "ndjson": ".ndjson", "parquet": ".parquet"}
+PARQUET_BATCH = 64 * 1024  # rows per parquet row group
+
+# an export of a report, run by run_jobs
+ExportJob = namedtuple("ExportJob", ["function", "args"])
+
+
+def output_path(path, fmt=config.EXPORT_FORMAT, compression=config.EXPORT_COMPRESSION):
+    """
+
+    :param path: path of the csv file, as written by previous versions
+    :param fmt: csv, ndjson or parquet
+    :param compression: None or gzip
+    :return: path of the file in that format, .csv is replaced by the extension of the format
+    """
+    if fmt not in FORMATS:
+        raise ValueError("Unknown export format %s, expected one of %s" % (fmt, ", ".join(FORMATS)))
+    if fmt != "csv":
+        if path.endswith(".csv"):
+            path = path[:-len(".csv")]
+        path += EXTENSIONS[fmt]
+    if compression == "gzip" and fmt != "parquet":  # parquet compresses its columns itself
+        path += ".gz"
+    return path
+
+
+class Writer(object):
+    """
+    Rows of a single exported file:
+
+        with exports.Writer(path, ["key", "count"]) as writer:
+            writer.write_rows(counter.most_common())
+    """
+
+    def __init__(self, path, fields, list_field=False, fmt=config.EXPORT_FORMAT,
+                 compression=config.EXPORT_COMPRESSION, buffer_bytes=config.EXPORT_BUFFER_BYTES):
+        """
+
+        :param path: path of the csv file, see output_path
+        :param fields: names of the columns, used by ndjson and parquet
+        :param list_field: if True the last column is a list, its items are separate columns in csv
+        :param fmt: csv, ndjson or parquet
+        :param compression: None or gzip
+        :param buffer_bytes: size of the write buffer
+        """
+        self.path = output_path(path, fmt, compression)
+        self.fields = list(fields)
+        self.list_field = list_field
+        self.fmt = fmt
+        self.rows = 0
+        self._part = self.path + ".part"
+        self._batch = []
+        self._parquet = None
+        if fmt == "parquet":
+            if pyarrow is None:
+                raise ImportError("pyarrow is needed for parquet exports (pip install pyarrow)")
+            self._compression = compression or "snappy"
+            self._file = None
+        elif compression == "gzip":
+            self._file = gzip.open(self._part, "wt", compresslevel=6)
+        elif compression is None:
+            self._file = open(self._part, "w", buffering=buffer_bytes)
+        else:
+            raise ValueError("Unknown compression %s, expected None or gzip" % compression)
+        if fmt == "csv":
+            self._csv = csv.writer(self._file, dialect='excel')
+
+    def write(self, row):
+        """
+
+        :param row: sequence of values, in order of fields
+        :return: void
+        """
+        self.write_rows([row])
+
+    def write_rows(self, rows):
+        """
+
+        :param rows: iterable of rows, see write
+        :return: void
+        """
+        if self.fmt == "csv":
+            if self.list_field:
+                rows = (list(row[:-1]) + list(row[-1]) for row in rows)
+            self._csv.writerows(self._counted(rows))
+        elif self.fmt == "ndjson":
+            fields = self.fields
+            self._file.writelines(json.dumps(dict(zip(fields, self._listed(row))), default=str) + "\n"
+                                  for row in self._counted(rows))
+        else:
+            for row in self._counted(rows):
+                self._batch.append(self._listed(row))
+                if len(self._batch) >= PARQUET_BATCH:
+                    self._write_batch()
+
+    def _counted(self, rows):
+        for row in rows:
+            self.rows += 1
+            yield row
+
+    def _listed(self, row):
+        if self.list_field:
+            return list(row[:-1]) + [list(row[-1])]
+        return list(row)
+
+    def _write_batch(self):
+        columns = dict((field, [row[i] for row in self._batch]) for i, field in enumerate(self.fields))
+        table = pyarrow.Table.from_pydict(columns)
+        if self._parquet is None:
+            self._parquet = parquet.ParquetWriter(self._part, table.schema, compression=self._compression)
+        else:
+            table = table.cast(self._parquet.schema.to_arrow_schema())
+        self._parquet.write_table(table)
+        self._batch = []
+
+    def close(self):
+        """
+        Flushes the rows and renames the file to its final name.
+
+        :return: path of the file
+        """
+        if self.fmt == "parquet":
+            if self._batch or self._parquet is None:
+                self._write_batch()
+            self._parquet.close()
+        else:
+            self._file.close()
+        os.replace(self._part, self.path)
+        return self.path
+
+    def abort(self):
+        """
+        Removes the unfinished file.
+
+        :return: void
+        """
+        try:
+            if self._parquet is not None:
+                self._parquet.close()
+            elif self._file is not None:
+                self._file.close()
+        finally:
+            if os.path.exists(self._part):
+                os.remove(self._part)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+def largest(items, size, top_k=None):
+    """
+    Sorts items by size, descending, ties in order of items (as sorted with key=lambda e: -size(e)).
+    With top_k only the largest items are kept in a heap, instead of sorting all of them.
+
+    :param items: iterable of items
+    :param size: function of an item, e.g. lambda e: len(e[1])
+    :param top_k: optional number of items returned
+    :return: list of items
+    """
+    if top_k is None:
+        return sorted(items, key=lambda e: -size(e))
+    return heapq.nlargest(top_k, items, key=size)
+
+
+def first(items, top_k=None):
+    """
+
+    :param items: iterable of items already sorted
+    :param top_k: optional number of items returned
+    :return: iterable of the first top_k items, all items if None
+    """
+    if top_k is None:
+        return items
+    return itertools.islice(items, top_k)
+
+
+def run_jobs(jobs, workers=config.EXPORT_WORKERS):
+    """
+    Runs exports of independent files in a pool of threads. Only the gzip compression
+    and the writes to disk release the GIL, the csv and ndjson serialization does not,
+    so the threads mostly overlap compression and disk with the serialization of other files.
+
+    :param jobs: list of ExportJob
+    :param workers: number of threads, 1 runs the jobs one by one
+    :return: list of the results of the jobs, in order of jobs
+    """
+    if workers <= 1 or len(jobs) <= 1:
+        return [job.function(*job.args) for job in jobs]
+    with concurrent.futures.ThreadPoolExecutor(min(workers, len(jobs))) as pool:
+        futures = [pool.submit(job.function, *job.args) for job in jobs]
+        return [future.result() for future in futures]
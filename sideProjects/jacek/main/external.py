@@ -0,0 +1,272 @@
+import heapq
+import os
+import pickle
+import shutil
+import tempfile
+import weakref
+import ipset as ipset
+
+PAIR_BYTES = 200  # rough size of a buffered (order, key, value) in memory
+DISK_EXPANSION = 4  # rough size in memory of a pickled bucket, relative to its size on disk
+MAX_LEVEL = 4  # buckets are split at most this many times
+RUN_CHUNK = 4096  # records per pickled chunk of a sorted run
+MAX_OPEN_RUNS = 256  # runs merged at once, more runs are first merged into longer ones
+
+
+class PartitionedGroups(object):
+    """
+    key --> values grouping kept on disk, for groupings which do not fit in memory
+    (ip --> asns in process_data.group_by, banner --> ips in group_by_banners).
+    Pairs are hash-partitioned by key into bucket files, every bucket is grouped
+    and sorted on its own (split again while it is larger than the memory budget)
+    and the sorted buckets are merged, so at most one bucket is in memory at a time.
+
+    The groups come out sorted by the number of values (descending), ties in order
+    of appearance of the key, and the values of a group in the same order as a set
+    (distinct=True) or list (distinct=False) filled in order of appearance. This is
+    the order of sorting the in-memory dict with key=lambda e: -len(e[1]).
+    """
+
+    def __init__(self, memory_budget, distinct=True, dir_path=None, partitions=16):
+        """
+
+        :param memory_budget: approximate number of bytes used for buffers and a single bucket
+        :param distinct: if True the values of a key are a set, otherwise a list
+        :param dir_path: directory for the bucket files, the system temp directory by default
+        :param partitions: number of buckets (and of sub-buckets when a bucket is split)
+        """
+        self.memory_budget = memory_budget
+        self.distinct = distinct
+        self.partitions = partitions
+        self.dir = tempfile.mkdtemp(prefix="groups_", dir=dir_path)
+        self._cleanup = weakref.finalize(self, shutil.rmtree, self.dir, True)
+        self.buffer = []  # (order, key, value)
+        self.pending = set()  # (key, value) in the buffer, distinct only
+        self.buffer_limit = max(1024, memory_budget // PAIR_BYTES)
+        self.buckets = [os.path.join(self.dir, "bucket_%d" % i) for i in range(partitions)]
+        self.runs = 0
+
+    def add(self, order, key, value):
+        """
+
+        :param order: position of the pair in the input (e.g. row index), increasing
+        :param key:
+        :param value:
+        :return: void
+        """
+        if self.distinct:
+            if (key, value) in self.pending:
+                return  # repetitions do not change the set
+            self.pending.add((key, value))
+        self.buffer.append((order, key, value))
+        if len(self.buffer) >= self.buffer_limit:
+            self.flush()
+
+    def flush(self):
+        """
+        Appends the buffered pairs to the bucket files.
+
+        :return: void
+        """
+        if self.buffer:
+            _partition(self.buffer, self.buckets, 0)
+        self.buffer = []
+        self.pending = set()
+
+    def sorted_groups(self, keep=None):
+        """
+        Groups can be read several times (e.g. for several sets of infected ips).
+
+        :param keep: optional set (or ipset.IPSet) of keys, other keys are left out
+        :return: generator of (key, list of values), sorted by the number of values
+        """
+        self.flush()
+        runs = []
+        for bucket in self.buckets:
+            if os.path.exists(bucket):
+                runs.extend(self._sort_bucket(bucket, keep, 0))
+        return _merge_runs(_merge_down(runs, self._write_run), self)
+
+    def _sort_bucket(self, bucket, keep, level):
+        if os.path.getsize(bucket) * DISK_EXPANSION > self.memory_budget and level < MAX_LEVEL:
+            # too large, split by another hash of the key
+            sub_buckets = [bucket + "_%d" % i for i in range(self.partitions)]
+            for chunk in _read_chunks(bucket):
+                _partition(chunk, sub_buckets, level + 1)
+            runs = []
+            for sub_bucket in sub_buckets:
+                if os.path.exists(sub_bucket):
+                    runs.extend(self._sort_bucket(sub_bucket, keep, level + 1))
+                    os.remove(sub_bucket)
+            return runs
+
+        groups = dict()  # key --> (order, values)
+        for chunk in _read_chunks(bucket):
+            for order, key, value in chunk:
+                group = groups.get(key)
+                if group is None:
+                    group = groups[key] = (order, set() if self.distinct else [])
+                if self.distinct:
+                    group[1].add(value)
+                else:
+                    group[1].append(value)
+        keys = list(groups)
+        members = ipset.isin(keys, keep) if keep is not None else [True] * len(keys)
+        records = sorted((-len(values), order, key, list(values))
+                         for key, (order, values), member in zip(keys, groups.values(), members) if member)
+        groups = None
+        return [self._write_run(records)]
+
+    def _write_run(self, records):
+        run = os.path.join(self.dir, "run_%d" % self.runs)
+        self.runs += 1
+        _write_run(run, records)
+        return run
+
+    def close(self):
+        """
+        Removes the bucket files.
+
+        :return: void
+        """
+        self._cleanup()
+
+
+class SortedRuns(object):
+    """
+    Records sorted on disk, for inputs which do not fit in memory (the two sides of
+    join.merge_join). Records are buffered up to the memory budget, every full buffer
+    is sorted and written as a run, and the runs are merged while reading, so only
+    the buffer and one chunk of every run are in memory at a time.
+
+    Records are tuples compared as a whole, so they should start with a unique
+    prefix (e.g. key and position in the input) when the rest is not comparable.
+    """
+
+    def __init__(self, memory_budget, record_bytes=PAIR_BYTES, dir_path=None):
+        """
+
+        :param memory_budget: approximate number of bytes used for the buffer
+        :param record_bytes: rough size of a record in memory
+        :param dir_path: directory for the run files, the system temp directory by default
+        """
+        self.dir = tempfile.mkdtemp(prefix="runs_", dir=dir_path)
+        self._cleanup = weakref.finalize(self, shutil.rmtree, self.dir, True)
+        self.buffer = []
+        self.buffer_limit = max(1024, memory_budget // record_bytes)
+        self.runs = []
+        self.written = 0  # runs written, including those merged into longer ones
+        self.count = 0
+
+    def add(self, record):
+        """
+
+        :param record: tuple
+        :return: void
+        """
+        self.buffer.append(record)
+        self.count += 1
+        if len(self.buffer) >= self.buffer_limit:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered records as a sorted run.
+
+        :return: void
+        """
+        if self.buffer:
+            self.buffer.sort()
+            self.runs.append(self._write_run(self.buffer))
+        self.buffer = []
+
+    def __iter__(self):
+        """
+        Records can be read several times, a run is never removed while reading.
+
+        :return: generator of the records in sorted order
+        """
+        self.flush()
+        self.runs = _merge_down(self.runs, self._write_run)
+        return heapq.merge(*[_iter_run(run) for run in self.runs])
+
+    def _write_run(self, records):
+        run = os.path.join(self.dir, "run_%d" % self.written)
+        self.written += 1
+        _write_run(run, records)
+        return run
+
+    def close(self):
+        """
+        Removes the run files.
+
+        :return: void
+        """
+        self._cleanup()
+
+
+def _partition(pairs, buckets, level):
+    parts = [[] for _ in buckets]
+    for pair in pairs:
+        key = pair[1]
+        parts[hash((level, key) if level else key) % len(buckets)].append(pair)
+    for bucket, part in zip(buckets, parts):
+        if part:
+            with open(bucket, "ab") as bucket_file:
+                pickle.dump(part, bucket_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _read_chunks(path):
+    with open(path, "rb") as chunk_file:
+        while True:
+            try:
+                yield pickle.load(chunk_file)
+            except EOFError:
+                return
+
+
+def _write_run(path, records):
+    with open(path, "wb") as run_file:
+        chunk = []
+        for record in records:
+            chunk.append(record)
+            if len(chunk) >= RUN_CHUNK:
+                pickle.dump(chunk, run_file, protocol=pickle.HIGHEST_PROTOCOL)
+                chunk = []
+        if chunk:
+            pickle.dump(chunk, run_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _merge_down(runs, write_run):
+    """
+    Too many open files for a single merge: the first MAX_OPEN_RUNS runs are merged
+    into a longer one (and removed) until at most MAX_OPEN_RUNS are left.
+
+    :param runs: list of paths of sorted runs
+    :param write_run: function writing records to a new run, returns its path
+    :return: list of paths of sorted runs
+    """
+    while len(runs) > MAX_OPEN_RUNS:
+        merged = write_run(heapq.merge(*[_iter_run(run) for run in runs[:MAX_OPEN_RUNS]]))
+        for run in runs[:MAX_OPEN_RUNS]:
+            os.remove(run)
+        runs = runs[MAX_OPEN_RUNS:] + [merged]
+    return runs
+
+
+def _iter_run(path):
+    for chunk in _read_chunks(path):
+        for record in chunk:
+            yield record
+
+
+def _merge_runs(runs, groups):
+    # groups is referenced until the runs are read, its directory is removed with it
+    try:
+        # (-len, order) is unique, the keys and values are never compared
+        for negative_len, order, key, values in heapq.merge(*[_iter_run(run) for run in runs]):
+            yield key, values
+    finally:
+        for run in runs:
+            if os.path.exists(run):
+                os.remove(run)
@@ -0,0 +1,251 @@
+"""
+Timing and memory of the stages of the pipeline (load, scan, intersect, counts, ...).
+Stages are always recorded, the rest is switched on with environment variables
+(see config.py), so production runs can be profiled without editing the code:
+
+    MIRAI_STAGES=1                  print every stage when it starts and ends
+    MIRAI_RUN_SUMMARY=run.json      save a json summary of all stages at exit
+    MIRAI_PROFILE_DIR=prof          save a cProfile dump per stage (prof/<stage>.prof)
+    MIRAI_PROFILE_STAGES=scan,load  only profile these stages
+    MIRAI_TRACEMALLOC_DIR=mem       trace python allocations, save the top lines per stage (mem/<stage>.txt)
+"""
+import atexit
+import collections
+import cProfile
+import datetime
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+import config as config
+
+_local = threading.local()  # stack of the stages currently running in a thread, outermost first
+_lock = threading.Lock()  # guards the records and totals, stages also end in worker threads
+_records = collections.deque(maxlen=config.STAGE_RECORDS)  # last finished stages, in order of completion
+_totals = dict()  # path --> calls, seconds and rows of all finished stages
+_finished = [0]  # number of finished stages
+_started = time.time()
+_profiling = [False]  # cProfile can not be nested, inner stages are part of the outer dump
+
+
+def _stack():
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+class Stage(object):
+    """
+    One run of a stage, returned by stage(). Set rows when the number of
+    processed rows is only known at the end.
+    """
+
+    def __init__(self, name, path, rows=None):
+        self.name = name
+        self.path = path  # names of the enclosing stages and this one, joined by "/"
+        self.rows = rows
+        self.seconds = None
+        self.rss_mb = None
+        self.peak_rss_mb = None
+        self.python_peak_mb = None  # only with tracemalloc
+
+    def as_dict(self):
+        record = {
+            "stage": self.name,
+            "path": self.path,
+            "seconds": round(self.seconds, 6),
+            "rows": self.rows,
+            "rows_per_second": self.rows / self.seconds if self.rows is not None and self.seconds > 0 else None,
+            "rss_mb": self.rss_mb,
+            "peak_rss_mb": self.peak_rss_mb,
+        }
+        if self.python_peak_mb is not None:
+            record["python_peak_mb"] = self.python_peak_mb
+        return record
+
+
+def stage(name, rows=None):
+    """
+    Measures a stage:
+
+        with instrument.stage("scan") as s:
+            s.rows = scan(...)
+
+    :param name: name of the stage
+    :param rows: number of rows processed by the stage, if known in advance
+    :return: context manager giving a Stage
+    """
+    return _StageContext(name, rows)
+
+
+class _StageContext(object):
+
+    def __init__(self, name, rows=None):
+        self.record = Stage(name, "/".join([s.name for s in _stack()] + [name]), rows)
+        self.profiler = None
+        self.start = None
+
+    def __enter__(self):
+        record = self.record
+        if config.PRINT_STAGES:
+            print("[stage] %s started" % record.path)
+        if config.TRACEMALLOC_DIR is not None:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            stack = _stack()
+            if stack:  # keep the peak of the enclosing stage before resetting it
+                _fold_peak(stack[-1])
+            tracemalloc.reset_peak()
+            record.python_peak_mb = 0.0
+        _stack().append(record)
+        if config.PROFILE_DIR is not None and (config.PROFILE_STAGES is None or record.name in config.PROFILE_STAGES):
+            with _lock:
+                if not _profiling[0]:
+                    self.profiler = cProfile.Profile()
+                    _profiling[0] = True
+            if self.profiler is not None:
+                self.profiler.enable()
+        self.start = time.perf_counter()
+        return record
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        record = self.record
+        record.seconds = time.perf_counter() - self.start
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(_dump_path(config.PROFILE_DIR, record.path, ".prof"))
+            _profiling[0] = False
+        stack = _stack()
+        stack.pop()
+        if record.python_peak_mb is not None:
+            _fold_peak(record)
+            with open(_dump_path(config.TRACEMALLOC_DIR, record.path, ".txt"), "w") as outfile:
+                for statistic in tracemalloc.take_snapshot().statistics("lineno")[:25]:
+                    outfile.write(str(statistic) + "\n")
+            if stack and stack[-1].python_peak_mb is not None:
+                stack[-1].python_peak_mb = max(stack[-1].python_peak_mb, record.python_peak_mb)
+        record.rss_mb = rss_mb()
+        record.peak_rss_mb = peak_rss_mb()
+        with _lock:
+            _records.append(record)
+            _finished[0] += 1
+            total = _totals.setdefault(record.path, {"calls": 0, "seconds": 0.0, "rows": None})
+            total["calls"] += 1
+            total["seconds"] += record.seconds
+            if record.rows is not None:
+                total["rows"] = (total["rows"] or 0) + record.rows
+        if config.PRINT_STAGES:
+            print("[stage] %s" % describe(record))
+        return False
+
+
+def _fold_peak(record):
+    record.python_peak_mb = max(record.python_peak_mb, tracemalloc.get_traced_memory()[1] / (1024.0 * 1024.0))
+
+
+def _dump_path(dir_path, stage_path, suffix):
+    if not os.path.exists(dir_path):
+        os.makedirs(dir_path)
+    return os.path.join(dir_path, "%d_%s%s" % (_finished[0], stage_path.replace("/", "."), suffix))
+
+
+def describe(record):
+    """
+
+    :param record: finished Stage
+    :return: one line with time, rows, throughput and memory of the stage
+    """
+    text = "%s: %.2f s" % (record.path, record.seconds)
+    if record.rows is not None:
+        text += ", %d rows" % record.rows
+        if record.seconds > 0:
+            text += " (%.0f rows/s)" % (record.rows / record.seconds)
+    text += ", rss %.0f MB (peak %.0f MB)" % (record.rss_mb, record.peak_rss_mb)
+    if record.python_peak_mb is not None:
+        text += ", python peak %.0f MB" % record.python_peak_mb
+    return text
+
+
+def rss_mb():
+    """
+
+    :return: current resident memory of this process in MB, or the peak if it is not available
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024.0 * 1024.0)
+    except (OSError, ValueError):
+        return peak_rss_mb()
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    """
+
+    :param who: resource.RUSAGE_SELF or resource.RUSAGE_CHILDREN (worker processes)
+    :return: high-water mark of the resident memory in MB
+    """
+    peak = resource.getrusage(who).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / (1024.0 * 1024.0)  # bytes on macOS
+    return peak / 1024.0  # kilobytes on linux
+
+
+def records():
+    """
+
+    :return: list of the last STAGE_RECORDS finished stages (Stage), in order of completion
+    """
+    with _lock:
+        return list(_records)
+
+
+def reset():
+    """
+    Forgets the finished stages, e.g. between the runs of a long running process.
+
+    :return: void
+    """
+    with _lock:
+        _records.clear()
+        _totals.clear()
+
+
+def summary():
+    """
+
+    :return: dict with the last STAGE_RECORDS finished stages and totals per stage name of all of them
+    """
+    with _lock:
+        records = list(_records)
+        totals = dict((path, dict(total)) for path, total in _totals.items())
+    for total in totals.values():
+        total["rows_per_second"] = total["rows"] / total["seconds"] \
+            if total["rows"] is not None and total["seconds"] > 0 else None
+    return {
+        "started": datetime.datetime.fromtimestamp(_started).isoformat(),
+        "argv": sys.argv,
+        "seconds": time.time() - _started,
+        "peak_rss_mb": peak_rss_mb(),
+        "children_peak_rss_mb": peak_rss_mb(resource.RUSAGE_CHILDREN),
+        "stages": [record.as_dict() for record in records],
+        "totals": totals,
+    }
+
+
+def write_summary(path):
+    """
+    Saves summary() as json.
+
+    :param path: output file
+    :return: void
+    """
+    with open(path, "w") as outfile:
+        json.dump(summary(), outfile, indent=2)
+
+
+if config.RUN_SUMMARY_PATH is not None:
+    atexit.register(write_summary, os.path.abspath(config.RUN_SUMMARY_PATH))
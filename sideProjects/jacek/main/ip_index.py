@@ -0,0 +1,210 @@
+import calendar
+import json
+import time
+from collections import Counter
+import numpy as np
+import ipset as ipset
+import mirai_cache as mirai_cache
+
+# columns with an inverted index (value --> rows)
+INDEXED = ["asn", "country", "prefix", "port"]
+
+
+class InfectedIndex(object):
+    """
+    All mirai rows of the infected ips, sorted by ip, with the columns of the mirai
+    cache (see mirai_cache.py) and an inverted index per attribute, so questions like
+    "infected ips in prefix X" or "ips of ASN Y seen after date D" are answered
+    without reading the mirai data again:
+
+        index = InfectedIndex.build(config.MIRAI_PATH, infected)
+        index.count(asn=4134, seen_after="2018-12-04T00:00:00Z")
+        index.ips(cidr="1.2.0.0/16")
+        index.counts_by("country", port=23)
+
+    Counts are numbers of distinct ips over all rows of an ip, not only its first row.
+    """
+
+    def __init__(self, columns, vocabularies):
+        """
+
+        :param columns: dict name --> numpy array, rows sorted by ip
+        :param vocabularies: dict name --> list of strings, for asn, country and prefix
+        """
+        self.columns = columns
+        self.vocabularies = vocabularies
+        self.codes = dict((name, dict((text, code) for code, text in enumerate(vocabulary)))
+                          for name, vocabulary in vocabularies.items())
+        self.inverted = dict()  # name --> (sorted distinct values, start of their rows in order)
+        for name in INDEXED:
+            order = np.argsort(columns[name], kind="stable")  # rows of a value stay sorted
+            values, starts = np.unique(columns[name][order], return_index=True)
+            self.inverted[name] = (values, np.append(starts, len(order)), order)
+
+    @classmethod
+    def build(cls, path_to_mirai, infected_ips):
+        """
+
+        :param path_to_mirai: absolute path to csv, the cache is built if it is missing or stale
+        :param infected_ips: set (or ipset.IPSet) of infected ips
+        :return: InfectedIndex
+        """
+        table = mirai_cache.load_cache(path_to_mirai)
+        if table is None:
+            mirai_cache.build_cache(path_to_mirai)
+            table = mirai_cache.load_cache(path_to_mirai)
+        positions = table.candidate_rows(infected_ips)
+        positions = positions[np.argsort(table["ip"][positions], kind="stable")]
+        columns = dict((name, np.ascontiguousarray(table[name][positions])) for name in mirai_cache.COLUMNS)
+        return cls(columns, table.vocabularies)
+
+    def __len__(self):
+        return len(self.columns["ip"])
+
+    def save(self, path):
+        """
+
+        :param path: output .npz file
+        :return: void
+        """
+        np.savez(path, vocabularies=np.array(json.dumps(self.vocabularies)), **self.columns)
+
+    @classmethod
+    def load(cls, path):
+        """
+
+        :param path: .npz file written by save
+        :return: InfectedIndex
+        """
+        with np.load(path) as data:
+            columns = dict((name, data[name]) for name in mirai_cache.COLUMNS)
+            return cls(columns, json.loads(str(data["vocabularies"])))
+
+    def rows(self, asn=None, country=None, prefix=None, port=None, cidr=None,
+             seen_after=None, seen_before=None, seen="fseen"):
+        """
+        Positions of the rows matching all given filters.
+
+        :param asn: asn as in the csv (string or int)
+        :param country: country code
+        :param prefix: prefix as in the csv, e.g. "1.2.3.0/24"
+        :param port: destination port
+        :param cidr: range of ips, e.g. "1.2.0.0/16"
+        :param seen_after: string in format %Y-%m-%dT%H:%M:%SZ, rows on or after that date
+        :param seen_before: string in format %Y-%m-%dT%H:%M:%SZ, rows before that date
+        :param seen: fseen or lseen used by the date filters
+        :return: sorted int64 array of row positions
+        :raises ValueError: if a date is not in format %Y-%m-%dT%H:%M:%SZ
+        """
+        ip_column = self.columns["ip"]
+        start, end = 0, len(ip_column)
+        if cidr is not None:  # rows are sorted by ip, a range of ips is a range of rows
+            low, high = cidr_range(cidr)
+            start = int(np.searchsorted(ip_column, low, side="left"))
+            end = int(np.searchsorted(ip_column, high, side="right"))
+
+        selected = None
+        for name, value in (("asn", asn), ("country", country), ("prefix", prefix), ("port", port)):
+            if value is None:
+                continue
+            rows = self._lookup(name, value)
+            rows = rows[(rows >= start) & (rows < end)]
+            selected = rows if selected is None else np.intersect1d(selected, rows, assume_unique=True)
+        if selected is None:
+            selected = np.arange(start, end)
+
+        if seen_after is not None or seen_before is not None:
+            times = self.columns[seen][selected]
+            mask = times != mirai_cache.TIME_MISSING
+            if seen_after is not None:
+                mask &= times >= parse_bound(seen_after)
+            if seen_before is not None:
+                mask &= times < parse_bound(seen_before)
+            selected = selected[mask]
+        return selected
+
+    def _lookup(self, name, value):
+        if name == "port":
+            code = int(value)
+        else:
+            code = self.codes[name].get(str(value))
+            if code is None:
+                return np.empty(0, dtype=np.int64)
+        values, starts, order = self.inverted[name]
+        i = int(np.searchsorted(values, code))
+        if i == len(values) or values[i] != code:
+            return np.empty(0, dtype=np.int64)
+        return order[starts[i]:starts[i + 1]].astype(np.int64)
+
+    def ip_values(self, **filters):
+        """
+
+        :param filters: see rows
+        :return: sorted uint32 array of distinct ips of the matching rows
+        """
+        ips = self.columns["ip"][self.rows(**filters)]
+        if len(ips) == 0:
+            return ips
+        return ips[np.append(True, ips[1:] != ips[:-1])]  # rows are sorted by ip
+
+    def ips(self, **filters):
+        """
+
+        :param filters: see rows
+        :return: list of distinct dotted-quad ips of the matching rows, sorted
+        """
+        return [ipset.int_to_ip(v) for v in self.ip_values(**filters).tolist()]
+
+    def count(self, **filters):
+        """
+
+        :param filters: see rows
+        :return: number of distinct ips of the matching rows
+        """
+        return len(self.ip_values(**filters))
+
+    def counts_by(self, name, **filters):
+        """
+
+        :param name: asn, country, prefix or port
+        :param filters: see rows
+        :return: Counter value --> number of distinct ips of the matching rows with that value
+        """
+        rows = self.rows(**filters)
+        pairs = np.unique((self.columns["ip"][rows].astype(np.int64) << 32) |
+                          (self.columns[name][rows].astype(np.int64) & 0xFFFFFFFF))
+        codes, counts = np.unique((pairs & 0xFFFFFFFF).astype(np.uint32).astype(self.columns[name].dtype),
+                                  return_counts=True)
+        if name in self.vocabularies:
+            keys = [self.vocabularies[name][code] for code in codes.tolist()]
+        else:
+            keys = codes.tolist()
+        return Counter(dict(zip(keys, counts.tolist())))
+
+
+def parse_bound(date):
+    """
+
+    :param date: string in format %Y-%m-%dT%H:%M:%SZ
+    :return: seconds since epoch (UTC), as the fseen and lseen columns
+    :raises ValueError: if the date is not in that format
+    """
+    try:
+        return calendar.timegm(time.strptime(date, mirai_cache.TIME_FORMAT))
+    except (TypeError, ValueError):
+        raise ValueError("Not a date in format %s: %r" % (mirai_cache.TIME_FORMAT, date))
+
+
+def cidr_range(cidr):
+    """
+
+    :param cidr: e.g. "1.2.0.0/16", or a single address
+    :return: (first, last) address of the range as integers
+    """
+    address, _, bits = cidr.partition("/")
+    bits = int(bits) if bits else 32
+    if not 0 <= bits <= 32:
+        raise ValueError("Not an IPv4 network: %s" % cidr)
+    mask = (0xFFFFFFFF << (32 - bits)) & 0xFFFFFFFF
+    first = ipset.ip_to_int(address) & mask
+    return first, first | (~mask & 0xFFFFFFFF)
@@ -0,0 +1,243 @@
+import socket
+import struct
+from array import array
+import numpy as np
+
+
+def ip_to_int(ip):
+    """
+
+    :param ip: dotted-quad ipv4 address
+    :return: address as an unsigned 32-bit integer
+    """
+    try:
+        return struct.unpack("!I", socket.inet_pton(socket.AF_INET, ip))[0]
+    except (OSError, TypeError):
+        raise ValueError("Not an IPv4 address: %s" % ip)
+
+
+def int_to_ip(value):
+    """
+
+    :param value: unsigned 32-bit integer
+    :return: dotted-quad ipv4 address
+    """
+    return socket.inet_ntoa(struct.pack("!I", value))
+
+
+def ips_to_array(ips, strict=True):
+    """
+
+    :param ips: iterable of dotted-quad addresses
+    :param strict: if False, addresses which are not ipv4 are mapped to -1 instead of raising ValueError
+    :return: int64 numpy array
+    """
+    if strict:
+        return np.fromiter((ip_to_int(ip) for ip in ips), dtype=np.int64)
+    return np.fromiter((_ip_to_int_or_missing(ip) for ip in ips), dtype=np.int64)
+
+
+def _ip_to_int_or_missing(ip):
+    try:
+        return ip_to_int(ip)
+    except ValueError:
+        return -1
+
+
+def isin(ips, ip_set):
+    """
+    Membership test for many ips at once, vectorized when ip_set is an IPSet.
+
+    :param ips: list of dotted-quad addresses
+    :param ip_set: IPSet or python set
+    :return: list of booleans
+    """
+    if isinstance(ip_set, IPSet):
+        return ip_set.isin(ips).tolist()
+    return [ip in ip_set for ip in ips]
+
+
+class IPSet(object):
+    """
+    Set of ipv4 addresses kept as a sorted array of unsigned 32-bit integers.
+    Uses 4 bytes per address instead of a python string per address, set
+    operations are done with numpy on whole arrays. Addresses which are not
+    ipv4 (rare, e.g. ipv6 in censys) are kept as strings in a small python set,
+    others, so the set has the same members as a python set of the addresses.
+    """
+    others = frozenset()  # sets saved before others existed
+
+    def __init__(self, ips=()):
+        """
+
+        :param ips: iterable of addresses, or another IPSet
+        """
+        if isinstance(ips, IPSet):
+            self.values = ips.values.copy()
+            self.others = set(ips.others)
+        else:
+            ips = ips if isinstance(ips, (list, tuple)) else list(ips)
+            values = ips_to_array(ips, strict=False)
+            self.others = set(ips[i] for i in np.nonzero(values < 0)[0].tolist())
+            self.values = np.unique(values[values >= 0].astype(np.uint32))
+
+    @classmethod
+    def from_ints(cls, values, assume_unique=False, others=()):
+        """
+
+        :param values: array of integers
+        :param assume_unique: True if values are already sorted and unique
+        :param others: addresses which are not ipv4
+        :return: IPSet
+        """
+        ip_set = cls()
+        values = np.asarray(values, dtype=np.uint32)
+        ip_set.values = values if assume_unique else np.unique(values)
+        ip_set.others = set(others)
+        return ip_set
+
+    def __len__(self):
+        return len(self.values) + len(self.others)
+
+    def __iter__(self):
+        for value in self.values.tolist():
+            yield int_to_ip(value)
+        for ip in sorted(self.others):
+            yield ip
+
+    def __contains__(self, ip):
+        if isinstance(ip, str):
+            value = _ip_to_int_or_missing(ip)
+            if value < 0:
+                return ip in self.others
+            ip = value
+        i = np.searchsorted(self.values, ip)
+        return i < len(self.values) and self.values[i] == ip
+
+    def __eq__(self, other):
+        return isinstance(other, IPSet) and np.array_equal(self.values, other.values) and self.others == other.others
+
+    def __and__(self, other):
+        return self.intersection(other)
+
+    def __or__(self, other):
+        return self.union(other)
+
+    def __sub__(self, other):
+        return self.difference(other)
+
+    def isin(self, ips):
+        """
+
+        :param ips: list of addresses or array of integers
+        :return: numpy array of booleans
+        """
+        if isinstance(ips, np.ndarray):
+            return np.isin(ips, self.values)
+        values = ips_to_array(ips, strict=False)
+        result = np.isin(values, self.values)
+        if self.others:
+            for i in np.nonzero(values < 0)[0].tolist():
+                result[i] = ips[i] in self.others
+        return result
+
+    def copy(self):
+        return IPSet(self)
+
+    def intersection(self, other):
+        """
+
+        :param other: IPSet or iterable of addresses
+        :return: IPSet
+        """
+        other = _as_ipset(other)
+        return IPSet.from_ints(np.intersect1d(self.values, other.values, assume_unique=True),
+                               assume_unique=True, others=self.others & other.others)
+
+    def difference(self, other):
+        """
+
+        :param other: IPSet or iterable of addresses
+        :return: IPSet
+        """
+        other = _as_ipset(other)
+        return IPSet.from_ints(np.setdiff1d(self.values, other.values, assume_unique=True),
+                               assume_unique=True, others=self.others - other.others)
+
+    def union(self, other):
+        """
+
+        :param other: IPSet or iterable of addresses
+        :return: IPSet
+        """
+        other = _as_ipset(other)
+        return IPSet.from_ints(_merge_unique(self.values, other.values), assume_unique=True,
+                               others=self.others | other.others)
+
+
+class IPSetBuilder(object):
+    """
+    Collects addresses one by one into a compact buffer, duplicates are dropped
+    every flush_size addresses so the buffer does not grow with repeated ips.
+    Addresses which are not ipv4 go to the others of the IPSet.
+    """
+
+    def __init__(self, flush_size=1 << 22):
+        self.flush_size = flush_size
+        self.buffer = array('I')
+        self.values = np.empty(0, dtype=np.uint32)
+        self.others = set()
+
+    def add(self, ip):
+        try:
+            self.buffer.append(ip_to_int(ip))
+        except ValueError:
+            self.others.add(ip)
+            return
+        if len(self.buffer) >= self.flush_size:
+            self._flush()
+
+    def add_ints(self, values):
+        """
+
+        :param values: sorted array of unique integers
+        :return: void
+        """
+        self._flush()
+        self.values = _merge_unique(self.values, np.asarray(values, dtype=np.uint32))
+
+    def _flush(self):
+        if len(self.buffer) > 0:
+            self.values = _merge_unique(self.values, np.unique(np.frombuffer(self.buffer, dtype=np.uint32)))
+            self.buffer = array('I')
+
+    def build(self):
+        """
+
+        :return: IPSet with all added addresses
+        """
+        self._flush()
+        return IPSet.from_ints(self.values, assume_unique=True, others=self.others)
+
+
+def _as_ipset(ips):
+    if isinstance(ips, IPSet):
+        return ips
+    return IPSet(ips)
+
+
+def _merge_unique(a, b):
+    """
+
+    :param a: sorted array of unique integers
+    :param b: sorted array of unique integers
+    :return: sorted array of unique integers from both arrays
+    """
+    merged = np.concatenate((a, b))
+    merged.sort(kind="stable")  # linear for two sorted runs of 32-bit integers
+    if len(merged) == 0:
+        return merged
+    keep = np.empty(len(merged), dtype=bool)
+    keep[0] = True
+    np.not_equal(merged[1:], merged[:-1], out=keep[1:])
+    return merged[keep]
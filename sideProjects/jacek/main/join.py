@@ -0,0 +1,226 @@
+"""
+Join of mirai and censys by ip for data which does not fit in memory, instead of
+the sets of process_data.match_mirai_censys. Both sides are sorted by ip on disk
+under a memory budget (see external.SortedRuns) and merged:
+
+    censys = join.sort_censys(config.JSON_DATA_DIR, memory_budget)
+    mirai = join.MiraiRuns(memory_budget, filter_port=True, filter_date=True)
+    loaders.scan_mirai(config.MIRAI_PATH, [mirai])
+    for joined in join.merge_join(censys, mirai):
+        joined.ip, joined.banner, joined.censys, joined.mirai
+
+Every infected ip comes once, in order of ip, with its censys records (port 23 or
+2323, in order of the files) and all its mirai rows (in order of the csv), so
+statistics of the infected ips are collected while reading the join, see scan_join
+and process_data.generate_join_report.
+"""
+import itertools
+from collections import namedtuple
+import aggregators as aggregators
+import config as config
+import external as external
+import ipset as ipset
+import loaders as loaders
+
+# rough size in memory of a sorted record of each side
+CENSYS_RECORD_BYTES = 600
+MIRAI_RECORD_BYTES = 2000
+
+# fields of a censys record kept by the join
+CensysRecord = namedtuple("CensysRecord", ["banner", "description", "asn", "country"])
+
+
+class JoinedIp(namedtuple("JoinedIp", ["ip", "censys", "mirai"])):
+    """
+    An infected ip: list of CensysRecord and list of (index, row) of its mirai rows.
+    """
+    __slots__ = ()
+
+    @property
+    def banner(self):
+        """
+
+        :return: the last non empty banner, as in the banner map of loaders.load_censys_ips, or None
+        """
+        for record in reversed(self.censys):
+            if record.banner:
+                return record.banner
+        return None
+
+    @property
+    def empty_banner(self):
+        """
+
+        :return: True if a censys record has an empty banner, as the ips_no_banner of loaders.load_censys_ips
+        """
+        return any(record.banner == "" for record in self.censys)
+
+
+class MiraiRuns(aggregators.MiraiIpFilter):
+    """
+    Mirai rows sorted by ip on disk, each with a flag telling if it matches the filters
+    (see aggregators.MiraiIpFilter). Filled by loaders.scan_mirai; rows read from the
+    columnar cache only have the columns kept in the cache.
+    """
+
+    def __init__(self, memory_budget, dir_path=config.SPILL_DIR, **filters):
+        """
+
+        :param memory_budget: approximate number of bytes used for the rows in memory
+        :param dir_path: directory for the run files, the system temp directory by default
+        :param filters: parameters of aggregators.MiraiIpFilter
+        """
+        aggregators.MiraiIpFilter.__init__(self, **filters)
+        self.runs = external.SortedRuns(memory_budget, MIRAI_RECORD_BYTES, dir_path=dir_path)
+        self._rows = []
+        self._indices = []
+
+    def update(self, row, index):
+        self._rows.append(row)
+        self._indices.append(index)
+        aggregators.MiraiIpFilter.update(self, row, index)
+
+    def _flush(self):
+        aggregators.MiraiIpFilter._flush(self)
+        self._rows = []
+        self._indices = []
+
+    def _collect(self, mask):
+        for ip, index, matches, row in zip(self._ips, self._indices, mask.tolist(), self._rows):
+            self.runs.add((ip, index, matches, row))
+
+    def update_table(self, table, positions):
+        mask = self._table_mask(table, positions)
+        for (position, row), matches in zip(table.iter_rows(positions), mask.tolist()):
+            self.runs.add((row[config.IP], position, matches, row))
+
+    def __iter__(self):
+        """
+
+        :return: generator of (ip, index, matches, row) sorted by ip and index
+        """
+        self._flush()
+        return iter(self.runs)
+
+    def close(self):
+        self.runs.close()
+
+
+def sort_censys(dir_path, memory_budget, version=2, dir_path_runs=config.SPILL_DIR):
+    """
+    Censys records with port 23 or 2323 sorted by ip on disk, read as by loaders.load_censys_ips.
+
+    :param dir_path: directory with censys files
+    :param memory_budget: approximate number of bytes used for the records in memory
+    :param version: new data files
+    :param dir_path_runs: directory for the run files, the system temp directory by default
+    :return: external.SortedRuns of (ip, position, CensysRecord), total_others
+    """
+    runs = external.SortedRuns(memory_budget, CENSYS_RECORD_BYTES, dir_path=dir_path_runs)
+    total_others = 0
+    order = 0
+    files = [dir_path + "/" + _file for _file in loaders.censys_files(dir_path)]
+    for file_path, scan_file in loaders.prefetch_scans(files):
+        print("processing file: ", file_path)
+        for d in loaders.iter_scan(file_path, scan_file=scan_file):
+            order += 1
+            if version == 2:
+                temp_ports = [int(p) for p in d['ports']]
+                if 23 not in temp_ports and 2323 not in temp_ports:
+                    total_others += 1  # counted as by load_censys_file, may contain duplicates
+                    continue
+            if not isinstance(d['ip'], str):
+                raise ValueError('Not a string: %s' % d['ip'])
+            if " " in d['ip']:
+                raise ValueError("IP contains Whitespace %s" % d['ip'])
+            runs.add((d['ip'], order, CensysRecord(d.get('banner'), d.get('description'), d.get('asn'),
+                                                   d.get('country_code'))))
+    return runs, total_others
+
+
+def merge_join(censys_runs, mirai_runs):
+    """
+    Merges the two sorted sides, only one ip of each side is in memory at a time.
+
+    :param censys_runs: sorted (ip, position, CensysRecord), see sort_censys
+    :param mirai_runs: MiraiRuns, or sorted (ip, index, matches, row)
+    :return: generator of JoinedIp, for the ips with censys records and a mirai row matching the filters
+    """
+    censys_groups = itertools.groupby(censys_runs, key=lambda record: record[0])
+    mirai_groups = itertools.groupby(mirai_runs, key=lambda record: record[0])
+    censys_ip, censys_records = next(censys_groups, (None, None))
+    mirai_ip, mirai_rows = next(mirai_groups, (None, None))
+    while censys_ip is not None and mirai_ip is not None:
+        if censys_ip < mirai_ip:
+            censys_ip, censys_records = next(censys_groups, (None, None))
+        elif mirai_ip < censys_ip:
+            mirai_ip, mirai_rows = next(mirai_groups, (None, None))
+        else:
+            rows = list(mirai_rows)
+            if any(matches for ip, index, matches, row in rows):
+                yield JoinedIp(censys_ip, [record for ip, order, record in censys_records],
+                               [(index, row) for ip, index, matches, row in rows])
+            censys_ip, censys_records = next(censys_groups, (None, None))
+            mirai_ip, mirai_rows = next(mirai_groups, (None, None))
+
+
+def scan_join(joined, _aggregators, compact=False):
+    """
+    Passes the mirai rows of every infected ip to the aggregators, as loaders.scan_mirai
+    does with candidates; the aggregators keep nothing about ips which are not infected.
+
+    :param joined: iterable of JoinedIp, see merge_join
+    :param _aggregators: list of aggregators.MiraiAggregator, or of objects with an update_joined(JoinedIp) method
+    :param compact: Boolean, if True return an ipset.IPSet instead of a set
+    :return: set of the infected ips
+    """
+    infected = ipset.IPSetBuilder() if compact else set()
+    for joined_ip in joined:
+        infected.add(joined_ip.ip)
+        for a in _aggregators:
+            if hasattr(a, "update_joined"):
+                a.update_joined(joined_ip)
+            else:
+                for index, row in joined_ip.mirai:
+                    a.update(row, index)
+    return infected.build() if compact else infected
+
+
+class JoinedBanners(object):
+    """
+    Banner statistics of the infected ips read from the join, see process_data.infected_banners_stats
+    and group_by_banners.
+    """
+
+    def __init__(self, memory_budget=None):
+        """
+
+        :param memory_budget: approximate number of bytes kept in memory, None keeps all groups in memory
+        """
+        self.count_empty_banners = 0
+        self.banners2ips = dict()
+        if memory_budget is not None:
+            self.banners2ips = external.PartitionedGroups(memory_budget, distinct=False, dir_path=config.SPILL_DIR)
+        self.order = 0
+
+    def update_joined(self, joined_ip):
+        if joined_ip.empty_banner:
+            self.count_empty_banners += 1
+        banner = joined_ip.banner
+        if banner is None:
+            return
+        if isinstance(self.banners2ips, external.PartitionedGroups):
+            self.banners2ips.add(self.order, banner, joined_ip.ip)
+            self.order += 1
+        else:
+            self.banners2ips.setdefault(banner, []).append(joined_ip.ip)
+
+    def groups(self):
+        """
+
+        :return: dict banner --> list of ips, or with a memory budget a generator of (banner, list of ips)
+            already sorted for loaders.export_banners
+        """
+        if isinstance(self.banners2ips, external.PartitionedGroups):
+            return self.banners2ips.sorted_groups()
+        return self.banners2ips
@@ -2,9 +2,29 @@ import base64
 import json
 import csv
 import config as config
-import datetime
-import time
+import aggregators as aggregators
+import banners as banners
+import censys_index as censys_index
+import devices as devices
+import exports as exports
+import instrument as instrument
+import ipset as ipset
+import mirai_cache as mirai_cache
+import sketches as sketches
+import collections
+import concurrent.futures
+import gzip
+import io
+import itertools
+import multiprocessing
 import os
+import queue
+import re
+import threading
+import numpy as np
+
+_SKIP_WHITESPACE = re.compile(r"\s*")
+_SKIP_SEPARATORS = re.compile(r"[\s,]*")
 
 
 def load_scan(file_path):
@@ -18,11 +38,195 @@ def load_scan(file_path):
         return data
 
 
+def open_scan(file_path):
+    """
+    Opens a censys file for reading, gzip compressed files are decompressed on the fly.
+
+    :param file_path: path to a json, ndjson or gzip compressed file
+    :return: file object in text mode
+    """
+    with open(file_path, "rb") as raw_file:
+        magic = raw_file.read(2)
+    if magic == b"\x1f\x8b":
+        return gzip.open(file_path, "rt")
+    return open(file_path)
+
+
+def iter_scan(file_path, chunk_size=1 << 20, scan_file=None):
+    """
+    Yields censys records one at a time, so the whole file is never kept in memory.
+    Supports both the "json array of strings" files written by convert_json.py
+    and line delimited json (one record per line), optionally gzip compressed.
+
+    :param file_path: path to a censys file
+    :param chunk_size: number of characters read at once from array files
+    :param scan_file: optional file object of file_path already opened with open_scan
+        (or a reader of prefetch_scans), the file is opened here when not given
+    :return: generator of records (dict)
+    """
+    if scan_file is None:
+        scan_file = open_scan(file_path)
+    try:
+        buf = scan_file.read(chunk_size)
+        pos = _SKIP_WHITESPACE.match(buf).end()
+        if pos < len(buf) and buf[pos] == "[":
+            for d in _iter_json_array(scan_file, buf, pos + 1, chunk_size):
+                yield d
+        else:
+            for line in _iter_lines(scan_file, buf, chunk_size):
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+    finally:
+        scan_file.close()
+
+
+def _iter_lines(scan_file, buf, chunk_size):
+    """
+
+    :param scan_file: file object positioned after buf
+    :param buf: already read part of the file
+    :param chunk_size: number of characters read at once
+    :return: generator of lines, without the line breaks
+    """
+    while True:
+        lines = buf.split("\n")
+        buf = lines.pop()  # incomplete last line
+        for line in lines:
+            yield line
+        more = scan_file.read(chunk_size)
+        if not more:
+            if buf:
+                yield buf
+            return
+        buf += more
+
+
+def prefetch_scans(file_paths, ahead=config.PREFETCH_FILES, chunk_size=1 << 20, max_chunks=4):
+    """
+    Reads (and decompresses) the next files in background threads while the current
+    one is processed. Every file has a bounded queue of chunks, so at most
+    (ahead + 1) * max_chunks * chunk_size characters are kept in memory.
+
+    :param file_paths: list of paths to censys files
+    :param ahead: number of files read ahead of the current one, 0 reads every file when it is used
+    :param chunk_size: number of characters read at once
+    :param max_chunks: number of chunks queued per file
+    :return: generator of (file path, file object for iter_scan), in order of file_paths
+    """
+    if ahead < 1:
+        for file_path in file_paths:
+            yield file_path, open_scan(file_path)
+        return
+
+    stop = threading.Event()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=ahead + 1)
+    readers = collections.deque()
+    try:
+        for file_path in file_paths:
+            reader = _QueuedScan(max_chunks, stop)
+            executor.submit(reader.fill, file_path, chunk_size)
+            readers.append((file_path, reader))
+            if len(readers) > ahead:
+                yield readers.popleft()
+        while readers:
+            yield readers.popleft()
+    finally:
+        stop.set()  # unblock the threads if the files were not read to the end
+        executor.shutdown(wait=True)
+
+
+class _QueuedScan(object):
+    """
+    File object of prefetch_scans, read() returns the chunks read by a background thread.
+    """
+
+    def __init__(self, max_chunks, stop):
+        self.chunks = queue.Queue(max_chunks)
+        self.stop = stop
+        self.done = False
+        self.closed = False  # closed before the end of the file, the thread stops reading
+
+    def fill(self, file_path, chunk_size):
+        try:
+            with open_scan(file_path) as scan_file:
+                while not self.stop.is_set() and not self.closed:
+                    chunk = scan_file.read(chunk_size)
+                    self._put(chunk)
+                    if not chunk:
+                        return
+        except BaseException as e:  # raised again in the thread reading the file
+            self._put(e)
+
+    def _put(self, item):
+        while not self.stop.is_set() and not self.closed:
+            try:
+                self.chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def read(self, size=-1):
+        """
+
+        :param size: ignored, the chunks have the size given to prefetch_scans
+        :return: next chunk, empty string at the end of the file
+        """
+        if self.done:
+            return ""
+        chunk = self.chunks.get()
+        if isinstance(chunk, BaseException):
+            self.done = True
+            raise chunk
+        if not chunk:
+            self.done = True
+        return chunk
+
+    def close(self):
+        self.closed = not self.done
+        self.done = True
+
+
+def _iter_json_array(scan_file, buf, pos, chunk_size):
+    """
+    Decodes the elements of a json array one by one, reading more data only when needed.
+
+    :param scan_file: file object positioned after buf
+    :param buf: already read part of the file
+    :param pos: position in buf just after the opening bracket
+    :param chunk_size: number of characters read at once
+    :return: generator of records (dict)
+    """
+    decoder = json.JSONDecoder()
+    while True:
+        pos = _SKIP_SEPARATORS.match(buf, pos).end()
+        if pos == len(buf) or buf[pos] != "]":
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except ValueError:  # element split between two chunks, or end of the buffer
+                more = scan_file.read(chunk_size)
+                if not more:
+                    if pos == len(buf):
+                        raise ValueError("Unexpected end of json array")
+                    raise
+                buf = buf[pos:] + more
+                pos = 0
+                continue
+            # convert_json.py stores every record as a json string
+            yield json.loads(value) if isinstance(value, str) else value
+            pos = end
+        else:
+            return
+
+
 def load_mirai_ips_filter_date_port(path_to_mirai,
                                     date_limit="2018-12-04T00:00:00Z",
                                     seen="fseen",
                                     filter_port=False,
-                                    filter_date=False):
+                                    filter_date=False,
+                                    compact=False,
+                                    ports=None,
+                                    date_until=None):
     """
     This method loads data from mirai csv file into memory.
     Different combinations of port and date filter can applied
@@ -33,138 +237,544 @@ def load_mirai_ips_filter_date_port(path_to_mirai,
     :param seen: fseen or lseen
     :param filter_port: Boolean, if filter by port 23/2323
     :param filter_date: Boolean, if True read after date_limit
+    :param compact: Boolean, if True return an ipset.IPSet instead of a set
+    :param ports: list of ports used by filter_port, 23 and 2323 by default
+    :param date_until: optional string in format %Y-%m-%dT%H:%M:%SZ, read only before that date
     :return: set of ips
     """
-    ips = set()
-    start_date = time.mktime(datetime.datetime.strptime(date_limit, "%Y-%m-%dT%H:%M:%SZ").timetuple())
-    _INDEX = config.FSEEN
-    if seen == "lseen":
-        _INDEX = config.LSEEN
+    mirai_filter = aggregators.MiraiIpFilter(date_limit=date_limit,
+                                             seen=seen,
+                                             filter_port=filter_port,
+                                             filter_date=filter_date,
+                                             compact=compact,
+                                             ports=ports,
+                                             date_until=date_until)
+    with instrument.stage("load_mirai") as load_stage:
+        load_stage.rows = scan_mirai(path_to_mirai, [mirai_filter])
+        mirai_ips = mirai_filter.result()
+
+    return mirai_ips
+
+
+def scan_mirai(path_to_mirai, _aggregators, candidates=None, use_cache=True, workers=config.MIRAI_WORKERS):
+    """
+    Reads the mirai csv once and passes every row to all aggregators,
+    so several statistics are collected without re-reading the file.
+    The columnar cache of the csv (see mirai_cache.py) is used instead when it is up to date.
+
+    :param path_to_mirai: absolute path to csv
+    :param _aggregators: list of aggregators.MiraiAggregator
+    :param candidates: set of ips, aggregators with candidates_only get only rows with these ips
+    :param use_cache: if False always read the csv
+    :param workers: number of processes parsing the csv when there is no cache, see scan_mirai_parallel
+    :return: number of rows read (the results are kept by the aggregators)
+    """
+    table = mirai_cache.load_cache(path_to_mirai) if use_cache else None
+    if table is not None:
+        scan_mirai_table(table, _aggregators, candidates)
+        return len(table)
+    if workers > 1:
+        return scan_mirai_parallel(path_to_mirai, _aggregators, candidates, workers=workers)
+
+    all_rows = [a for a in _aggregators if not a.candidates_only]
+    candidate_rows = [a for a in _aggregators if a.candidates_only]
 
     mirai_file = open(path_to_mirai, "r")
     mirai_reader = csv.reader(mirai_file, dialect='excel')
 
-    for row in mirai_reader:
+    index = -1
+    skipped = 0
+    for index, row in enumerate(mirai_reader):
         # Checks
-        if not isinstance(row[0], str):
-            raise ValueError('Not a string: %s' % row[0])
-        if " " in row[0]:
-            raise ValueError("IP contains Whitespace %s" % row[0])
-
-        if len(row[0]) > 2:  # apply different matching filter below
-            if not filter_date:
-                if not filter_port:
-                    ips.add(row[0])
+        if not isinstance(row[config.IP], str):
+            raise ValueError('Not a string: %s' % row[config.IP])
+        if " " in row[config.IP]:
+            raise ValueError("IP contains Whitespace %s" % row[config.IP])
+
+        if len(row[config.IP]) > 2:  # skips the header
+            for a in all_rows:
+                a.update(row, index)
+            if candidates is None or row[config.IP] in candidates:
+                for a in candidate_rows:
+                    a.update(row, index)
+        else:
+            skipped += 1
+    mirai_file.close()
+    return index + 1 - skipped
+
+
+def scan_mirai_table(table, _aggregators, candidates=None):
+    """
+    Same as scan_mirai, reading the memory-mapped columns of the cache.
+
+    :param table: mirai_cache.MiraiTable
+    :param _aggregators: list of aggregators.MiraiAggregator
+    :param candidates: set of ips, aggregators with candidates_only get only rows with these ips
+    :return: void (the results are kept by the aggregators)
+    """
+    all_rows = table.candidate_rows()
+    candidate_rows = table.candidate_rows(candidates)
+    for a in _aggregators:
+        a.update_table(table, candidate_rows if a.candidates_only else all_rows)
+
+
+def scan_mirai_parallel(path_to_mirai, _aggregators, candidates=None, workers=config.MIRAI_WORKERS,
+                        chunk_bytes=config.MIRAI_CHUNK_BYTES):
+    """
+    Same as scan_mirai, with the csv split into byte ranges (see split_csv) parsed by a
+    pool of processes into typed columns (see mirai_cache.parse_rows). Chunks are passed
+    to the aggregators in the order of the file, so statistics depending on the order of
+    rows (e.g. the first row of every ip) are the same as when reading the csv at once.
+    As with the cache, ips have to be ipv4 addresses.
+
+    :param path_to_mirai: absolute path to csv
+    :param _aggregators: list of aggregators.MiraiAggregator
+    :param candidates: set of ips, aggregators with candidates_only get only rows with these ips
+    :param workers: number of processes
+    :param chunk_bytes: approximate size of a byte range
+    :return: number of rows read (the results are kept by the aggregators)
+    """
+    if candidates is not None and not isinstance(candidates, ipset.IPSet):
+        candidates = ipset.IPSet(ip for ip in candidates if mirai_cache._is_ipv4(ip))
+    # rows of other ips are dropped by the workers when no aggregator needs them
+    worker_candidates = candidates if all(a.candidates_only for a in _aggregators) else None
+
+    vocabularies = dict((name, dict()) for name in mirai_cache.TEXT_COLUMNS)
+    offset = 0
+    rows = 0
+    pool = multiprocessing.Pool(workers, initializer=_init_mirai_worker, initargs=(worker_candidates,))
+    try:
+        pending = collections.deque()
+        ranges = iter(split_csv(path_to_mirai, chunk_bytes))
+        while True:
+            # at most two chunks per worker are parsed ahead of the aggregators
+            for start, end in itertools.islice(ranges, 2 * workers - len(pending)):
+                pending.append(pool.apply_async(_parse_mirai_range, (path_to_mirai, start, end)))
+            if not pending:
+                break
+            columns, chunk_vocabularies, chunk_rows = pending.popleft().get()
+            for name in mirai_cache.TEXT_COLUMNS:  # codes of the chunk --> codes of the whole file
+                vocabulary = vocabularies[name]
+                mapping = np.array([vocabulary.setdefault(text, len(vocabulary)) for text in chunk_vocabularies[name]]
+                                   or [0], dtype=np.int32)
+                columns[name] = mapping[columns[name]]
+            table = mirai_cache.ChunkTable(columns, dict((name, list(vocabularies[name]))
+                                                         for name in mirai_cache.TEXT_COLUMNS), offset)
+            scan_mirai_table(table, _aggregators, candidates)
+            offset += len(table)
+            rows += chunk_rows
+    finally:
+        pool.close()
+        pool.join()
+    return rows
+
+
+def split_csv(path, chunk_bytes):
+    """
+    Splits a csv file into byte ranges of about chunk_bytes ending at line breaks
+    outside of quoted fields (a line break is inside a quoted field when an odd number
+    of quotes precedes it, escaped quotes are doubled).
+
+    :param path: path to csv
+    :param chunk_bytes: approximate size of a range
+    :return: list of (start, end) byte offsets covering the file
+    """
+    size = os.path.getsize(path)
+    ranges = []
+    start = 0
+    quotes = 0  # quotes before position
+    position = 0
+    target = chunk_bytes
+    with open(path, "rb") as csv_file:
+        while target < size:
+            block = csv_file.read(max(chunk_bytes, 1 << 20))
+            if not block:
+                break
+            search = max(0, target - position)
+            while search < len(block):
+                newline = block.find(b"\n", search)
+                if newline < 0:
+                    break
+                if (quotes + block.count(b'"', 0, newline)) % 2 == 0:
+                    ranges.append((start, position + newline + 1))
+                    start = position + newline + 1
+                    target = start + chunk_bytes
+                    search = max(newline + 1, target - position)
                 else:
-                    if int(row[3]) == 23 or int(row[3]) == 2323:
-                        ips.add(row[0])
-            else:  # Use only rows after some point at time
-                noted_on = time.mktime(datetime.datetime.strptime(row[_INDEX], "%Y-%m-%dT%H:%M:%SZ").timetuple())
-                if noted_on >= start_date:
-                    if not filter_port:  # Do not filter ports
-                        ips.add(row[0])
-                    else:
-                        if int(row[3]) == 23 or int(row[3]) == 2323:  # filter ports
-                            ips.add(row[0])
+                    search = newline + 1
+            quotes += block.count(b'"')
+            position += len(block)
+    if start < size:
+        ranges.append((start, size))
+    return ranges
+
+
+_worker_candidates = [None]
+
+
+def _init_mirai_worker(candidates):
+    _worker_candidates[0] = candidates
+
+
+def _parse_mirai_range(path_to_mirai, start, end):
+    """
+
+    :param path_to_mirai: absolute path to csv
+    :param start: byte offset of the first line
+    :param end: byte offset after the last line
+    :return: (dict column name --> numpy array, column name --> list of strings, number of rows read)
+    """
+    with open(path_to_mirai, "rb") as mirai_file:
+        mirai_file.seek(start)
+        data = mirai_file.read(end - start)
+    chunk = []
+    # decoded and with line endings translated as by open(path_to_mirai, "r") in scan_mirai
+    for row in csv.reader(io.TextIOWrapper(io.BytesIO(data)), dialect='excel'):
+        if " " in row[config.IP]:
+            raise ValueError("IP contains Whitespace %s" % row[config.IP])
+        if len(row[config.IP]) > 2:  # skips the header
+            chunk.append(row)
+    rows = len(chunk)
+    vocabularies = dict((name, dict()) for name in mirai_cache.TEXT_COLUMNS)
+    if not chunk:
+        columns = dict((name, np.empty(0, dtype=dtype)) for name, (index, dtype) in mirai_cache.COLUMNS.items())
+    else:
+        columns = mirai_cache.parse_rows(chunk, vocabularies)
+    candidates = _worker_candidates[0]
+    if candidates is not None:
+        keep = candidates.isin(columns["ip"])
+        columns = dict((name, values[keep]) for name, values in columns.items())
+    return columns, dict((name, list(vocabularies[name])) for name in mirai_cache.TEXT_COLUMNS), rows
+
+
+def censys_files(dir_path):
+    """
+    Skips hidden files and the .part files of an interrupted convert_json.py run.
 
-    return ips
+    :param dir_path: directory with censys files
+    :return: names of the censys files, sorted
+    """
+    return sorted(f for f in os.listdir(dir_path) if not f.startswith(".") and not f.endswith(".part"))
 
 
-def load_censys_ips(dir_path, version=2):
+def load_censys_ips(dir_path, version=2, workers=config.CENSYS_WORKERS, compact=config.COMPACT_IPS,
+                    device_index=None, index_path=config.CENSYS_INDEX_PATH):
     """
 
     :param dir_path:
     :param version: new data files
+    :param workers: number of processes reading the files, 1 reads them in this process
+    :param compact: if True the sets of ips are returned as ipset.IPSet
+    :param device_index: optional devices.DeviceIndex, filled with the fields used by count_devices
+    :param index_path: optional path to a censys_index.CensysIndex, only files not loaded
+        by previous runs are read when given
     :return: set of unique ids from censys files
     """
-    ips = set()  # stores elements without repetitions
-    ips_with_banner = set()
-    ips_no_banner = set()
-    ips_banners = dict()
+    if compact:
+        ips = ipset.IPSet()
+        ips_with_banner = ipset.IPSet()
+        ips_no_banner = ipset.IPSet()
+    else:
+        ips = set()  # stores elements without repetitions
+        ips_with_banner = set()
+        ips_no_banner = set()
+    ips_banners = banners.BannerStore(compact=compact)  # ip --> banner, each banner text kept once
     total_others = 0
-    files = os.listdir(dir_path)  # list all files from the directory
-    old_size = 0
-    for _file in files:
-        print("processing file: ", _file)
-        data = load_scan(dir_path + "/" + _file)
-        print("Number of lines in the file: ", len(data))
-        for d in data:
-            d = json.loads(d)
-            if version == 2:
-                temp_ports = [int(p) for p in d['ports']]
-                if 23 not in temp_ports and 2323 not in temp_ports:
-                    total_others += 1  # we dont store them in set, this count may contain duplicates
-                    continue  # not using port 23 or 2323 -> skip it
-            if not isinstance(d['ip'], str):
-                raise ValueError('Not a string: %s' % d['ip'])
-            if " " in d['ip']:
-                raise ValueError("IP contains Whitespace %s" %d['ip'])
-            # passed the checks, add to the set
-            ips.add(d['ip'])
+    merged_devices = devices.DeviceIndex() if device_index is not None else None
+    files = censys_files(dir_path)  # in order of name, so the index finds the files merged before
+    with_devices = device_index is not None
+
+    with instrument.stage("load_censys") as load_stage:
+        index = None
+        start = 0
+        if index_path is not None:
+            index = censys_index.CensysIndex(index_path, [version, compact, with_devices])
+            signatures = [index.signature(dir_path + "/" + _file) for _file in files]
+            state = index.load_state(signatures)
+            if state is not None:  # start from the files merged by the previous run
+                start, (ips, ips_with_banner, ips_no_banner, ips_banners, total_others, merged_devices) = state
+                print("Loaded %d files from the index" % start)
+        new_files = [_file for _file in files[start:]
+                     if index is None or not index.is_current(dir_path + "/" + _file)]
 
-            try:
-                if len(d['banner']) > 0:
-                    ips_banners[d['ip']] = d['banner']
-                    ips_with_banner.add(d['ip'])
-                else:
-                    ips_no_banner.add(d['ip'])
-            except KeyError as ke:
-                continue
-        print("Added %d ips from this file" % (len(ips) - old_size))
         old_size = len(ips)
+        total_lines = 0
+        pool = None
+        if workers > 1:
+            # files are independent, partial results are merged below in the order of files
+            pool = multiprocessing.Pool(workers)
+            loaded = pool.imap(_load_censys_file_args,
+                               [(dir_path + "/" + _file, version, compact, with_devices) for _file in new_files])
+        else:
+            # the next files are read in background threads while the current one is processed
+            loaded = (load_censys_file(file_path, version, compact, with_devices, scan_file=scan_file)
+                      for file_path, scan_file in prefetch_scans([dir_path + "/" + _file for _file in new_files]))
+        new_files = set(new_files)
+        try:
+            for _file in files[start:]:
+                with instrument.stage("load_file") as file_stage:
+                    if _file in new_files:
+                        print("processing file: ", _file)
+                        partial = next(loaded)
+                        if index is not None:
+                            index.store(dir_path + "/" + _file, partial)
+                    else:
+                        print("cached file: ", _file)
+                        partial = index.lookup(dir_path + "/" + _file)
+                    ips, ips_with_banner, ips_no_banner, ips_banners, total_others, merged_devices = \
+                        merge_censys_file((ips, ips_with_banner, ips_no_banner, ips_banners, total_others,
+                                           merged_devices), partial)
+                    lines = partial[5]
+                    print("Number of lines in the file: ", lines)
+                    print("Added %d ips from this file" % (len(ips) - old_size))
+                    old_size = len(ips)
+                    file_stage.rows = lines
+                    total_lines += lines
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        if index is not None:
+            if start < len(files):
+                index.save_state(signatures,
+                                 (ips, ips_with_banner, ips_no_banner, ips_banners, total_others, merged_devices))
+            index.close()
+        if device_index is not None:
+            device_index.merge(merged_devices)
+        load_stage.rows = total_lines
 
     return ips, ips_with_banner, ips_no_banner, ips_banners, total_others
 
 
-def export_counters(outfile_base_name, _counter, counter_name):
+def merge_censys_file(merged, partial):
+    """
+    Adds the result of load_censys_file to the results of the previous files.
+
+    :param merged: ips, ips_with_banner, ips_no_banner, ips_banners, total_others, devices.DeviceIndex or None;
+        the sets (not ipset.IPSet) and the banner map are updated in place
+    :param partial: result of load_censys_file
+    :return: merged with the file added
+    """
+    ips, ips_with_banner, ips_no_banner, ips_banners, total_others, merged_devices = merged
+    file_ips, file_with_banner, file_no_banner, file_banners, file_others, lines, file_devices = partial
+    if isinstance(ips, ipset.IPSet):
+        ips = ips.union(file_ips)
+        ips_with_banner = ips_with_banner.union(file_with_banner)
+        ips_no_banner = ips_no_banner.union(file_no_banner)
+    else:
+        ips.update(file_ips)
+        ips_with_banner.update(file_with_banner)
+        ips_no_banner.update(file_no_banner)
+    ips_banners.update(file_banners)  # banners from later files win, as when read one by one
+    total_others += file_others
+    if merged_devices is not None:
+        merged_devices.merge(file_devices)
+    return ips, ips_with_banner, ips_no_banner, ips_banners, total_others, merged_devices
+
+
+def load_censys_file(file_path, version=2, compact=False, with_devices=False, scan_file=None):
+    """
+    Loads a single censys file, see load_censys_ips.
+
+    :param file_path: path to a censys file
+    :param version: new data files
+    :param compact: if True the sets of ips are returned as ipset.IPSet
+    :param with_devices: if True also build a devices.DeviceIndex of the file
+    :param scan_file: optional file object of file_path, see iter_scan
+    :return: ips, ips_with_banner, ips_no_banner, ips_banners, total_others, number of lines,
+        devices.DeviceIndex or None
+    """
+    device_index = devices.DeviceIndex() if with_devices else None
+    if compact:
+        ips = ipset.IPSetBuilder()
+        ips_with_banner = ipset.IPSetBuilder()
+        ips_no_banner = ipset.IPSetBuilder()
+    else:
+        ips = set()
+        ips_with_banner = set()
+        ips_no_banner = set()
+    ips_banners = banners.BannerStore(compact=compact)  # ip --> banner, each banner text kept once
+    total_others = 0
+    lines = 0
+    for d in iter_scan(file_path, scan_file=scan_file):
+        lines += 1
+        if device_index is not None:
+            device_index.add(d)
+        if version == 2:
+            temp_ports = [int(p) for p in d['ports']]
+            if 23 not in temp_ports and 2323 not in temp_ports:
+                total_others += 1  # we dont store them in set, this count may contain duplicates
+                continue  # not using port 23 or 2323 -> skip it
+        if not isinstance(d['ip'], str):
+            raise ValueError('Not a string: %s' % d['ip'])
+        if " " in d['ip']:
+            raise ValueError("IP contains Whitespace %s" %d['ip'])
+        # passed the checks, add to the set
+        ips.add(d['ip'])
+
+        try:
+            if len(d['banner']) > 0:
+                ips_banners[d['ip']] = d['banner']
+                ips_with_banner.add(d['ip'])
+            else:
+                ips_no_banner.add(d['ip'])
+        except KeyError as ke:
+            continue
+
+    if compact:
+        return ips.build(), ips_with_banner.build(), ips_no_banner.build(), ips_banners, total_others, lines, \
+            device_index
+    return ips, ips_with_banner, ips_no_banner, ips_banners, total_others, lines, device_index
+
+
+def load_censys_sketch(dir_path, capacity=config.APPROX_CAPACITY, error_rate=config.APPROX_ERROR,
+                       precision=config.APPROX_PRECISION, workers=config.CENSYS_WORKERS):
+    """
+    Approximate counterpart of load_censys_ips with fixed memory, see sketches.CensysSketch.
+    Sketches of the files are merged, so files can be read by a pool of processes.
+
+    :param dir_path:
+    :param capacity: expected number of distinct censys ips
+    :param error_rate: false positive rate of the membership test at capacity
+    :param precision: precision of the HyperLogLog counts
+    :param workers: number of processes reading the files, 1 reads them in this process
+    :return: sketches.CensysSketch
+    """
+    files = [dir_path + "/" + _file for _file in censys_files(dir_path)]
+    merged = sketches.CensysSketch(capacity, error_rate, precision)
+    with instrument.stage("load_censys_sketch") as load_stage:
+        if workers > 1:
+            pool = multiprocessing.Pool(workers)
+            try:
+                for partial in pool.imap(_load_censys_file_sketch_args,
+                                         [(file_path, capacity, error_rate, precision) for file_path in files]):
+                    merged.merge(partial)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for file_path, scan_file in prefetch_scans(files):
+                print("processing file: ", file_path)
+                load_censys_file_sketch(file_path, capacity, error_rate, precision, scan_file=scan_file,
+                                        sketch=merged)
+        load_stage.rows = merged.lines
+    return merged
+
+
+def load_censys_file_sketch(file_path, capacity, error_rate, precision, scan_file=None, sketch=None,
+                            chunk_size=1 << 16):
+    """
+    Sketch of a single censys file, see load_censys_sketch.
+
+    :param file_path: path to a censys file
+    :param capacity: expected number of distinct censys ips
+    :param error_rate: false positive rate of the membership test at capacity
+    :param precision: precision of the HyperLogLog counts
+    :param scan_file: optional file object of file_path, see iter_scan
+    :param sketch: optional sketches.CensysSketch to add the file to, a new one by default
+    :param chunk_size: number of ips hashed at once
+    :return: sketches.CensysSketch
+    """
+    if sketch is None:
+        sketch = sketches.CensysSketch(capacity, error_rate, precision)
+    ips, with_banner, no_banner = [], [], []
+    for d in iter_scan(file_path, scan_file=scan_file):
+        sketch.lines += 1
+        temp_ports = [int(p) for p in d['ports']]
+        if 23 not in temp_ports and 2323 not in temp_ports:
+            sketch.total_others += 1
+            continue
+        ips.append(d['ip'])
+        if 'banner' in d:
+            if len(d['banner']) > 0:
+                with_banner.append(d['ip'])
+            else:
+                no_banner.append(d['ip'])
+        if len(ips) >= chunk_size:
+            _add_sketch_chunk(sketch, ips, with_banner, no_banner)
+            ips, with_banner, no_banner = [], [], []
+    _add_sketch_chunk(sketch, ips, with_banner, no_banner)
+    return sketch
+
+
+def _add_sketch_chunk(sketch, ips, with_banner, no_banner):
+    hashes = sketches.hash_ips(ips)
+    sketch.ips.add_hashes(hashes)
+    sketch.ips_count.add_hashes(hashes)
+    sketch.with_banner.add_hashes(sketches.hash_ips(with_banner))
+    sketch.no_banner.add_hashes(sketches.hash_ips(no_banner))
+
+
+def _load_censys_file_sketch_args(args):
+    return load_censys_file_sketch(*args)
+
+
+def _load_censys_file_args(args):
+    return load_censys_file(*args)
+
+
+def export_counters(outfile_base_name, _counter, counter_name, top_k=config.EXPORT_TOP_K):
     """
 
     :param outfile_base_name:
     :param _counter:
     :param counter_name:
+    :param top_k: optional number of the most common keys exported, all keys if None
     :return:
     """
-    outfile = open(outfile_base_name + "_" + counter_name + ".csv", "w")
-    out_writer = csv.writer(outfile, dialect='excel')
-    for key, value in _counter.most_common():
-        out_writer.writerow([key, value])
+    with exports.Writer(outfile_base_name + "_" + counter_name + ".csv", ["key", "count"]) as writer:
+        # most_common(n) keeps the n largest in a heap instead of sorting all keys
+        writer.write_rows(_counter.most_common(top_k))
     print("Exported counters: %s" % counter_name)
 
 
-def export_banners(outfile_base_name, banners_map, counter_name, version=2):
+def export_banners(outfile_base_name, banners_map, counter_name, version=2, banner_store=None,
+                   top_k=config.EXPORT_TOP_K):
     """
 
     :param outfile_base_name:
-    :param banners_map:
+    :param banners_map: banner --> list of ips, or banner id --> list of ips if banner_store is given,
+        or (banner, list of ips) already sorted (see external.py)
     :param counter_name:
     :param version: old (1) or new (2) censys data
+    :param banner_store: optional banners.BannerStore used to decode banner ids
+    :param top_k: optional number of the largest groups exported, all groups if None
     :return:
     """
-    outfile = open(outfile_base_name + "_" + counter_name + ".csv", "w")
-    out_writer = csv.writer(outfile, dialect='excel')
-
     # iterate over sorted map
-    for key, value in sorted(banners_map.items(), key=lambda e: -(len(e[1]))):
-        if version == 1:
-            out_writer.writerow([base64.b64decode(key)] + [len(value)] + value)
-        else:
-            out_writer.writerow([key] + [len(value)] + value)
+    if isinstance(banners_map, dict):
+        banners_map = exports.largest(banners_map.items(), lambda e: len(e[1]), top_k)
+    else:
+        banners_map = exports.first(banners_map, top_k)
+
+    def rows():
+        for key, value in banners_map:
+            if banner_store is not None:
+                key = banner_store.text(key)  # decoded only here
+            if version == 1:
+                key = base64.b64decode(key)
+            yield key, len(value), value
+
+    with exports.Writer(outfile_base_name + "_" + counter_name + ".csv", ["banner", "count", "ips"],
+                        list_field=True) as writer:
+        writer.write_rows(rows())
     print("Exported [banners --> IP_list] map.")
 
 
-def export_general(outfile_base_name, mappigns, mapping_name):
+def export_general(outfile_base_name, mappigns, mapping_name, top_k=config.EXPORT_TOP_K):
     """
 
     :param outfile_base_name:
     :param mappigns:
     :param dict_name:
+    :param top_k: optional number of the largest mappings exported, all mappings if None
     :return:
     """
-    outfile = open(outfile_base_name + "_" + mapping_name + ".csv", "w")
-    out_writer = csv.writer(outfile, dialect='excel')
-
-    # iterate over sorted map
-    for key, value in sorted(mappigns.items(), key=lambda e: -(len(e[1]))):
-        out_writer.writerow([key] + [len(value)] + value)
+    with exports.Writer(outfile_base_name + "_" + mapping_name + ".csv", ["key", "count", "values"],
+                        list_field=True) as writer:
+        # iterate over sorted map
+        writer.write_rows((key, len(value), value)
+                          for key, value in exports.largest(mappigns.items(), lambda e: len(e[1]), top_k))
 
-    print("Exported [%s] map." % mapping_name)
\ No newline at end of file
+    print("Exported [%s] map." % mapping_name)
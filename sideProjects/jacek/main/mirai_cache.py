@@ -0,0 +1,342 @@
+import csv
+import json
+import os
+import re
+import shutil
+import numpy as np
+import config as config
+import ipset as ipset
+
+# columns kept in the cache: name --> (index in the mirai csv, numpy dtype)
+COLUMNS = {
+    "ip": (config.IP, np.uint32),
+    "port": (config.DST_PORT, np.int32),
+    "fseen": (config.FSEEN, np.int64),
+    "lseen": (config.LSEEN, np.int64),
+    "asn": (config.ASN, np.int32),
+    "country": (config.COUNTRY, np.int32),
+    "prefix": (config.PREFIX, np.int32),
+}
+# text columns are stored as integer codes into a vocabulary
+TEXT_COLUMNS = ["asn", "country", "prefix"]
+# csv index --> cached column
+BY_INDEX = dict((index, name) for name, (index, dtype) in COLUMNS.items())
+
+PORT_MISSING = -1
+TIME_MISSING = np.iinfo(np.int64).min  # same value as numpy's NaT
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+# values accepted by parse_times, numpy alone also takes e.g. dates without a time or "NaT"
+_TIME_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}Z\Z")
+
+
+def cache_path(path_to_mirai):
+    """
+
+    :param path_to_mirai: absolute path to csv
+    :return: directory of the columnar cache of that csv
+    """
+    return path_to_mirai + ".cache"
+
+
+def is_fresh(path_to_mirai):
+    """
+
+    :param path_to_mirai: absolute path to csv
+    :return: True if the cache exists and was built after the last change of the csv
+    """
+    meta_path = cache_path(path_to_mirai) + "/meta.json"
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path) as meta_file:
+        meta = json.load(meta_file)
+    stat = os.stat(path_to_mirai)
+    return os.path.getmtime(meta_path) > stat.st_mtime and meta["source_size"] == stat.st_size
+
+
+def build_cache(path_to_mirai, chunk_size=1 << 20):
+    """
+    Converts the columns of the mirai csv used by the analysis into typed
+    binary files: ips as uint32, timestamps as int64 (seconds since epoch, UTC),
+    ports as int32, asn/country/prefix as int32 codes into a vocabulary.
+    Rows keep their order from the csv, the header is skipped.
+
+    :param path_to_mirai: absolute path to csv
+    :param chunk_size: number of rows converted at once
+    :return: void
+    """
+    target = cache_path(path_to_mirai)
+    tmp = target + ".tmp"
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    source_size = os.stat(path_to_mirai).st_size
+
+    vocabularies = dict((name, dict()) for name in TEXT_COLUMNS)
+    outfiles = dict((name, open(tmp + "/" + name + ".bin", "wb")) for name in COLUMNS)
+    rows = 0
+    mirai_file = open(path_to_mirai, "r")
+    mirai_reader = csv.reader(mirai_file, dialect='excel')
+    chunk = []
+    try:
+        for row in mirai_reader:
+            if " " in row[config.IP]:
+                raise ValueError("IP contains Whitespace %s" % row[config.IP])
+            if len(row[config.IP]) > 2:  # skips the header
+                chunk.append(row)
+            if len(chunk) == chunk_size:
+                rows += _write_chunk(chunk, outfiles, vocabularies)
+                chunk = []
+        rows += _write_chunk(chunk, outfiles, vocabularies)
+    except ValueError:  # a malformed row, no cache is written
+        shutil.rmtree(tmp)
+        raise
+    finally:
+        mirai_file.close()
+        for outfile in outfiles.values():
+            outfile.close()
+
+    meta = {
+        "rows": rows,
+        "source_size": source_size,
+        "columns": dict((name, np.dtype(dtype).str) for name, (index, dtype) in COLUMNS.items()),
+        "vocabularies": dict((name, list(vocabularies[name])) for name in TEXT_COLUMNS),
+    }
+    with open(tmp + "/meta.json", "w") as meta_file:
+        json.dump(meta, meta_file)
+    if os.path.exists(target):
+        shutil.rmtree(target)
+    os.rename(tmp, target)
+    print("Cached %d mirai rows in %s" % (rows, target))
+
+
+def _write_chunk(chunk, outfiles, vocabularies):
+    """
+
+    :param chunk: list of csv rows
+    :param outfiles: column name --> binary file
+    :param vocabularies: column name --> dict text --> code
+    :return: number of rows written
+    """
+    if len(chunk) == 0:
+        return 0
+    for name, array in parse_rows(chunk, vocabularies).items():
+        array.tofile(outfiles[name])
+    return len(chunk)
+
+
+def parse_rows(rows, vocabularies):
+    """
+    Converts csv rows into typed columns.
+
+    :param rows: list of csv rows
+    :param vocabularies: column name --> dict text --> code, extended with unseen values
+    :return: dict column name --> numpy array
+    :raises ValueError: for a port which is not an integer or a time not in format %Y-%m-%dT%H:%M:%SZ,
+        as the filters raise when reading the csv
+    """
+    columns = dict()
+    columns["ip"] = ipset.ips_to_array([row[config.IP] for row in rows]).astype(np.uint32)
+    columns["port"] = np.fromiter((int(row[config.DST_PORT]) for row in rows), dtype=np.int32, count=len(rows))
+    columns["fseen"] = parse_times([row[config.FSEEN] for row in rows], strict=True)
+    columns["lseen"] = parse_times([row[config.LSEEN] for row in rows], strict=True)
+    for name in TEXT_COLUMNS:
+        vocabulary = vocabularies[name]
+        index = COLUMNS[name][0]
+        columns[name] = np.fromiter((vocabulary.setdefault(row[index], len(vocabulary)) for row in rows),
+                                    dtype=np.int32, count=len(rows))
+    return columns
+
+
+def parse_times(values, strict=False):
+    """
+
+    :param values: list of strings in format %Y-%m-%dT%H:%M:%SZ
+    :param strict: if True raise a ValueError for a value which is not in that format
+    :return: int64 array of seconds since epoch (UTC), TIME_MISSING where the value is not in
+        that format or can't be parsed
+    """
+    valid = np.fromiter((_TIME_PATTERN.match(v) is not None for v in values), dtype=bool, count=len(values))
+    texts = [v[:-1] for v, ok in zip(values, valid.tolist()) if ok]
+    times = np.full(len(values), TIME_MISSING, dtype=np.int64)
+    try:
+        times[valid] = np.array(texts, dtype="datetime64[s]").astype(np.int64)
+    except ValueError:  # e.g. month 13
+        times[valid] = [_parse_time(text) for text in texts]
+    if strict and (times == TIME_MISSING).any():
+        raise ValueError("time data %r does not match format '%s'"
+                         % (values[int(np.argmax(times == TIME_MISSING))], TIME_FORMAT))
+    return times
+
+
+def _parse_time(text):
+    try:
+        return np.datetime64(text, "s").astype(np.int64)
+    except ValueError:
+        return TIME_MISSING
+
+
+def format_times(values):
+    """
+
+    :param values: int64 array of seconds since epoch
+    :return: list of strings in format %Y-%m-%dT%H:%M:%SZ, empty where missing
+    """
+    return ["" if text == "NaT" else text + "Z"
+            for text in np.datetime_as_string(np.asarray(values).astype("datetime64[s]"), unit="s").tolist()]
+
+
+class MiraiTable(object):
+    """
+    Memory-mapped columns of the mirai csv, see build_cache.
+    """
+
+    def __init__(self, path):
+        with open(path + "/meta.json") as meta_file:
+            meta = json.load(meta_file)
+        self.rows = meta["rows"]
+        self.columns = dict()
+        for name, dtype in meta["columns"].items():
+            if self.rows > 0:
+                self.columns[name] = np.memmap(path + "/" + name + ".bin", dtype=np.dtype(dtype), mode="r",
+                                               shape=(self.rows,))
+            else:
+                self.columns[name] = np.empty(0, dtype=np.dtype(dtype))
+        self.vocabularies = meta["vocabularies"]
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def decode(self, name, codes):
+        """
+
+        :param name: asn, country or prefix
+        :param codes: iterable of codes
+        :return: list of strings as they appear in the csv
+        """
+        vocabulary = self.vocabularies[name]
+        return [vocabulary[code] for code in np.asarray(codes).tolist()]
+
+    def candidate_rows(self, candidates=None):
+        """
+
+        :param candidates: set of ips (or ipset.IPSet), None for all rows
+        :return: positions of rows with an ip from candidates, in order
+        """
+        if candidates is None:
+            return np.arange(self.rows)
+        if not isinstance(candidates, ipset.IPSet):
+            candidates = ipset.IPSet(ip for ip in candidates if _is_ipv4(ip))
+        return np.nonzero(np.isin(self.columns["ip"], candidates.values))[0]
+
+    def iter_rows(self, positions):
+        """
+        Rebuilds csv-like rows (lists of strings indexed as in config.py) for aggregators
+        without a columnar implementation, see CachedRow.
+
+        :param positions: array of row positions
+        :return: generator of (position, CachedRow)
+        """
+        width = max(index for index, dtype in COLUMNS.values()) + 1
+        for start in range(0, len(positions), 1 << 16):
+            chunk = positions[start:start + (1 << 16)]
+            values = {
+                "ip": [ipset.int_to_ip(v) for v in self.columns["ip"][chunk].tolist()],
+                "port": [str(v) if v != PORT_MISSING else "" for v in self.columns["port"][chunk].tolist()],
+                "fseen": format_times(self.columns["fseen"][chunk]),
+                "lseen": format_times(self.columns["lseen"][chunk]),
+            }
+            for name in TEXT_COLUMNS:
+                values[name] = self.decode(name, self.columns[name][chunk])
+            for i, position in enumerate(chunk.tolist()):
+                row = CachedRow([""] * width)
+                for name, (index, dtype) in COLUMNS.items():
+                    row[index] = values[name][i]
+                yield position, row
+
+
+class CachedRow(list):
+    """
+    A row rebuilt from the cache. Reading a column which is not kept in the cache
+    raises a ValueError instead of returning an empty value, which would put every
+    row in the same group; such aggregators need loaders.scan_mirai(..., use_cache=False, workers=1).
+    """
+    __slots__ = ()
+
+    def __getitem__(self, index):
+        if isinstance(index, int) and index % len(self) not in BY_INDEX:
+            raise ValueError("Column %d of the mirai csv is not kept in the columnar cache, read the csv "
+                             "with use_cache=False and workers=1" % index)
+        return list.__getitem__(self, index)
+
+
+class ChunkTable(MiraiTable):
+    """
+    Consecutive rows of the mirai csv parsed in memory (see loaders.scan_mirai_parallel),
+    read by the aggregators like the cache. Row positions continue those of the
+    previous chunks, so the order of rows is kept across chunks.
+    """
+
+    def __init__(self, columns, vocabularies, offset):
+        """
+
+        :param columns: dict column name --> numpy array, see parse_rows
+        :param vocabularies: column name --> list of strings, for asn, country and prefix
+        :param offset: position of the first row of the chunk
+        """
+        self.rows = len(columns["ip"])
+        self.offset = offset
+        self.columns = dict((name, _OffsetColumn(values, offset)) for name, values in columns.items())
+        self.vocabularies = vocabularies
+
+    def candidate_rows(self, candidates=None):
+        """
+
+        :param candidates: ipset.IPSet, None for all rows
+        :return: positions of rows with an ip from candidates, in order
+        """
+        if candidates is None:
+            return np.arange(self.offset, self.offset + self.rows)
+        return np.nonzero(candidates.isin(self.columns["ip"].values))[0] + self.offset
+
+
+class _OffsetColumn(object):
+    """
+    Column of a ChunkTable indexed by row positions.
+    """
+
+    def __init__(self, values, offset):
+        self.values = values
+        self.offset = offset
+
+    def __getitem__(self, positions):
+        return self.values[positions - self.offset]
+
+    def __len__(self):
+        return len(self.values)
+
+
+def _is_ipv4(ip):
+    try:
+        ipset.ip_to_int(ip)
+        return True
+    except ValueError:
+        return False
+
+
+def load_cache(path_to_mirai):
+    """
+
+    :param path_to_mirai: absolute path to csv
+    :return: MiraiTable, or None if there is no up to date cache of the csv
+    """
+    if not is_fresh(path_to_mirai):
+        return None
+    return MiraiTable(cache_path(path_to_mirai))
+
+
+if __name__ == '__main__':
+    # one-time conversion, rerun after the mirai csv changes
+    build_cache(config.MIRAI_PATH)
@@ -0,0 +1,300 @@
+"""
+The analysis of process_data.py as named stages with checkpoints:
+
+    censys --> mirai (one per filter spec) --> intersect --> counts, banners, ports, group_by, durations, devices
+           \--> mirai_stats (counts, ports, groupings, durations of all rows of censys ips) --/
+    and then exports and plots, which only write files.
+
+The output of every stage is pickled into the checkpoint directory under a key made
+of the stage name, its parameters, the keys of its inputs and the size and
+modification time of the files it reads. A stage whose key already has a checkpoint
+is not run again, and its output is only loaded when a later stage needs it. So a
+run which crashed in a late stage continues from the last checkpoint, and changing
+only the output names or plot titles recomputes nothing:
+
+    python pipeline.py
+
+Checkpoints of old keys are never removed, the directory can be deleted at any time.
+"""
+import hashlib
+import json
+import os
+import pickle
+import aggregators as aggregators
+import banners as banners
+import config as config
+import devices as devices
+import instrument as instrument
+import loaders as loaders
+import plot_methods as my_plt
+import process_data as process_data
+
+# part of every key, increase it when a change of the code changes the output of a stage
+VERSION = 1
+
+_NOT_LOADED = object()
+
+
+class Artifact(object):
+    """
+    Output of a stage, saved in a checkpoint file and loaded on first use.
+    """
+
+    def __init__(self, name, key, path, params=None):
+        self.name = name
+        self.key = key
+        self.path = path
+        self.params = params
+        self._value = _NOT_LOADED
+
+    def exists(self):
+        return self._value is not _NOT_LOADED or os.path.exists(self.path)
+
+    @property
+    def value(self):
+        if self._value is _NOT_LOADED:
+            with instrument.stage("load_checkpoint"):
+                with open(self.path, "rb") as checkpoint:
+                    self._value = pickle.load(checkpoint)
+        return self._value
+
+
+class Pipeline(object):
+    """
+    Runs stages, skipping those with a checkpoint of the same key.
+    """
+
+    def __init__(self, dir_path=config.PIPELINE_DIR, force=()):
+        """
+
+        :param dir_path: directory of the checkpoints, created if missing
+        :param force: names of stages run even if they have a checkpoint
+        """
+        self.dir = dir_path
+        self.force = set(force)
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+
+    def artifact(self, name, params=None, inputs=(), sources=()):
+        """
+
+        :param name: name of the stage
+        :param params: dict of json serializable parameters changing the output
+        :param inputs: list of Artifact the stage reads
+        :param sources: list of paths of files (or directories of files) the stage reads
+        :return: Artifact, see Artifact.exists
+        """
+        description = json.dumps([VERSION, name, params or {}, [a.key for a in inputs],
+                                  [_fingerprint(path) for path in sources]], sort_keys=True)
+        key = hashlib.sha1(description.encode("utf-8")).hexdigest()
+        return Artifact(name, key, os.path.join(self.dir, "%s_%s.pickle" % (name, key)), params)
+
+    def is_done(self, artifact):
+        """
+
+        :param artifact: Artifact
+        :return: True if the stage does not have to run
+        """
+        return artifact.exists() and artifact.name not in self.force
+
+    def save(self, artifact, value):
+        """
+        Writes the checkpoint of a stage, renamed when complete so a crash never leaves a partial checkpoint.
+
+        :param artifact: Artifact
+        :param value: output of the stage
+        :return: void
+        """
+        with open(artifact.path + ".part", "wb") as checkpoint:
+            pickle.dump(value, checkpoint, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(artifact.path + ".part", artifact.path)
+        artifact._value = value
+
+    def stage(self, name, function, params=None, inputs=(), sources=()):
+        """
+        Runs function(*values of inputs, **params) unless the stage has a checkpoint.
+
+        :param name: name of the stage
+        :param function: module level function computing the output
+        :param params: see artifact
+        :param inputs: see artifact
+        :param sources: see artifact
+        :return: Artifact
+        """
+        artifact = self.artifact(name, params, inputs, sources)
+        if self.is_done(artifact):
+            print("Stage %s: reusing checkpoint %s" % (name, artifact.key[:12]))
+            return artifact
+        with instrument.stage(name):
+            value = function(*[a.value for a in inputs], **(params or {}))
+        self.save(artifact, value)
+        return artifact
+
+
+def _fingerprint(path):
+    """
+
+    :param path: file or directory
+    :return: list of (path, size, modification time) of the file or of the files of the directory
+    """
+    path = os.path.abspath(path)
+    if os.path.isdir(path):
+        return [_fingerprint(os.path.join(path, name))[0] for name in sorted(os.listdir(path))
+                if not name.startswith(".") and not name.endswith(".part")]
+    stat = os.stat(path)
+    return [(path, stat.st_size, stat.st_mtime_ns)]
+
+
+def filter_params(spec):
+    """
+
+    :param spec: process_data.ReportSpec
+    :return: parameters of the spec which change the set of mirai ips (not the output name)
+    """
+    return {"filter_port": spec.filter_port, "filter_date": spec.filter_date, "date_limit": spec.date_limit,
+            "seen": spec.seen}
+
+
+def run_reports(specs, dir_path_censys=config.JSON_DATA_DIR, path_to_mirai=config.MIRAI_PATH,
+                devices_spec=None, pipeline=None):
+    """
+    Same output as loaders.load_censys_ips, process_data.generate_reports and
+    process_data.load_data_and_count_devices, with a checkpoint after every stage.
+    Groupings are kept in memory (GROUP_MEMORY_BUDGET is not used), they are part of the checkpoints.
+
+    :param specs: list of process_data.ReportSpec
+    :param dir_path_censys: directory with censys files
+    :param path_to_mirai: absolute path to csv
+    :param devices_spec: optional process_data.ReportSpec whose infected ips are used to count devices
+    :param pipeline: Pipeline, one with the default checkpoint directory if None
+    :return: void
+    """
+    pipeline = pipeline if pipeline is not None else Pipeline()
+    censys = pipeline.stage("censys", _load_censys, params={"dir_path": dir_path_censys, "compact": config.COMPACT_IPS},
+                            sources=[dir_path_censys])
+
+    # mirai ips of every filter and the statistics of all rows in a single pass over mirai
+    filters = dict()  # key --> Artifact
+    for spec in specs + ([devices_spec] if devices_spec is not None else []):
+        artifact = pipeline.artifact("mirai", filter_params(spec), sources=[path_to_mirai])
+        filters.setdefault(artifact.key, artifact)
+    stats = pipeline.artifact("mirai_stats", inputs=[censys], sources=[path_to_mirai])
+    _scan_mirai(pipeline, path_to_mirai, [a for a in filters.values() if not pipeline.is_done(a)],
+                stats if not pipeline.is_done(stats) else None, censys)
+
+    plot_jobs = []
+    for spec in specs:
+        mirai = filters[pipeline.artifact("mirai", filter_params(spec), sources=[path_to_mirai]).key]
+        print("\n################## Processing " + spec.outfile_base_name + " ##################")
+        infected = pipeline.stage("intersect", _intersect, inputs=[mirai, censys])
+        counts = pipeline.stage("counts", _counts, inputs=[infected, stats])
+        banner_stats = pipeline.stage("banners", _banners, inputs=[infected, censys])
+        ports = pipeline.stage("ports", _ports, inputs=[infected, stats])
+        groups = pipeline.stage("group_by", _group_by, inputs=[infected, stats])
+        durations = pipeline.stage("durations", _durations, inputs=[infected, stats])
+
+        banners_count_not_empty, count_empty_banners, banners2ips = banner_stats.value
+        prefix_count, country_count, asn_count = counts.value
+        ips2asn, ips2country = groups.value
+        data = process_data.ReportData(infected.value, banners_count_not_empty, count_empty_banners, banners2ips,
+                                       prefix_count, country_count, asn_count, ports.value,
+                                       ips2asn, ips2country, durations.value)
+        plot_jobs += process_data.export_report(spec.outfile_base_name, data)
+
+    with instrument.stage("plots", rows=len(plot_jobs)):
+        my_plt.render(plot_jobs)
+
+    if devices_spec is not None:
+        mirai = filters[pipeline.artifact("mirai", filter_params(devices_spec), sources=[path_to_mirai]).key]
+        infected = pipeline.stage("intersect", _intersect, inputs=[mirai, censys])
+        print("found %d infected devices" % len(infected.value))
+        print("Getting device statistics... ")
+        device_stats = pipeline.stage("devices", _devices, params={"dir_path_censys": dir_path_censys},
+                                      inputs=[infected, censys])
+        process_data.write_devices(device_stats.value)
+
+
+def _scan_mirai(pipeline, path_to_mirai, filters, stats, censys):
+    """
+
+    :param pipeline: Pipeline
+    :param path_to_mirai: absolute path to csv
+    :param filters: list of Artifact of mirai ips to compute
+    :param stats: Artifact of the mirai statistics to compute, or None
+    :param censys: Artifact of the censys stage
+    :return: void
+    """
+    if not filters and stats is None:
+        print("Stage mirai: reusing checkpoints")
+        return
+    mirai_filters = [aggregators.MiraiIpFilter(compact=config.COMPACT_IPS, **artifact.params) for artifact in filters]
+    statistics = []
+    if stats is not None:
+        statistics = [aggregators.FirstRowCounts(), aggregators.PortCounts(),
+                      aggregators.GroupBy(by=config.ASN, memory_budget=None),
+                      aggregators.GroupBy(by=config.COUNTRY, memory_budget=None), aggregators.FirstSeenDuration()]
+    with instrument.stage("scan_mirai") as scan_stage:
+        scan_stage.rows = loaders.scan_mirai(path_to_mirai, mirai_filters + statistics,
+                                             candidates=censys.value[0] if stats is not None else None)
+    for artifact, mirai_filter in zip(filters, mirai_filters):
+        pipeline.save(artifact, mirai_filter.result())
+    if stats is not None:
+        pipeline.save(stats, dict(zip(["counts", "ports", "ips2asn", "ips2country", "durations"], statistics)))
+
+
+def _load_censys(dir_path, compact):
+    device_index = devices.DeviceIndex()
+    censys_ips, censys_with_banners, censys_empty_banners, _banners_map, not23count = \
+        loaders.load_censys_ips(dir_path, compact=compact, device_index=device_index)
+    print("Censys IPs (port 23 or 2323): ", len(censys_ips))
+    print("Censys IPs (other ports): ", not23count)
+    print("Censys with banners: ", len(censys_with_banners))
+    print("Censys without banners: ", len(censys_empty_banners))
+    return censys_ips, censys_with_banners, censys_empty_banners, _banners_map, not23count, device_index
+
+
+def _intersect(mirai_ips, censys):
+    print("Loaded %d IPs from MIRAI." % len(mirai_ips))
+    return process_data.match_mirai_censys(mirai_ips, censys[0])
+
+
+def _counts(infected, stats):
+    return stats["counts"].result(infected)
+
+
+def _banners(infected, censys):
+    banners_count_not_empty, count_empty_banners = process_data.infected_banners_stats(infected, censys[2])
+    banner_map = censys[3]
+    banners2ips = process_data.group_by_banners(infected, banner_map, memory_budget=None)
+    # sorted and decoded as by loaders.export_banners, the checkpoint does not need the banner map
+    banners2ips = sorted(banners2ips.items(), key=lambda e: -(len(e[1])))
+    if isinstance(banner_map, banners.BannerStore):
+        banners2ips = [(banner_map.text(key), value) for key, value in banners2ips]
+    return banners_count_not_empty, count_empty_banners, banners2ips
+
+
+def _ports(infected, stats):
+    return stats["ports"].result(infected)
+
+
+def _group_by(infected, stats):
+    # sorted as by process_data.export_group_by
+    return tuple(sorted(stats[name].result(infected).items(), key=lambda e: -(len(e[1])))
+                 for name in ("ips2asn", "ips2country"))
+
+
+def _durations(infected, stats):
+    return stats["durations"].durations(infected)
+
+
+def _devices(infected, censys, dir_path_censys):
+    return process_data.device_stats(dir_path_censys, infected, device_index=censys[5])
+
+
+if __name__ == '__main__':
+    # same reports as the main block of process_data.py
+    reports = [
+        process_data.ReportSpec(filter_port=True, filter_date=True, date_limit="2018-12-04T00:00:00Z", seen="fseen",
+                                outfile_base_name="../new_results/port23_past04_only/port23_past04"),
+    ]
+    run_reports(reports, devices_spec=reports[0])
@@ -1,7 +1,18 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import pickle
+from collections import namedtuple
+import numpy as np
 import config as config
 import pandas as pd
+import matplotlib
 import matplotlib.pyplot as plt
 
+# a plot to render, see render: name of a function of this module, its arguments and the files it writes
+PlotJob = namedtuple("PlotJob", ["function", "args", "outputs"])
+
 
 def plot_bar(_values_list, key, value, title,path):
     """
@@ -26,16 +37,44 @@ def plot_bar(_values_list, key, value, title,path):
         print("Empty list in plot_bar.")
 
 
-def plot_duration(_infected_ips, path, _title="Hours of Activity"):
+def plot_duration(_infected_ips, path, _title="Hours of Activity", first_seen=None, durations=None):
+    """
 
-    mirai_data = pd.read_csv(config.MIRAI_PATH)
+    :param _infected_ips: set of infected ips
+    :param path: base path of the output files
+    :param _title:
+    :param first_seen: optional list of (ip, fseen, lseen) from the first row of every ip,
+        e.g. collected by aggregators.FirstSeenDuration; the mirai csv is read when missing
+    :param durations: optional array (timedelta64) of lseen - fseen of the infected ips,
+        see aggregators.FirstSeenDuration.durations; used instead of first_seen
+    :return:
+    """
+    if durations is not None:
+        time_diff = pd.Series(np.asarray(durations).astype("timedelta64[ns]"), name="duration")
+        plot_durations(time_diff, path, _title)
+        return
+    if first_seen is None:
+        mirai_data = pd.read_csv(config.MIRAI_PATH)
+        mirai_data = mirai_data.drop_duplicates(subset=['ip'])
+    else:
+        mirai_data = pd.DataFrame(first_seen, columns=["ip", "fseen", "lseen"])
     infected_ips = pd.DataFrame(list(_infected_ips))
     infected_ips.columns = ["infected"]
-    mirai_data = mirai_data.drop_duplicates(subset=['ip'])
     mirai_data["fseen"] = pd.to_datetime(mirai_data["fseen"], infer_datetime_format=False)
     mirai_data["lseen"] = pd.to_datetime(mirai_data["lseen"], infer_datetime_format=False)
     mirai_data = mirai_data[mirai_data["ip"].isin(infected_ips["infected"])]  # only infected left
     time_diff = pd.Series(mirai_data['lseen'] - mirai_data['fseen'], name="duration")
+    plot_durations(time_diff, path, _title)
+
+
+def plot_durations(time_diff, path, _title="Hours of Activity"):
+    """
+
+    :param time_diff: pandas Series of durations (lseen - fseen) named "duration"
+    :param path: base path of the output files
+    :param _title:
+    :return:
+    """
     time_diff = time_diff.to_frame()
     time_diff.describe().to_csv(path + "_with_zeros.csv")
     time_diff = time_diff[time_diff["duration"] != pd.Timedelta('0 days 00:00:00')]
@@ -52,3 +91,86 @@ def plot_duration(_infected_ips, path, _title="Hours of Activity"):
     plt.close()
 
 
+def bar_job(_values_list, key, value, title, path):
+    """
+
+    :return: PlotJob of plot_bar, see plot_bar for the parameters
+    """
+    return PlotJob("plot_bar", (_values_list, key, value, title, path), [path] if _values_list else [])
+
+
+def duration_job(durations, path, _title="Hours of Activity"):
+    """
+
+    :param durations: array (timedelta64) of lseen - fseen of the infected ips
+    :param path: base path of the output files
+    :param _title:
+    :return: PlotJob of plot_duration
+    """
+    return PlotJob("plot_duration", ((), path, _title, None, durations),
+                   [path + "_with_zeros.csv", path + "_no_zeros.csv", path + ".png"])
+
+
+def render(jobs, workers=config.PLOT_WORKERS, digests_path=config.PLOT_DIGESTS_PATH):
+    """
+    Renders plots in a pool of processes. A plot is skipped when its files exist and
+    were rendered from the same data; the sha1 of the arguments of every plot is kept
+    in a single json file (digests_path), so the report directories only hold the reports.
+
+    :param jobs: list of PlotJob
+    :param workers: number of processes, 1 renders in this process
+    :param digests_path: json file path of the first file --> sha1, None renders every plot
+    :return: number of rendered plots
+    """
+    digests = _load_digests(digests_path)
+    todo = []
+    for job in jobs:
+        digest = hashlib.sha1(pickle.dumps((job.function, job.args), protocol=pickle.HIGHEST_PROTOCOL)).hexdigest()
+        if job.outputs and _rendered(job.outputs, digest, digests):
+            continue
+        todo.append((job, digest))
+    if workers > 1 and len(todo) > 1:
+        pool = multiprocessing.Pool(min(workers, len(todo)), initializer=_init_render_worker)
+        try:
+            pool.map(_render_job, [job for job, digest in todo])
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for job, digest in todo:
+            _render_job(job)
+    if digests_path is not None and any(job.outputs for job, digest in todo):
+        digests = _load_digests(digests_path)  # with the plots of other runs rendered meanwhile
+        for job, digest in todo:
+            if job.outputs:
+                digests[os.path.abspath(job.outputs[0])] = digest
+        directory = os.path.dirname(os.path.abspath(digests_path))
+        os.makedirs(directory, exist_ok=True)
+        with open(digests_path + ".part", "w") as digests_file:
+            json.dump(digests, digests_file, indent=0, sort_keys=True)
+        os.replace(digests_path + ".part", digests_path)
+    return len(todo)
+
+
+def _load_digests(digests_path):
+    if digests_path is None:
+        return dict()
+    try:
+        with open(digests_path) as digests_file:
+            return json.load(digests_file)
+    except (OSError, ValueError):
+        return dict()
+
+
+def _rendered(outputs, digest, digests):
+    if not all(os.path.exists(output) for output in outputs):
+        return False
+    return digests.get(os.path.abspath(outputs[0])) == digest
+
+
+def _init_render_worker():
+    matplotlib.use("Agg")  # the workers only save plots to files
+
+
+def _render_job(job):
+    globals()[job.function](*job.args)
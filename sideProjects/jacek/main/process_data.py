@@ -1,12 +1,25 @@
-import csv
 import json
-import os
-from collections import Counter
+from collections import namedtuple
 import pandas as pd
 import loaders as loaders
+import aggregators as aggregators
+import banners as banners
+import devices as devices
+import exports as exports
+import external as external
+import instrument as instrument
+import ipset as ipset
+import join as join
 import config as config
 import plot_methods as my_plt
 
+# filters and output of a single report, see generate_reports
+ReportSpec = namedtuple("ReportSpec", ["filter_port", "filter_date", "date_limit", "seen", "outfile_base_name"])
+# statistics of a single report, see export_report
+ReportData = namedtuple("ReportData", ["infected", "banners_count_not_empty", "count_empty_banners", "banners2ips",
+                                       "prefix_count", "country_count", "asn_count", "port_counts",
+                                       "ips2asn", "ips2country", "durations"])
+
 
 def get_counts(infected_ips, path_to_mirai, filter_by_port=False):
     """
@@ -16,26 +29,13 @@ def get_counts(infected_ips, path_to_mirai, filter_by_port=False):
     :param filter_by_port: if true only rows with port 23 and 2323 are counted
     :return: prefix_count, country_count, asn_count of type dict
     """
-    prefix_count = Counter()
-    country_count = Counter()
-    asn_count = Counter()
-
-    mirai_file = open(path_to_mirai, "r")
-    mirai_reader = csv.reader(mirai_file, dialect='excel')
-
-    for row in mirai_reader:
-        if filter_by_port and int(row[config.DST_PORT]) != 23 and int(row[config.DST_PORT]) != 2323:
-            continue  # skip this row, we don't care about this port
-        if len(row[0]) > 2:
-            if row[0] in infected_ips:
-                prefix_count[row[config.PREFIX]] += 1
-                country_count[row[config.COUNTRY]] += 1
-                asn_count[row[config.ASN]] += 1
-                # remove from the set to not count twice
-                infected_ips.remove(row[0])
+    counts = aggregators.FirstRowCounts(filter_by_port=filter_by_port)
+    with instrument.stage("counts") as counts_stage:
+        counts_stage.rows = loaders.scan_mirai(path_to_mirai, [counts], candidates=infected_ips)
+        result = counts.result(infected_ips)
     print("Counting prefixes, countries and asn numbers done. ")
 
-    return prefix_count, country_count, asn_count
+    return result
 
 
 def group_by(path_to_mirai, outfile, _censys_ips, by=config.ASN):
@@ -47,29 +47,47 @@ def group_by(path_to_mirai, outfile, _censys_ips, by=config.ASN):
     :param by: group by ASN or Country of origin
     :return: void (exports to a csv)
     """
-    mappings = dict()
+    grouped = aggregators.GroupBy(by=by)
+    with instrument.stage("group_by") as group_stage:
+        group_stage.rows = loaders.scan_mirai(path_to_mirai, [grouped], candidates=_censys_ips)
+        export_group_by(outfile, grouped.result(_censys_ips))
 
-    mirai_file = open(path_to_mirai, "r")
-    mirai_reader = csv.reader(mirai_file, dialect='excel')
 
-    for row in mirai_reader:
-        # Checks
-        if not isinstance(row[config.IP], str):
-            raise ValueError('Not a string: %s' % row[0])
-        if " " in row[0]:
-            raise ValueError("IP contains Whitespace %s" % row[0])
+def export_group_by(outfile, mappings, top_k=config.EXPORT_TOP_K):
+    """
+    Exports ip --> values mappings sorted by the number of values
+    :param outfile: path to output file
+    :param mappings: dict ip --> set of values, or (ip, values) already sorted (see external.py)
+    :param top_k: optional number of the ips with most values exported, all ips if None
+    :return: void
+    """
+    if isinstance(mappings, dict):
+        mappings = exports.largest(mappings.items(), lambda e: len(e[1]), top_k)
+    else:
+        mappings = exports.first(mappings, top_k)
+    with exports.Writer(outfile, ["ip", "values"], list_field=True) as writer:
+        writer.write_rows(mappings)
+
 
-        if row[config.IP] in _censys_ips:
-            if row[config.IP] in mappings:
-                mappings[row[config.IP]].add(row[by])
-            else:
-                mappings[row[config.IP]] = set()
-                mappings[row[config.IP]].add(row[by])
+def export_infected(outfile_base_name, data):
+    """
+    Exports the infected ips, in csv after the totals; in other formats the totals
+    are written to <outfile_base_name>_infected_totals.
 
-    outfile = open(outfile, "w")
-    out_writer = csv.writer(outfile, dialect='excel')
-    for key, value in sorted(mappings.items(), key=lambda e: -(len(e[1]))):
-        out_writer.writerow([key] + list(value))
+    :param outfile_base_name: base name of output file used for exports
+    :param data: ReportData
+    :return: void
+    """
+    totals = [["Infected total", len(data.infected)],
+              ["Infected with banners", data.banners_count_not_empty],
+              ["Infected without banners", data.count_empty_banners]]
+    with exports.Writer(outfile_base_name + "_infected.csv", ["ip"]) as writer:
+        if writer.fmt == "csv":
+            writer.write_rows(totals)
+        else:
+            with exports.Writer(outfile_base_name + "_infected_totals.csv", ["name", "value"]) as totals_writer:
+                totals_writer.write_rows(totals)
+        writer.write_rows([inf] for inf in data.infected)
 
 
 def count_ports(infected_ips, path_to_mirai):
@@ -82,35 +100,38 @@ def count_ports(infected_ips, path_to_mirai):
     :param path_to_mirai:
     :return: dict()
     """
-    port_count = Counter()
-    mirai_file = open(path_to_mirai, "r")
-    mirai_reader = csv.reader(mirai_file, dialect='excel')
-
-    for row in mirai_reader:
-        if len(row[config.IP]) > 2:
-            if row[config.IP] in infected_ips:
-                if row[config.DST_PORT] in port_count.keys():
-                    port_count[row[config.DST_PORT]] += 1
-                else:
-                    port_count[row[config.DST_PORT]] = 1
-                # remove from the set to not count twice
+    ports = aggregators.PortCounts()
+    with instrument.stage("ports") as ports_stage:
+        ports_stage.rows = loaders.scan_mirai(path_to_mirai, [ports], candidates=infected_ips)
+        result = ports.result(infected_ips)
     print("Counting done. ")
-    return port_count
+    return result
 
 
-def group_by_banners(infected_ips, banner_map):
+def group_by_banners(infected_ips, banner_map, memory_budget=config.GROUP_MEMORY_BUDGET):
     """
 
     :param infected_ips:
-    :param banner_map
-    :return: a dictionary in form of dict[banner] = [list of ips with that banner]
+    :param banner_map: dict ip --> banner, or banners.BannerStore
+    :param memory_budget: approximate number of bytes kept in memory, None keeps all groups in memory
+    :return: a dictionary in form of dict[banner] = [list of ips with that banner],
+        banners are replaced by their ids if banner_map is a banners.BannerStore;
+        with a memory budget a generator of (banner, list of ips) already sorted for loaders.export_banners
     """
+    if isinstance(banner_map, banners.BannerStore):
+        return banner_map.group_ids(infected_ips, memory_budget=memory_budget)
+
     result = dict()
+    if memory_budget is not None:
+        result = external.PartitionedGroups(memory_budget, distinct=False, dir_path=config.SPILL_DIR)
     i = 0
+    members = ipset.isin(list(banner_map.keys()), infected_ips)
     try:
-        for key, value in banner_map.items():
-            if key in infected_ips:
-                if value in result:
+        for (key, value), infected in zip(banner_map.items(), members):
+            if infected:
+                if memory_budget is not None:
+                    result.add(i, value, key)
+                elif value in result:
                     result[value].append(key)
                 else:
                     result[value] = [key]
@@ -119,16 +140,20 @@ def group_by_banners(infected_ips, banner_map):
         print(i, "\t", ve)
         i += 1
 
+    if memory_budget is not None:
+        return result.sorted_groups()
     return result
 
 
 def match_mirai_censys(_mirai_ips, _censys_ips):
     """
 
-    :param _mirai_ips: set
-    :param _censys_ips: set
+    :param _mirai_ips: set or ipset.IPSet
+    :param _censys_ips: set or ipset.IPSet
     :return: intersection of two sets => infected ips
     """
+    if isinstance(_mirai_ips, ipset.IPSet) and not isinstance(_censys_ips, ipset.IPSet):
+        return _mirai_ips.intersection(_censys_ips)  # vectorized intersection of sorted arrays
 
     return _censys_ips.intersection(_mirai_ips)
 
@@ -136,8 +161,8 @@ def match_mirai_censys(_mirai_ips, _censys_ips):
 def infected_banners_stats(infected, empty_banners):
     """
     Performs set intersection operation to find common elements
-    :param infected: set of unique infected ips
-    :param empty_banners: set of ips with empty banners from censys
+    :param infected: set (or ipset.IPSet) of unique infected ips
+    :param empty_banners: set (or ipset.IPSet) of ips with empty banners from censys
     :return: number of infected devices with banners and without banners
     """
     count_infected = len(infected)
@@ -147,62 +172,59 @@ def infected_banners_stats(infected, empty_banners):
     return count_not_empty, count_empty_banners
 
 
-def count_devices(dir_path_censys, infected_ips):
-    ASN_TOP10 = [12389, 4837, 4134, 8452, 3462, 4766, 18403, 8376, 24444, 9121]
-    # to find devices for given most common asns
-    asn_device_map = dict()
-    for a in ASN_TOP10:
-        asn_device_map[a] = Counter()
-    # get censys files
-    files = os.listdir(dir_path_censys)  # list all files from the directory
-    # some sets and counters
-    devices_counter = Counter()  # count devices
-    found = set()  # helper to keep devices unique
-    multi_device_ips = set()  # get ips with multiple devices
-    multi_device_asn = set()  # get asns with multiple devices
-    multi_country_counter = Counter()  # count countries with multiple devices
-    no_description = 0
-    for _file in files:
-        data = loaders.load_scan(dir_path_censys + "/" + _file)
-        for d in data:
-            d = json.loads(d)
-            if d['ip'] in infected_ips:  # check if this ip was infected
-                try:
-                    if ',' in d['description']:
-                        devices = d['description'].split(',')
-                        if devices[0] == devices[1]:  # repetitions mikrotik, mikrotik ...
-                            if d['ip'] + devices[0] not in found:  # don't count repetitions
-                                devices_counter[devices[0]] += 1
-                                found.add(d['ip'] + devices[0])
-                                if int(d['asn']) in ASN_TOP10:
-                                    asn_device_map[int(d['asn'])][devices[0]] += 1
-                        else:
-                            for dev in devices:
-                                if d['ip'] + dev not in found:  # don't count repetitions
-                                    devices_counter[dev] += 1
-                                    found.add(d['ip'] + dev)
-                                    if int(d['asn']) in ASN_TOP10:
-                                        asn_device_map[int(d['asn'])][dev] += 1
-                                    multi_device_ips.add(d['ip'])
-                                    multi_device_asn.add(d['asn'])
-                                    multi_country_counter[d['country_code']] += 1
-                    elif ' ' in d['description']:
-                        split_ = d['description'].split(' ')
-                        if len(split_) == 2:
-                            if d['ip'] + d['description'] not in found:  # don't count repetitions
-                                devices_counter[d['description']] += 1
-                                found.add(d['ip'] + d['description'])
-                                if int(d['asn']) in ASN_TOP10:
-                                    asn_device_map[int(d['asn'])][d['description']] += 1
-                        else:  # length longer than 3, expect repetition
-                            if d['ip'] + split_[0] not in found:  # don't count repetitions
-                                devices_counter[split_[0]] += 1
-                                found.add(d['ip'] + split_[0])
-                                if int(d['asn']) in ASN_TOP10:
-                                    asn_device_map[int(d['asn'])][split_[0]] += 1
-                except KeyError as ke:  # that entry does not have description field
-                    no_description += 1
-                    continue
+def count_devices(dir_path_censys, infected_ips, device_index=None):
+    """
+    Counts devices of infected ips using the description field of censys records.
+
+    :param dir_path_censys: directory with censys files, read when device_index is None
+    :param infected_ips: set of infected ips
+    :param device_index: optional devices.DeviceIndex filled by loaders.load_censys_ips
+    :return: void
+    """
+    write_devices(device_stats(dir_path_censys, infected_ips, device_index=device_index))
+
+
+def device_stats(dir_path_censys, infected_ips, device_index=None):
+    """
+
+    :param dir_path_censys: directory with censys files, read when device_index is None
+    :param infected_ips: set of infected ips
+    :param device_index: optional devices.DeviceIndex filled by loaders.load_censys_ips
+    :return: devices.DeviceStats of the infected ips
+    """
+    stats = devices.DeviceStats()
+    with instrument.stage("count_devices") as devices_stage:
+        records = 0
+        if device_index is not None:
+            for d in device_index.iter_records(infected_ips):
+                stats.add(d)
+                records += 1
+            stats.no_description += device_index.count_no_description(infected_ips)
+        else:
+            # get censys files
+            files = loaders.censys_files(dir_path_censys)
+            for file_path, scan_file in loaders.prefetch_scans([dir_path_censys + "/" + _file for _file in files]):
+                for d in loaders.iter_scan(file_path, scan_file=scan_file):
+                    records += 1
+                    if d['ip'] in infected_ips:  # check if this ip was infected
+                        stats.add(d)
+        devices_stage.rows = records
+    return stats
+
+
+def write_devices(stats):
+    """
+    Prints, exports and plots the devices counted by device_stats.
+
+    :param stats: devices.DeviceStats
+    :return: void
+    """
+    devices_counter = stats.devices_counter
+    multi_device_ips = stats.multi_device_ips
+    multi_device_asn = stats.multi_device_asn
+    multi_country_counter = stats.multi_country_counter
+    asn_device_map = stats.asn_device_map
+    no_description = stats.no_description
     print("No description column: ", no_description)
     print("Number of IPs attacked on multiple devices: ", len(multi_device_ips))
     pd.DataFrame(list(multi_device_ips)).to_csv("multi_device_ips.csv")
@@ -215,18 +237,20 @@ def count_devices(dir_path_censys, infected_ips):
         if i < 10:  # add only 10 most common for plotting
             temp_list.append((key, value))
 
-    my_plt.plot_bar(temp_list, key="Device", value="Count",
-                    title="Top 10 most often attacked devices",
-                    path="devices.png")
+    plot_jobs = [my_plt.bar_job(temp_list, key="Device", value="Count",
+                                title="Top 10 most often attacked devices",
+                                path="devices.png")]
 
     temp_list = []
     for key, value in multi_country_counter.most_common(10):
         print(key, "\t", value)
         temp_list.append((key, value))
 
-    my_plt.plot_bar(temp_list, key="Country Code", value="Count",
-                    title="Countries where one IP was attacked on multiple devices",
-                    path="multi_country.png")
+    plot_jobs.append(my_plt.bar_job(temp_list, key="Country Code", value="Count",
+                                    title="Countries where one IP was attacked on multiple devices",
+                                    path="multi_country.png"))
+    with instrument.stage("plots", rows=len(plot_jobs)):
+        my_plt.render(plot_jobs)
 
     for key, value in asn_device_map.items():
         print("Most common devices with asn number %d" % key)
@@ -235,20 +259,22 @@ def count_devices(dir_path_censys, infected_ips):
 
 
 def load_data_and_count_devices(_censys_ips, dir_path_censys, path_to_mirai, _date_limit, _seen, _filter_port,
-                                _filter_date):
+                                _filter_date, device_index=None):
     mirai_ips = loaders.load_mirai_ips_filter_date_port(
         path_to_mirai,
         date_limit=_date_limit,
         seen=_seen,
         filter_port=_filter_port,
-        filter_date=_filter_date)
+        filter_date=_filter_date,
+        compact=isinstance(_censys_ips, ipset.IPSet))
     print("Loaded %d IPs from MIRAI." % len(mirai_ips))
 
     # intersection
-    infected = match_mirai_censys(mirai_ips, _censys_ips)
+    with instrument.stage("intersect"):
+        infected = match_mirai_censys(mirai_ips, _censys_ips)
     print("found %d infected devices" % len(infected))
     print("Getting device statistics... ")
-    count_devices(dir_path_censys, infected)
+    count_devices(dir_path_censys, infected, device_index=device_index)
 
 
 def generate_report(censys_ips, censys_with_banners, censys_empty_banners, _banners_map,
@@ -256,9 +282,9 @@ def generate_report(censys_ips, censys_with_banners, censys_empty_banners, _bann
                     _filter_port=False, _filter_date=False, outfile_base_name="output"):
     """
 
-    :param censys_ips: set of all censys ips
-    :param censys_with_banners: set of censys ips with banners
-    :param censys_empty_banners: set of censys ips without banners
+    :param censys_ips: set (or ipset.IPSet) of all censys ips
+    :param censys_with_banners: set (or ipset.IPSet) of censys ips with banners
+    :param censys_empty_banners: set (or ipset.IPSet) of censys ips without banners
     :param _banners_map: ip --> banner
     :param path_to_mirai:
     :param _date_limit: the oldest date to look for
@@ -268,103 +294,282 @@ def generate_report(censys_ips, censys_with_banners, censys_empty_banners, _bann
     :param outfile_base_name: base name of output file used for exports
     :return: void
     """
+    generate_reports(censys_ips, censys_with_banners, censys_empty_banners, _banners_map, path_to_mirai,
+                     [ReportSpec(_filter_port, _filter_date, _date_limit, _seen, outfile_base_name)])
+
+
+def generate_reports(censys_ips, censys_with_banners, censys_empty_banners, _banners_map, path_to_mirai, specs):
+    """
+    Generates several reports (e.g. with and without the port filter) from a single
+    pass over mirai. Only the sets of mirai ips depend on the filters, so every row
+    is passed to the filter of each report and to one shared set of aggregators.
+
+    :param censys_ips: set (or ipset.IPSet) of all censys ips
+    :param censys_with_banners: set (or ipset.IPSet) of censys ips with banners
+    :param censys_empty_banners: set (or ipset.IPSet) of censys ips without banners
+    :param _banners_map: ip --> banner
+    :param path_to_mirai:
+    :param specs: list of ReportSpec
+    :return: void
+    """
+    # collect everything needed from mirai in a single pass over the csv
+    mirai_filters = [aggregators.MiraiIpFilter(date_limit=spec.date_limit,
+                                               seen=spec.seen,
+                                               filter_port=spec.filter_port,
+                                               filter_date=spec.filter_date,
+                                               compact=isinstance(censys_ips, ipset.IPSet))
+                     for spec in specs]
+    counts = aggregators.FirstRowCounts()
+    ports = aggregators.PortCounts()
+    ips2asn = aggregators.GroupBy(by=config.ASN)
+    ips2country = aggregators.GroupBy(by=config.COUNTRY)
+    durations = aggregators.FirstSeenDuration()
+    with instrument.stage("scan_mirai") as scan_stage:
+        scan_stage.rows = loaders.scan_mirai(path_to_mirai,
+                                             mirai_filters + [counts, ports, ips2asn, ips2country, durations],
+                                             candidates=censys_ips)
+
+    plot_jobs = []
+    for spec, mirai_filter in zip(specs, mirai_filters):
+        with instrument.stage("report"):
+            plot_jobs += write_report(spec, mirai_filter.result(), censys_ips, censys_empty_banners, _banners_map,
+                                      counts, ports, ips2asn, ips2country, durations)
+
+    # plots of all reports together, in a pool of processes
+    with instrument.stage("plots", rows=len(plot_jobs)):
+        my_plt.render(plot_jobs)
+
+
+def write_report(spec, mirai_ips, censys_ips, censys_empty_banners, _banners_map,
+                 counts, ports, ips2asn, ips2country, durations):
+    """
+    Exports statistics and plots of one report, see generate_reports.
+
+    :param spec: ReportSpec
+    :param mirai_ips: set of mirai ips matching the filters of spec
+    :param censys_ips: set (or ipset.IPSet) of all censys ips
+    :param censys_empty_banners: set (or ipset.IPSet) of censys ips without banners
+    :param _banners_map: ip --> banner
+    :param counts: aggregators.FirstRowCounts
+    :param ports: aggregators.PortCounts
+    :param ips2asn: aggregators.GroupBy by asn
+    :param ips2country: aggregators.GroupBy by country
+    :param durations: aggregators.FirstSeenDuration
+    :return: list of plot_methods.PlotJob
+    """
+    outfile_base_name = spec.outfile_base_name
     print("\n################## Processing " + outfile_base_name + " ##################")
-    if _filter_port:
+    if spec.filter_port:
         print("Filtering by ports 23 and 2323")
-    if _filter_date:
-        print("Filtering by date, retrieving records starting from " + _date_limit)
+    if spec.filter_date:
+        print("Filtering by date, retrieving records starting from " + spec.date_limit)
 
     print()  # empty line
 
-    mirai_ips = loaders.load_mirai_ips_filter_date_port(
-        path_to_mirai,
-        date_limit=_date_limit,
-        seen=_seen,
-        filter_port=_filter_port,
-        filter_date=_filter_date)
     print("Loaded %d IPs from MIRAI." % len(mirai_ips))
 
     # intersection
-    infected = match_mirai_censys(mirai_ips, censys_ips)
+    with instrument.stage("intersect", rows=len(mirai_ips)):
+        infected = match_mirai_censys(mirai_ips, censys_ips)
     # stats
-    prefix_count, country_count, asn_count = get_counts(infected.copy(), path_to_mirai)
-    # Line below limits sets of banners to the infected ones
-    banners_count_not_empty, count_empty_banners = infected_banners_stats(infected, censys_empty_banners)
+    with instrument.stage("counts", rows=len(infected)):
+        prefix_count, country_count, asn_count = counts.result(infected)
+    with instrument.stage("banners", rows=len(infected)):
+        # Line below limits sets of banners to the infected ones
+        banners_count_not_empty, count_empty_banners = infected_banners_stats(infected, censys_empty_banners)
+        # maps banner to a list of ips (banner --> [ip1, ip2]
+        banners2ips = group_by_banners(infected_ips=infected, banner_map=_banners_map)
+    with instrument.stage("ports", rows=len(infected)):
+        port_counts = ports.result(infected)
+    with instrument.stage("group_by", rows=len(infected)):
+        ips2asn_groups = ips2asn.result(infected)
+        ips2country_groups = ips2country.result(infected)
+    with instrument.stage("durations", rows=len(infected)):
+        durations_infected = durations.durations(infected)
+
+    data = ReportData(infected, banners_count_not_empty, count_empty_banners, banners2ips,
+                      prefix_count, country_count, asn_count, port_counts,
+                      ips2asn_groups, ips2country_groups, durations_infected)
+    return export_report(outfile_base_name, data,
+                         banner_store=_banners_map if isinstance(_banners_map, banners.BannerStore) else None)
+
+
+def export_report(outfile_base_name, data, banner_store=None):
+    """
+    Writes the statistics of one report to csv files and prepares its plots.
+    Nothing is computed here, so a report can be exported again under another
+    name from saved statistics (see pipeline.py).
 
+    :param outfile_base_name: base name of output file used for exports
+    :param data: ReportData
+    :param banner_store: optional banners.BannerStore used to decode the banner ids of data.banners2ips
+    :return: list of plot_methods.PlotJob, rendered by the caller (see plot_methods.render)
+    """
+    infected = data.infected
     print("Infected total: ", len(infected))
-    print("Infected with banners", banners_count_not_empty)
-    print("Infected without banners", count_empty_banners)
-
-    # maps banner to a list of ips (banner --> [ip1, ip2]
-    banners2ips = group_by_banners(infected_ips=infected, banner_map=_banners_map)
-    port_counts = count_ports(infected_ips=infected.copy(), path_to_mirai=path_to_mirai)
-
-    group_by(path_to_mirai=path_to_mirai,
-             outfile=outfile_base_name + "ips2asn",
-             _censys_ips=infected,
-             by=config.ASN)
-    group_by(path_to_mirai=path_to_mirai,
-             outfile=outfile_base_name + "_ips2country",
-             _censys_ips=infected,
-             by=config.COUNTRY)
-
-    ########################## Export infected IPs ###############################################
-    outfile = open(outfile_base_name + "_infected.csv", "w")
-    out_writer = csv.writer(outfile, dialect='excel')
-
-    out_writer.writerow(["Infected total", len(infected)])
-    out_writer.writerow(["Infected with banners", banners_count_not_empty])
-    out_writer.writerow(["Infected without banners", count_empty_banners])
-    for inf in infected:
-        out_writer.writerow([inf])
-
-    ########################## Export Counters ###############################################
-    loaders.export_banners(outfile_base_name, banners2ips, "banners2ips", version=2)
-    loaders.export_counters(outfile_base_name, prefix_count, "prefix_count")
-    loaders.export_counters(outfile_base_name, country_count, "country_count")
-    loaders.export_counters(outfile_base_name, port_counts, "ports_count")
-
-    # Add plots for below
+    print("Infected with banners", data.banners_count_not_empty)
+    print("Infected without banners", data.count_empty_banners)
+
+    with instrument.stage("exports", rows=len(infected)):
+        # independent files, see exports.run_jobs
+        exports.run_jobs([
+            exports.ExportJob(export_group_by, (outfile_base_name + "ips2asn", data.ips2asn)),
+            exports.ExportJob(export_group_by, (outfile_base_name + "_ips2country", data.ips2country)),
+            exports.ExportJob(export_infected, (outfile_base_name, data)),
+            exports.ExportJob(loaders.export_banners, (outfile_base_name, data.banners2ips, "banners2ips", 2,
+                                                       banner_store)),
+            exports.ExportJob(loaders.export_counters, (outfile_base_name, data.prefix_count, "prefix_count")),
+            exports.ExportJob(loaders.export_counters, (outfile_base_name, data.country_count, "country_count")),
+            exports.ExportJob(loaders.export_counters, (outfile_base_name, data.port_counts, "ports_count")),
+        ])
+
+    plot_jobs = []
     temp_list = []
     print("\n################# Prefix top 10 #########################")
-    for key, value in prefix_count.most_common(10):
+    for key, value in data.prefix_count.most_common(10):
         print(key, "\t", value)
         temp_list.append((key, value))
 
-    my_plt.plot_bar(temp_list, key="Prefix", value="Count",
-                    title="Number of infected devices grouped by Prefix",
-                    path=outfile_base_name + "_prefix.png")
+    plot_jobs.append(my_plt.bar_job(temp_list, key="Prefix", value="Count",
+                                    title="Number of infected devices grouped by Prefix",
+                                    path=outfile_base_name + "_prefix.png"))
     temp_list = []
 
     print("\n################# Country top 10 #########################")
-    for key, value in country_count.most_common(10):
+    for key, value in data.country_count.most_common(10):
         print(key, "\t", value)
         temp_list.append((key, value))
 
-    my_plt.plot_bar(temp_list, key="Country", value="Count",
-                    title="Number of infected devices grouped by country",
-                    path=outfile_base_name + "_country.png")
+    plot_jobs.append(my_plt.bar_job(temp_list, key="Country", value="Count",
+                                    title="Number of infected devices grouped by country",
+                                    path=outfile_base_name + "_country.png"))
     temp_list = []
 
     print("\n################# ASN top 10 #########################")
-    for key, value in asn_count.most_common(10):
+    for key, value in data.asn_count.most_common(10):
         print(key, "\t", value)
         temp_list.append((key, value))
 
-    my_plt.plot_bar(temp_list, key="ASN", value="Count",
-                    title="Number of infected devices grouped by ASN number",
-                    path=outfile_base_name + "_asn.png")
-    temp_list = []
+    plot_jobs.append(my_plt.bar_job(temp_list, key="ASN", value="Count",
+                                    title="Number of infected devices grouped by ASN number",
+                                    path=outfile_base_name + "_asn.png"))
 
     ### Plot durations for this data
-    my_plt.plot_duration(infected, outfile_base_name + "_duration")
+    plot_jobs.append(my_plt.duration_job(data.durations, outfile_base_name + "_duration"))
+    return plot_jobs
 
 
+def generate_approx_report(censys_sketch, path_to_mirai, spec):
+    """
+    Approximate report in fixed memory, see aggregators.ApproxCounts. Estimates are
+    printed with their error bounds, saved to <outfile_base_name>_approx.json and the
+    top 10 prefixes, countries and asns are plotted as in the exact report.
+
+    :param censys_sketch: sketches.CensysSketch, see loaders.load_censys_sketch
+    :param path_to_mirai:
+    :param spec: ReportSpec
+    :return: dict with the estimates, see aggregators.ApproxCounts.result
+    """
+    approx = aggregators.ApproxCounts(censys_sketch, date_limit=spec.date_limit, seen=spec.seen,
+                                      filter_port=spec.filter_port, filter_date=spec.filter_date)
+    with instrument.stage("scan_mirai") as scan_stage:
+        scan_stage.rows = loaders.scan_mirai(path_to_mirai, [approx])
+    with instrument.stage("approx_counts"):
+        result = approx.result()
+
+    outfile_base_name = spec.outfile_base_name
+    print("\n################## Approximate " + outfile_base_name + " ##################")
+    print("Censys IPs (port 23 or 2323): ~%d (+- %.1f%%)" %
+          (censys_sketch.ips_count.count(), 100 * censys_sketch.ips_count.relative_error()))
+    print("Censys IPs (other ports): ", censys_sketch.total_others)
+    print("Infected total: ~%d (+- %.1f%%)" % (result["infected"], 100 * result["infected_relative_error"]))
+    print("Bloom filter false positive rate: censys %.4f, seen %.4f" %
+          (result["censys_false_positive_rate"], result["seen_false_positive_rate"]))
+    print("Distinct IPs of the top keys: +- %.1f%%" % (100 * result["distinct_relative_error"]))
+
+    plot_jobs = []
+    for name, key, title in (("prefix", "Prefix", "Number of infected devices grouped by Prefix"),
+                             ("country", "Country", "Number of infected devices grouped by country"),
+                             ("asn", "ASN", "Number of infected devices grouped by ASN number")):
+        print("\n######## %s top 10 (counts at most %d too high with probability %.3f, about %.2f%% too low) ########" %
+              (key, result[name + "_error"], result[name + "_confidence"], 100 * result[name + "_undercount_rate"]))
+        for (k, value), (_, distinct) in zip(result[name], result[name + "_distinct"]):
+            print(k, "\t", value, "\t", "~%d distinct IPs over all rows" % distinct)
+        plot_jobs.append(my_plt.bar_job(result[name], key=key, value="Count", title=title + " (approximate)",
+                                        path=outfile_base_name + "_approx_" + name + ".png"))
+
+    summary = dict(result)
+    summary["ports"] = sorted(result["ports"].items(), key=lambda e: -e[1])
+    summary["censys_ips"] = censys_sketch.ips_count.count()
+    summary["censys_with_banners"] = censys_sketch.with_banner.count()
+    summary["censys_empty_banners"] = censys_sketch.no_banner.count()
+    summary["censys_other_ports"] = censys_sketch.total_others
+    with open(outfile_base_name + "_approx.json", "w") as outfile:
+        json.dump(summary, outfile, indent=2)
+
+    with instrument.stage("plots", rows=len(plot_jobs)):
+        my_plt.render(plot_jobs)
+    return result
+
+
+def generate_join_report(dir_path_censys, path_to_mirai, spec, memory_budget=config.JOIN_MEMORY_BUDGET):
+    """
+    Report of generate_reports for data which does not fit in memory: censys and mirai
+    are sorted by ip on disk and joined (see join.py), the statistics are collected from
+    the join, so only the infected ips are kept in memory. Same numbers as the report of
+    generate_reports, but infected ips and groups with the same size come in order of ip.
+
+    :param dir_path_censys: directory with censys files
+    :param path_to_mirai: absolute path to csv
+    :param spec: ReportSpec
+    :param memory_budget: approximate number of bytes for each side of the join
+        and for the groupings, see config.GROUP_MEMORY_BUDGET
+    :return: ReportData
+    """
+    with instrument.stage("sort_censys") as censys_stage:
+        censys_runs, not23count = join.sort_censys(dir_path_censys, memory_budget)
+        censys_stage.rows = censys_runs.count
+    print("Censys records (port 23 or 2323): ", censys_runs.count)
+    print("Censys IPs (other ports): ", not23count)
+
+    mirai_runs = join.MiraiRuns(memory_budget, date_limit=spec.date_limit, seen=spec.seen,
+                                filter_port=spec.filter_port, filter_date=spec.filter_date)
+    with instrument.stage("sort_mirai") as mirai_stage:
+        mirai_stage.rows = loaders.scan_mirai(path_to_mirai, [mirai_runs])
+
+    counts = aggregators.FirstRowCounts()
+    ports = aggregators.PortCounts()
+    ips2asn = aggregators.GroupBy(by=config.ASN, memory_budget=memory_budget)
+    ips2country = aggregators.GroupBy(by=config.COUNTRY, memory_budget=memory_budget)
+    durations = aggregators.FirstSeenDuration()
+    joined_banners = join.JoinedBanners(memory_budget=memory_budget)
+    try:
+        with instrument.stage("join") as join_stage:
+            infected = join.scan_join(join.merge_join(censys_runs, mirai_runs),
+                                      [counts, ports, ips2asn, ips2country, durations, joined_banners],
+                                      compact=config.COMPACT_IPS)
+            join_stage.rows = len(infected)
+    finally:
+        censys_runs.close()
+        mirai_runs.close()
+
+    print("\n################## Processing " + spec.outfile_base_name + " ##################")
+    data = ReportData(infected, len(infected) - joined_banners.count_empty_banners,
+                      joined_banners.count_empty_banners, joined_banners.groups(),
+                      *counts.result(infected), ports.result(infected), ips2asn.result(infected),
+                      ips2country.result(infected), durations.durations(infected))
+    plot_jobs = export_report(spec.outfile_base_name, data)
+    with instrument.stage("plots", rows=len(plot_jobs)):
+        my_plt.render(plot_jobs)
+    return data
+
 if __name__ == '__main__':
     # get all censys info
 
+    # keep what count_devices needs, so censys files are read only once
+    device_index = devices.DeviceIndex()
     censys_ips, censys_with_banners, censys_empty_banners, _banners_map, not23count = \
-        loaders.load_censys_ips(config.JSON_DATA_DIR)
+        loaders.load_censys_ips(config.JSON_DATA_DIR, device_index=device_index)
 
     print("Censys IPs (port 23 or 2323): ", len(censys_ips))
     print("Censys IPs (other ports): ", not23count)
@@ -372,38 +577,33 @@ if __name__ == '__main__':
     print("Censys without banners: ", len(censys_empty_banners))
 
     # Match only data from MIRAI where port 23 or 2323 were used and after date [_date_limit]
-    
-    generate_report(censys_ips, censys_with_banners, censys_empty_banners, _banners_map,
-                    config.MIRAI_PATH, _date_limit="2018-12-04T00:00:00Z",
-                    _seen="fseen", _filter_port=True, _filter_date=True,
-                    outfile_base_name="../new_results/port23_past04_only/port23_past04")
-    
+    reports = [
+        ReportSpec(filter_port=True, filter_date=True, date_limit="2018-12-04T00:00:00Z", seen="fseen",
+                   outfile_base_name="../new_results/port23_past04_only/port23_past04"),
+    ]
+    generate_reports(censys_ips, censys_with_banners, censys_empty_banners, _banners_map,
+                     config.MIRAI_PATH, reports)
+
     load_data_and_count_devices(censys_ips, config.JSON_DATA_DIR, config.MIRAI_PATH,
                                 _date_limit="2018-12-04T00:00:00Z",
-                                _seen="fseen", _filter_port=True, _filter_date=True)
+                                _seen="fseen", _filter_port=True, _filter_date=True, device_index=device_index)
 
     """
-    # Use all data
-    generate_report(censys_ips, censys_with_banners, censys_empty_banners, _banners_map,
-                    MIRAI_PATH, _date_limit="2018-12-04T00:00:00Z",
-                    _seen="fseen", _filter_port=False, _filter_date=False, outfile_base_name="new_results/all/all")
-
-    # Match only data from MIRAI where port 23 or 2323 were used
-    generate_report(censys_ips, censys_with_banners, censys_empty_banners, _banners_map,
-                    MIRAI_PATH, _date_limit="2018-12-04T00:00:00Z",
-                    _seen="fseen", _filter_port=True, _filter_date=False,
-                    outfile_base_name="new_results/port23_only/port23")
-
-    # Match only data from MIRAI after date [_date_limit]
-    generate_report(censys_ips, censys_with_banners, censys_empty_banners, _banners_map,
-                    MIRAI_PATH, _date_limit="2018-12-04T00:00:00Z",
-                    _seen="fseen", _filter_port=False, _filter_date=True,
-                    outfile_base_name="new_results/past04_only/past04")
-
-    # Match only data from MIRAI where port 23 or 2323 were used and after date [_date_limit]
-    generate_report(censys_ips, censys_with_banners, censys_empty_banners, _banners_map,
-                    MIRAI_PATH, _date_limit="2018-12-04T00:00:00Z",
-                    _seen="fseen", _filter_port=True, _filter_date=True,
-                    outfile_base_name="new_results/port23_past04_only/port23_past04")
-
+    # All four variants, generated from a single pass over MIRAI
+    reports = [
+        # Use all data
+        ReportSpec(filter_port=False, filter_date=False, date_limit="2018-12-04T00:00:00Z", seen="fseen",
+                   outfile_base_name="../new_results/all/all"),
+        # Match only data from MIRAI where port 23 or 2323 were used
+        ReportSpec(filter_port=True, filter_date=False, date_limit="2018-12-04T00:00:00Z", seen="fseen",
+                   outfile_base_name="../new_results/port23_only/port23"),
+        # Match only data from MIRAI after date [_date_limit]
+        ReportSpec(filter_port=False, filter_date=True, date_limit="2018-12-04T00:00:00Z", seen="fseen",
+                   outfile_base_name="../new_results/past04_only/past04"),
+        # Match only data from MIRAI where port 23 or 2323 were used and after date [_date_limit]
+        ReportSpec(filter_port=True, filter_date=True, date_limit="2018-12-04T00:00:00Z", seen="fseen",
+                   outfile_base_name="../new_results/port23_past04_only/port23_past04"),
+    ]
+    generate_reports(censys_ips, censys_with_banners, censys_empty_banners, _banners_map,
+                     config.MIRAI_PATH, reports)
     """
@@ -0,0 +1,393 @@
+"""
+Analysis server: loads the censys files and the mirai cache once and answers
+questions over http on localhost, so a follow-up question does not reload the data.
+
+    python server.py --port 8765
+    curl "localhost:8765/infected?filter_port=1&filter_date=1&date_limit=2018-12-04T00:00:00Z"
+    curl "localhost:8765/top?by=country&n=10&filter_port=1"
+    curl "localhost:8765/ports?n=20"
+    curl "localhost:8765/banners?n=5&ips=3"
+    curl "localhost:8765/devices?n=10&filter_port=1&filter_date=1"
+    curl "localhost:8765/status"
+
+Filters are the parameters of process_data.ReportSpec (filter_port, filter_date,
+date_limit, seen), results are kept per filter. New censys files (and a new mirai
+cache) are picked up every SERVER_RELOAD_SECONDS (config.py) in a background thread,
+or by /reload, which clears the kept results. Results of the SERVER_MAX_FILTERS most
+recently used filters are kept.
+"""
+import argparse
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import aggregators as aggregators
+import banners as banners
+import config as config
+import devices as devices
+import instrument as instrument
+import loaders as loaders
+import mirai_cache as mirai_cache
+import process_data as process_data
+
+FILTER_DEFAULTS = {"filter_port": False, "filter_date": False, "date_limit": "2018-12-04T00:00:00Z",
+                   "seen": "fseen"}
+
+
+class BadRequest(Exception):
+    """
+    Invalid parameters of a request, answered with 400.
+    """
+
+
+class Analysis(object):
+    """
+    Censys and mirai data kept in memory and the results computed for recent filters.
+    Results of different filters are computed at the same time, a reload waits for them
+    and they wait for the reload.
+    """
+
+    def __init__(self, dir_path_censys, path_to_mirai, compact=config.COMPACT_IPS,
+                 reload_seconds=config.SERVER_RELOAD_SECONDS, max_filters=config.SERVER_MAX_FILTERS):
+        """
+
+        :param dir_path_censys: directory with censys files
+        :param path_to_mirai: absolute path to csv, its cache is built if missing or stale
+        :param compact: see loaders.load_censys_ips
+        :param reload_seconds: time between two checks for new files, see watch
+        :param max_filters: number of filters whose results are kept, the least recently used are dropped
+        """
+        self.dir = dir_path_censys
+        self.path_to_mirai = path_to_mirai
+        self.compact = compact
+        self.reload_seconds = reload_seconds
+        self.max_filters = max_filters
+        self.data_lock = _ReadWriteLock()  # read by computations, written by reload
+        self.lock = threading.Lock()  # guards results and pending, never held while computing
+        self.reload_lock = threading.Lock()  # one reload at a time
+        self.device_index = devices.DeviceIndex()
+        self.censys = loaders.load_censys_ips(dir_path_censys, compact=compact, device_index=self.device_index)
+        self.censys_files = set(loaders.censys_files(dir_path_censys))
+        self.table = None
+        self.mirai_size = None
+        self._build_cache()
+        self._load_mirai()
+        self.results = collections.OrderedDict()  # filter --> dict of results, least recently used first
+        self.pending = dict()  # (filter, name) --> lock of the request computing it
+
+    def _build_cache(self):
+        if not mirai_cache.is_fresh(self.path_to_mirai):
+            mirai_cache.build_cache(self.path_to_mirai)
+
+    def _load_mirai(self):
+        table = mirai_cache.load_cache(self.path_to_mirai)
+        self.table = table
+        self.mirai_size = os.stat(self.path_to_mirai).st_size
+        # statistics of all rows of censys ips, shared by all filters (see process_data.generate_reports)
+        self.counts = aggregators.FirstRowCounts()
+        self.ports = aggregators.PortCounts()
+        with instrument.stage("scan_mirai") as scan_stage:
+            loaders.scan_mirai_table(table, [self.counts, self.ports], candidates=self.censys[0])
+            scan_stage.rows = len(table)
+
+    def watch(self):
+        """
+        Checks for new files every reload_seconds in a background thread.
+
+        :return: the thread
+        """
+        def check():
+            while True:
+                time.sleep(self.reload_seconds)
+                try:
+                    self.reload()
+                except Exception as e:  # keep serving the loaded data
+                    print("Reload failed: %s" % e)
+
+        thread = threading.Thread(target=check, name="reload", daemon=True)
+        thread.start()
+        return thread
+
+    def reload(self):
+        """
+        Adds new censys files and reloads a changed mirai csv. Files are read (and the
+        mirai cache rebuilt) while requests are still answered.
+
+        :return: list of the new censys files
+        """
+        with self.reload_lock:
+            return self._reload()
+
+    def _reload(self):
+        new_files = [f for f in loaders.censys_files(self.dir) if f not in self.censys_files]
+        partials = [loaders.load_censys_file(self.dir + "/" + _file, compact=self.compact, with_devices=True)
+                    for _file in new_files]
+        mirai_changed = os.stat(self.path_to_mirai).st_size != self.mirai_size or \
+            not mirai_cache.is_fresh(self.path_to_mirai)
+        if mirai_changed:
+            self._build_cache()
+        if not new_files and not mirai_changed:
+            return []
+        with self.data_lock.writing():
+            for _file, partial in zip(new_files, partials):
+                print("processing file: ", _file)
+                merged = loaders.merge_censys_file(self.censys + (self.device_index,), partial)
+                self.censys, self.device_index = merged[:5], merged[5]
+                self.censys_files.add(_file)
+            self._load_mirai()
+            with self.lock:
+                self.results = collections.OrderedDict()
+        return new_files
+
+    def result(self, spec, name):
+        """
+
+        :param spec: dict with the keys of FILTER_DEFAULTS
+        :param name: infected, infected_banners, counts, ports, banners or devices
+        :return: the result for that filter, computed on first use
+        """
+        with self.data_lock.reading():
+            return self._result(spec, name)
+
+    def _result(self, spec, name):
+        key = tuple(spec[k] for k in sorted(FILTER_DEFAULTS))
+        with self.lock:
+            value = self._kept(key, name)
+            if value is not _MISSING:
+                return value
+            pending = self.pending.setdefault((key, name), threading.Lock())
+        with pending:  # a single request computes it, the others wait for it
+            with self.lock:
+                value = self._kept(key, name)
+            if value is _MISSING:
+                value = self._compute(spec, name)
+                with self.lock:
+                    self.results.setdefault(key, dict())[name] = value
+                    self.results.move_to_end(key)
+                    while len(self.results) > self.max_filters:
+                        self.results.popitem(last=False)
+            with self.lock:
+                self.pending.pop((key, name), None)
+        return value
+
+    def _kept(self, key, name):
+        results = self.results.get(key)
+        if results is None or name not in results:
+            return _MISSING
+        self.results.move_to_end(key)
+        return results[name]
+
+    def _compute(self, spec, name):
+        if name == "infected":
+            mirai_filter = aggregators.MiraiIpFilter(date_limit=spec["date_limit"], seen=spec["seen"],
+                                                     filter_port=spec["filter_port"],
+                                                     filter_date=spec["filter_date"], compact=self.compact)
+            mirai_filter.update_table(self.table, self.table.candidate_rows())
+            return process_data.match_mirai_censys(mirai_filter.result(), self.censys[0])
+        infected = self._result(spec, "infected")
+        if name == "infected_banners":  # with the censys data of the same load as infected
+            return (len(infected),) + process_data.infected_banners_stats(infected, self.censys[2])
+        if name == "counts":
+            return self.counts.result(infected)
+        if name == "ports":
+            return self.ports.result(infected)
+        if name == "banners":
+            banner_map = self.censys[3]
+            groups = process_data.group_by_banners(infected, banner_map, memory_budget=None)
+            groups = sorted(groups.items(), key=lambda e: -(len(e[1])))
+            if isinstance(banner_map, banners.BannerStore):
+                groups = [(banner_map.text(key), value) for key, value in groups]
+            return groups
+        if name == "devices":
+            return process_data.device_stats(self.dir, infected, device_index=self.device_index)
+        raise KeyError(name)
+
+    def status(self):
+        with self.data_lock.reading():
+            with self.lock:
+                return {"censys_files": len(self.censys_files), "censys_ips": len(self.censys[0]),
+                        "mirai_rows": len(self.table), "filters": len(self.results)}
+
+
+_MISSING = object()
+
+
+class _ReadWriteLock(object):
+    """
+    Any number of readers or a single writer; a waiting writer stops new readers.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writing = False
+
+    @contextlib.contextmanager
+    def reading(self):
+        with self._condition:
+            while self._writing:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def writing(self):
+        with self._condition:
+            while self._writing:
+                self._condition.wait()
+            self._writing = True
+            while self._readers:
+                self._condition.wait()
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
+
+def parse_spec(query):
+    """
+
+    :param query: dict name --> list of values, see urllib.parse.parse_qs
+    :return: dict with the keys of FILTER_DEFAULTS
+    :raises BadRequest: if a value is not valid
+    """
+    spec = dict(FILTER_DEFAULTS)
+    for name in ("filter_port", "filter_date"):
+        if name in query:
+            spec[name] = query[name][0].lower() in ("1", "true", "yes")
+    if "date_limit" in query:
+        spec["date_limit"] = query["date_limit"][0]
+        try:
+            time.strptime(spec["date_limit"], mirai_cache.TIME_FORMAT)
+        except ValueError:
+            raise BadRequest("date_limit must be in format %s" % mirai_cache.TIME_FORMAT)
+    if "seen" in query:
+        if query["seen"][0] not in ("fseen", "lseen"):
+            raise BadRequest("seen must be fseen or lseen")
+        spec["seen"] = query["seen"][0]
+    return spec
+
+
+def parse_int(query, name, default):
+    """
+
+    :param query: dict name --> list of values
+    :param name: name of the parameter
+    :param default: value if the parameter is missing
+    :return: the parameter as a non-negative int
+    :raises BadRequest: if it is not a non-negative int
+    """
+    try:
+        value = int(query.get(name, [default])[0])
+    except ValueError:
+        value = -1
+    if value < 0:
+        raise BadRequest("%s must be a non-negative integer" % name)
+    return value
+
+
+def answer(analysis, path, query):
+    """
+
+    :param analysis: Analysis
+    :param path: path of the request, e.g. /top
+    :param query: dict name --> list of values
+    :return: json serializable answer
+    """
+    if path == "/status":
+        return analysis.status()
+    if path == "/reload":
+        return {"new_files": analysis.reload()}
+    spec = parse_spec(query)
+    n = parse_int(query, "n", 10)
+    if path == "/infected":
+        infected, with_banners, without_banners = analysis.result(spec, "infected_banners")
+        return {"filter": spec, "infected": infected, "with_banners": with_banners,
+                "without_banners": without_banners}
+    if path == "/top":
+        by = query.get("by", ["country"])[0]
+        names = ["prefix", "country", "asn"]
+        if by not in names:
+            raise BadRequest("by must be one of %s" % ", ".join(names))
+        counter = analysis.result(spec, "counts")[names.index(by)]
+        return {"filter": spec, "by": by, "top": counter.most_common(n)}
+    if path == "/ports":
+        return {"filter": spec, "ports": analysis.result(spec, "ports").most_common(n)}
+    if path == "/banners":
+        shown = parse_int(query, "ips", 0)
+        groups = analysis.result(spec, "banners")
+        return {"filter": spec, "groups": len(groups),
+                "banners": [{"banner": banner, "count": len(ips), "ips": ips[:shown]} for banner, ips in groups[:n]]}
+    if path == "/devices":
+        stats = analysis.result(spec, "devices")
+        return {"filter": spec, "no_description": stats.no_description,
+                "multi_device_ips": len(stats.multi_device_ips), "devices": stats.devices_counter.most_common(n),
+                "multi_country": stats.multi_country_counter.most_common(n)}
+    return None
+
+
+class Handler(BaseHTTPRequestHandler):
+    analysis = None  # set by serve
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        started = time.perf_counter()
+        try:
+            body = answer(self.analysis, url.path, urllib.parse.parse_qs(url.query))
+            status = 200 if body is not None else 404
+            if body is None:
+                body = {"error": "unknown path %s" % url.path}
+        except BadRequest as br:
+            status, body = 400, {"error": str(br)}
+        except Exception as e:
+            status, body = 500, {"error": "%s: %s" % (type(e).__name__, e)}
+        if status == 200:
+            body["milliseconds"] = round((time.perf_counter() - started) * 1000, 3)
+        data = json.dumps(body, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve(analysis, host="127.0.0.1", port=config.SERVER_PORT):
+    """
+    Answers requests until interrupted.
+
+    :param analysis: Analysis
+    :param host: address to listen on, localhost by default
+    :param port:
+    :return: void
+    """
+    Handler.analysis = analysis
+    analysis.watch()
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    print("Serving on http://%s:%d" % (host, httpd.server_port))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Answer questions about the loaded data over http")
+    parser.add_argument("--censys", default=config.JSON_DATA_DIR)
+    parser.add_argument("--mirai", default=config.MIRAI_PATH)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=config.SERVER_PORT)
+    args = parser.parse_args()
+    serve(Analysis(args.censys, args.mirai), args.host, args.port)
@@ -0,0 +1,312 @@
+import hashlib
+import math
+import numpy as np
+import ipset as ipset
+
+
+def mix64(values):
+    """
+    splitmix64 finalizer, spreads integer keys over 64 bits.
+
+    :param values: integer numpy array
+    :return: uint64 array of hashes
+    """
+    z = np.asarray(values).astype(np.uint64)
+    with np.errstate(over="ignore"):
+        z = z + np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+def hash_ips(ips):
+    """
+
+    :param ips: list of addresses, or integer array of ipv4 addresses (mask out the -1 of
+        ipset.ips_to_array for addresses which are not ipv4, they would all get one hash)
+    :return: uint64 array of hashes, the same in every process
+    """
+    if isinstance(ips, np.ndarray):
+        return mix64(ips.astype(np.int64) & 0xFFFFFFFF)
+    values = ipset.ips_to_array(ips, strict=False).astype(np.int64)
+    for i in np.nonzero(values < 0)[0].tolist():
+        # not ipv4: hashed from its text, above the range of ipv4 addresses so it never equals one
+        digest = hashlib.blake2b(str(ips[i]).encode("utf-8"), digest_size=7).digest()
+        values[i] = int.from_bytes(digest, "little") | (1 << 56)
+    return mix64(values)
+
+
+def hash_keys(keys):
+    """
+
+    :param keys: list of strings (asn, country, prefix, ...)
+    :return: uint64 array of hashes, the same in every process
+    """
+    return np.fromiter((int.from_bytes(hashlib.blake2b(str(k).encode("utf-8"), digest_size=8).digest(), "little")
+                        for k in keys), dtype=np.uint64, count=len(keys))
+
+
+class HyperLogLog(object):
+    """
+    Approximate number of distinct items in 2 ** precision bytes,
+    relative standard error 1.04 / sqrt(2 ** precision).
+    """
+
+    def __init__(self, precision=14):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    def add_hashes(self, hashes):
+        """
+
+        :param hashes: uint64 array (see hash_ips)
+        :return: void
+        """
+        if len(hashes) == 0:
+            return
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        buckets = (hashes >> np.uint64(64 - self.precision)).astype(np.int64)
+        # rank = position of the first 1 bit after the bucket bits, from the next 32 bits
+        rest = ((hashes << np.uint64(self.precision)) >> np.uint64(32)).astype(np.float64)
+        rank = np.where(rest > 0, 33 - np.frexp(rest)[1], 33).astype(np.uint8)
+        np.maximum.at(self.registers, buckets, rank)
+
+    def count(self):
+        """
+
+        :return: estimated number of distinct items
+        """
+        m = float(len(self.registers))
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros > 0:
+            return int(round(m * math.log(m / zeros)))  # linear counting for small cardinalities
+        return int(round(estimate))
+
+    def relative_error(self):
+        """
+
+        :return: relative standard error of count
+        """
+        return 1.04 / math.sqrt(len(self.registers))
+
+    def merge(self, other):
+        """
+
+        :param other: HyperLogLog with the same precision
+        :return: void
+        """
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+
+class CountMinSketch(object):
+    """
+    Approximate counts of keys in a depth x width table. An estimate is never below
+    the true count and exceeds it by at most e / width * total with probability
+    1 - exp(-depth).
+    """
+
+    def __init__(self, width=2048, depth=5):
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width), dtype=np.int64)
+        self.total = 0
+
+    def _columns(self, hashes, row):
+        return (mix64(hashes ^ np.uint64(row + 1)) % np.uint64(self.width)).astype(np.int64)
+
+    def add_hashes(self, hashes, counts=1):
+        """
+
+        :param hashes: uint64 array of key hashes (see hash_keys)
+        :param counts: count per key, or an array of counts
+        :return: void
+        """
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        counts = np.broadcast_to(np.asarray(counts, dtype=np.int64), hashes.shape)
+        for row in range(self.depth):
+            np.add.at(self.table[row], self._columns(hashes, row), counts)
+        self.total += int(counts.sum())
+
+    def estimate_hashes(self, hashes):
+        """
+
+        :param hashes: uint64 array of key hashes
+        :return: int64 array of estimated counts
+        """
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        estimates = self.table[0][self._columns(hashes, 0)]
+        for row in range(1, self.depth):
+            estimates = np.minimum(estimates, self.table[row][self._columns(hashes, row)])
+        return estimates
+
+    def error_bound(self):
+        """
+
+        :return: (maximum overestimate, probability that it holds)
+        """
+        return math.e / self.width * self.total, 1 - math.exp(-self.depth)
+
+    def merge(self, other):
+        """
+
+        :param other: CountMinSketch with the same width and depth
+        :return: void
+        """
+        self.table += other.table
+        self.total += other.total
+
+
+class TopKeys(object):
+    """
+    Heavy hitters: a CountMinSketch of all keys and a bounded set of candidate
+    keys with the highest estimates.
+    """
+
+    def __init__(self, k=10, width=2048, depth=5, candidates=None):
+        self.k = k
+        self.sketch = CountMinSketch(width, depth)
+        self.capacity = candidates if candidates is not None else 10 * k
+        self.candidates = dict()  # key --> hash
+
+    def add(self, keys, counts=1):
+        """
+
+        :param keys: list of keys
+        :param counts: count per key, or a list of counts
+        :return: void
+        """
+        if len(keys) == 0:
+            return
+        hashes = hash_keys(keys)
+        self.sketch.add_hashes(hashes, counts)
+        for key, h in zip(keys, hashes.tolist()):
+            self.candidates[key] = h
+        if len(self.candidates) > self.capacity:
+            self._prune()
+
+    def _prune(self):
+        keys = list(self.candidates)
+        estimates = self.sketch.estimate_hashes(np.array([self.candidates[k] for k in keys], dtype=np.uint64))
+        keep = np.argsort(-estimates, kind="stable")[:self.capacity]
+        self.candidates = dict((keys[i], self.candidates[keys[i]]) for i in keep.tolist())
+
+    def top(self):
+        """
+
+        :return: list of (key, estimated count) of the k most common keys
+        """
+        keys = list(self.candidates)
+        if not keys:
+            return []
+        estimates = self.sketch.estimate_hashes(np.array([self.candidates[k] for k in keys], dtype=np.uint64))
+        order = np.argsort(-estimates, kind="stable")[:self.k]
+        return [(keys[i], int(estimates[i])) for i in order.tolist()]
+
+    def merge(self, other):
+        """
+
+        :param other: TopKeys with the same parameters
+        :return: void
+        """
+        self.sketch.merge(other.sketch)
+        self.candidates.update(other.candidates)
+        self._prune()
+
+
+class BloomFilter(object):
+    """
+    Approximate membership: no false negatives, false positives with
+    probability error_rate once capacity items are added.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(64, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / float(capacity) * math.log(2))))
+        self.bits = np.zeros((self.size + 7) // 8, dtype=np.uint8)
+        self.added = 0
+
+    def _positions(self, hashes, i):
+        h1 = hashes & np.uint64(0xFFFFFFFF)
+        h2 = (hashes >> np.uint64(32)) | np.uint64(1)
+        with np.errstate(over="ignore"):
+            return ((h1 + np.uint64(i) * h2) % np.uint64(self.size)).astype(np.int64)
+
+    def add_hashes(self, hashes):
+        """
+
+        :param hashes: uint64 array (see hash_ips)
+        :return: void
+        """
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        for i in range(self.hashes):
+            positions = self._positions(hashes, i)
+            np.bitwise_or.at(self.bits, positions >> 3, (1 << (positions & 7)).astype(np.uint8))
+        self.added += len(hashes)
+
+    def contains_hashes(self, hashes):
+        """
+
+        :param hashes: uint64 array
+        :return: boolean array, True if the item was probably added
+        """
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        result = np.ones(len(hashes), dtype=bool)
+        for i in range(self.hashes):
+            positions = self._positions(hashes, i)
+            result &= (self.bits[positions >> 3] >> (positions & 7).astype(np.uint8)) & 1 == 1
+        return result
+
+    def false_positive_rate(self):
+        """
+
+        :return: false positive rate for the items added so far, from the fraction of bits set
+        """
+        return (np.unpackbits(self.bits)[:self.size].sum() / float(self.size)) ** self.hashes
+
+    def merge(self, other):
+        """
+
+        :param other: BloomFilter with the same capacity and error rate
+        :return: void
+        """
+        np.bitwise_or(self.bits, other.bits, out=self.bits)
+        self.added += other.added
+
+
+class CensysSketch(object):
+    """
+    Fixed-size summary of the censys files, the approximate counterpart of the sets
+    returned by loaders.load_censys_ips: a Bloom filter of the ips with port 23 or 2323
+    and HyperLogLog counts of all, with banner and without banner ips.
+    """
+
+    def __init__(self, capacity, error_rate=0.01, precision=14):
+        """
+
+        :param capacity: expected number of distinct censys ips
+        :param error_rate: false positive rate of the membership test at capacity
+        :param precision: precision of the HyperLogLog counts
+        """
+        self.ips = BloomFilter(capacity, error_rate)
+        self.ips_count = HyperLogLog(precision)
+        self.with_banner = HyperLogLog(precision)
+        self.no_banner = HyperLogLog(precision)
+        self.total_others = 0
+        self.lines = 0
+
+    def merge(self, other):
+        """
+
+        :param other: CensysSketch with the same parameters
+        :return: void
+        """
+        self.ips.merge(other.ips)
+        self.ips_count.merge(other.ips_count)
+        self.with_banner.merge(other.with_banner)
+        self.no_banner.merge(other.no_banner)
+        self.total_others += other.total_others
+        self.lines += other.lines
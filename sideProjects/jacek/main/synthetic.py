@@ -0,0 +1,137 @@
+import csv
+import gzip
+import json
+import os
+import random
+import time
+import config as config
+import ipset as ipset
+
+COUNTRIES = ["CN", "BR", "US", "RU", "KR", "IN", "VN", "TW", "TR", "MX", "IR", "TH", "AR", "EG", "IT"]
+ASNS = [12389, 4837, 4134, 8452, 3462, 4766, 18403, 8376, 24444, 9121, 7738, 28573, 9829, 45899, 3269]
+PORTS = ["23", "23", "23", "2323", "2323", "80", "7547", "8080", "5555"]
+BANNERS = ["\r\nlogin: ", "BusyBox v1.19.4 built-in shell (ash)\r\nlogin: ", "",
+           "\r\nUser Access Verification\r\n\r\nUsername: ", "MikroTik v6.40\r\nLogin: ", "(none) login: ",
+           "\xff\xfd\x01\xff\xfd\x1f\xff\xfb\x01\xff\xfb\x03", "Welcome to ZXDSL 831CII\r\nLogin: ", "Password: ", "\r\r\nDVR login: "]
+DESCRIPTIONS = ["MikroTik,MikroTik", "Hikvision,Dahua", "ZTE router", "Huawei HG8245 router", "AVTech",
+                "Dahua DVR", "TP-Link,TP-Link", "Ubiquiti AirOS router", "ZyXEL,Netgear", "Linux"]
+START = 1530576000  # 2018-07-03
+END = 1551571200  # 2019-03-03
+
+
+def pool_ip(k):
+    """
+    Deterministic ip number k of the synthetic population, the mapping is a
+    bijection of 32-bit integers so different k give different ips.
+
+    :param k: index in the population
+    :return: dotted-quad address
+    """
+    return ipset.int_to_ip((k * 2654435761 + 16777619) & 0xFFFFFFFF)
+
+
+def write_mirai_csv(path, rows, population, seed=0):
+    """
+    Writes a mirai csv with the columns at the indices in config.py and a header
+    with the column names used by plot_methods.
+
+    :param path: output csv
+    :param rows: number of rows
+    :param population: number of distinct ips, drawn from pool_ip(0 .. population - 1)
+    :param seed:
+    :return: void
+    """
+    rng = random.Random(seed)
+    width = max(config.IP, config.PREFIX, config.COUNTRY, config.ASN, config.FSEEN, config.LSEEN,
+                config.DST_PORT) + 1
+    header = ["c%d" % i for i in range(width)]
+    header[config.IP] = "ip"
+    header[config.DST_PORT] = "dst_port"
+    header[config.FSEEN] = "fseen"
+    header[config.LSEEN] = "lseen"
+    header[config.ASN] = "asn"
+    header[config.COUNTRY] = "country"
+    header[config.PREFIX] = "prefix"
+    with open(path, "w", newline="") as mirai_file:
+        mirai_writer = csv.writer(mirai_file, dialect='excel')
+        mirai_writer.writerow(header)
+        for i in range(rows):
+            k = rng.randrange(population)
+            ip = pool_ip(k)
+            fseen = rng.randrange(START, END)
+            lseen = fseen + rng.choice([0, 0, rng.randrange(0, 200 * 3600)])
+            row = [""] * width
+            row[config.IP] = ip
+            row[config.DST_PORT] = rng.choice(PORTS)
+            row[config.FSEEN] = _format_time(fseen)
+            row[config.LSEEN] = _format_time(lseen)
+            # attributes mostly stable per ip, sometimes changing
+            attributes = k if rng.random() < 0.95 else k + rng.randrange(1, len(ASNS))
+            row[config.ASN] = str(ASNS[attributes % len(ASNS)])
+            row[config.COUNTRY] = COUNTRIES[attributes * 7 % len(COUNTRIES)]
+            row[config.PREFIX] = ip.rsplit(".", 1)[0] + ".0/24"
+            mirai_writer.writerow(row)
+
+
+def _format_time(seconds):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(seconds))
+
+
+def censys_record(rng, population, overlap):
+    """
+
+    :param rng: random.Random
+    :param population: number of distinct ips of the mirai population
+    :param overlap: fraction of records with an ip from the mirai population
+    :return: censys record (dict) as in the files written by convert_json.py
+    """
+    if rng.random() < overlap:
+        ip = pool_ip(rng.randrange(population))
+    else:
+        ip = pool_ip(population + rng.randrange(population))  # outside of mirai
+    record = {"ip": ip, "ports": rng.choice([["23"], ["2323"], ["23", "80"], ["80"], ["443", "8080"]])}
+    if rng.random() < 0.9:
+        record["banner"] = rng.choice(BANNERS)
+    if rng.random() < 0.7:
+        record["description"] = rng.choice(DESCRIPTIONS)
+    record["asn"] = str(rng.choice(ASNS))
+    record["country_code"] = rng.choice(COUNTRIES)
+    return record
+
+
+def write_censys_dir(dir_path, records, files, population, overlap=0.5, seed=0, ndjson=False, compress=False):
+    """
+    Writes censys files, by default in the "json array of strings" format of convert_json.py.
+
+    :param dir_path: output directory, created if missing
+    :param records: total number of records
+    :param files: number of files
+    :param population: number of distinct ips of the mirai population
+    :param overlap: fraction of records with an ip from the mirai population
+    :param seed:
+    :param ndjson: if True write one json record per line
+    :param compress: if True gzip the files
+    :return: void
+    """
+    if not os.path.exists(dir_path):
+        os.makedirs(dir_path)
+    rng = random.Random(seed)
+    per_file = records // files
+    for f in range(files):
+        count = per_file if f < files - 1 else records - per_file * (files - 1)
+        name = dir_path + "/scan_%04d.%s" % (f, "ndjson" if ndjson else "json")
+        if compress:
+            outfile = gzip.open(name + ".gz", "wt")
+        else:
+            outfile = open(name, "w")
+        with outfile:
+            if ndjson:
+                for i in range(count):
+                    outfile.write(json.dumps(censys_record(rng, population, overlap)) + "\n")
+            else:  # json array of strings, written incrementally
+                outfile.write("[")
+                for i in range(count):
+                    if i > 0:
+                        outfile.write(", ")
+                    outfile.write(json.dumps(json.dumps(censys_record(rng, population, overlap)) + "\n"))
+                outfile.write("]")
@@ -0,0 +1,44 @@
+import unittest
+import numpy as np
+import ip_index as ip_index
+import ipset as ipset
+import mirai_cache as mirai_cache
+
+
+def _index():
+    ips = ["1.2.3.4", "1.2.3.4", "5.6.7.8", "9.9.9.9"]
+    fseen = mirai_cache.parse_times(["2018-12-01T00:00:00Z", "2018-12-05T00:00:00Z",
+                                     "2018-12-03T00:00:00Z", "2018-12-06T12:00:00Z"])
+    columns = {
+        "ip": ipset.ips_to_array(ips).astype(np.uint32),
+        "port": np.array([23, 2323, 23, 23], dtype=np.int32),
+        "fseen": fseen,
+        "lseen": fseen,
+        "asn": np.array([0, 0, 1, 1], dtype=np.int32),
+        "country": np.array([0, 0, 0, 1], dtype=np.int32),
+        "prefix": np.array([0, 0, 1, 2], dtype=np.int32),
+    }
+    vocabularies = {"asn": ["4134", "4837"], "country": ["CN", "RU"],
+                    "prefix": ["1.2.3.0/24", "5.6.7.0/24", "9.9.9.0/24"]}
+    return ip_index.InfectedIndex(columns, vocabularies)
+
+
+class InfectedIndexTest(unittest.TestCase):
+
+    def test_seen_bounds(self):
+        index = _index()
+        self.assertEqual(index.count(), 3)
+        self.assertEqual(index.ips(seen_after="2018-12-04T00:00:00Z"), ["1.2.3.4", "9.9.9.9"])
+        self.assertEqual(index.ips(seen_before="2018-12-04T00:00:00Z"), ["1.2.3.4", "5.6.7.8"])
+
+    def test_malformed_bound(self):
+        index = _index()
+        for date in ["2018-12-04", "yesterday", "2018-12-04T00:00:00", ""]:
+            with self.assertRaises(ValueError):
+                index.count(seen_after=date)
+            with self.assertRaises(ValueError):
+                index.count(seen_before=date)
+
+
+if __name__ == "__main__":
+    unittest.main()
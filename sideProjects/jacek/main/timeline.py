@@ -0,0 +1,255 @@
+import calendar
+import json
+import os
+import time
+from collections import Counter
+import numpy as np
+import config as config
+import ipset as ipset
+import mirai_cache as mirai_cache
+
+# distinct rows of a bucket, sorted by ip (codes of asn, country and prefix index the vocabularies of the timeline)
+ROW_DTYPE = np.dtype([("ip", np.uint32), ("port", np.int32), ("asn", np.int32), ("country", np.int32),
+                      ("prefix", np.int32)])
+
+
+class Timeline(object):
+    """
+    Mirai rows grouped into time buckets (days by default) by their fseen or lseen,
+    kept in a directory with one file per bucket, so reports for any range of dates
+    are answered by merging the buckets of the range, and a new mirai dump only
+    adds (or extends) the buckets of its days:
+
+        timeline = Timeline("../timeline")
+        timeline.append(config.MIRAI_PATH)
+        infected = timeline.infected(censys_ips, start="2018-12-04T00:00:00Z", ports=[23, 2323])
+        timeline.counts_by("country", start="2018-12-04T00:00:00Z", end="2019-01-01T00:00:00Z",
+                           infected_ips=infected)
+
+    A bucket keeps the distinct (ip, port, asn, country, prefix) of its rows, sorted
+    by ip, so adding the same rows twice changes nothing and counts
+    over a range are numbers of distinct ips, not sums of daily counts. Rows without
+    the timestamp are not in any bucket. Unlike the report, counts use all rows of an
+    ip in the range, not only its first row.
+    """
+
+    def __init__(self, dir_path, seen="fseen", bucket_seconds=config.TIMELINE_BUCKET_SECONDS):
+        """
+
+        :param dir_path: directory of the timeline, created if missing; an existing timeline
+            keeps its own seen and bucket_seconds
+        :param seen: fseen or lseen, the timestamp which decides the bucket of a row
+        :param bucket_seconds: length of a bucket in seconds
+        """
+        self.dir = dir_path
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+        meta_path = os.path.join(dir_path, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path) as meta_file:
+                meta = json.load(meta_file)
+        else:
+            meta = {"seen": seen, "bucket_seconds": bucket_seconds, "buckets": [], "undated": 0,
+                    "sources": [], "vocabularies": dict((name, []) for name in mirai_cache.TEXT_COLUMNS)}
+        self.seen = meta["seen"]
+        self.bucket_seconds = meta["bucket_seconds"]
+        self.buckets = sorted(meta["buckets"])  # start of every bucket, seconds since epoch
+        self.undated = meta["undated"]  # rows without timestamp, over all appended dumps
+        self.sources = meta["sources"]
+        self.vocabularies = meta["vocabularies"]
+        self.codes = dict((name, dict((text, code) for code, text in enumerate(vocabulary)))
+                          for name, vocabulary in self.vocabularies.items())
+        self._loaded = dict()  # bucket start --> array of ROW_DTYPE
+
+    def append(self, path_to_mirai, since=None, force=False):
+        """
+        Adds the rows of a mirai dump, reading its columnar cache (built if missing or stale).
+
+        :param path_to_mirai: absolute path to csv
+        :param since: optional string in format %Y-%m-%dT%H:%M:%SZ, rows of earlier buckets are skipped
+        :param force: if False a dump already appended (same path, size and modification time) is skipped
+        :return: list of the starts of the buckets added or changed
+        """
+        stat = os.stat(path_to_mirai)
+        source = {"path": os.path.abspath(path_to_mirai), "size": stat.st_size, "mtime": stat.st_mtime}
+        if source in self.sources and not force:
+            print("Already in the timeline: %s" % path_to_mirai)
+            return []
+        table = mirai_cache.load_cache(path_to_mirai)
+        if table is None:
+            mirai_cache.build_cache(path_to_mirai)
+            table = mirai_cache.load_cache(path_to_mirai)
+        changed = self.add_table(table, since=since)
+        if source not in self.sources:
+            self.sources.append(source)
+        self.save(changed)
+        print("Added %d rows to %d buckets of the timeline" % (len(table), len(changed)))
+        return changed
+
+    def add_table(self, table, since=None, chunk_size=1 << 20):
+        """
+        Adds the rows of a mirai table to the buckets in memory, see save.
+
+        :param table: mirai_cache.MiraiTable
+        :param since: see append
+        :param chunk_size: number of rows read at once
+        :return: list of the starts of the buckets added or changed
+        """
+        mappings = dict((name, np.array([self._code(name, text) for text in table.vocabularies[name]] or [0],
+                                        dtype=np.int32))
+                        for name in mirai_cache.TEXT_COLUMNS)
+        first_bucket = self._bucket_of(self._parse(since)) if since is not None else None
+        pending = dict()  # bucket start --> list of arrays of ROW_DTYPE
+        for start in range(0, len(table), chunk_size):
+            stop = min(start + chunk_size, len(table))
+            seen = np.asarray(table[self.seen][start:stop])
+            dated = seen != mirai_cache.TIME_MISSING
+            self.undated += int(len(seen) - np.count_nonzero(dated))
+            rows = np.empty(len(seen), dtype=ROW_DTYPE)
+            rows["ip"] = table["ip"][start:stop]
+            rows["port"] = table["port"][start:stop]
+            for name in mirai_cache.TEXT_COLUMNS:
+                rows[name] = mappings[name][table[name][start:stop]]
+            buckets = self._bucket_of(seen[dated])
+            rows = rows[dated]
+            if first_bucket is not None:
+                rows, buckets = rows[buckets >= first_bucket], buckets[buckets >= first_bucket]
+            order = np.argsort(buckets, kind="stable")
+            rows, buckets = rows[order], buckets[order]
+            values, starts = np.unique(buckets, return_index=True)
+            for bucket, part in zip(values.tolist(), np.split(rows, starts[1:])):
+                pending.setdefault(bucket, []).append(np.unique(part))
+
+        for bucket, parts in pending.items():
+            if bucket in self.buckets:
+                parts.append(self.bucket(bucket))
+            else:
+                self.buckets.append(bucket)
+            self._loaded[bucket] = np.unique(np.concatenate(parts))
+        self.buckets.sort()
+        return sorted(pending)
+
+    def save(self, buckets=None):
+        """
+        Writes buckets and the metadata of the timeline.
+
+        :param buckets: starts of the buckets to write, all buckets in memory by default
+        :return: void
+        """
+        for bucket in (sorted(self._loaded) if buckets is None else buckets):
+            path = self._bucket_path(bucket)
+            np.save(path + ".part.npy", self._loaded[bucket])
+            os.replace(path + ".part.npy", path)
+        meta = {"seen": self.seen, "bucket_seconds": self.bucket_seconds, "buckets": self.buckets,
+                "undated": self.undated, "sources": self.sources, "vocabularies": self.vocabularies}
+        with open(os.path.join(self.dir, "meta.json.part"), "w") as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(os.path.join(self.dir, "meta.json.part"), os.path.join(self.dir, "meta.json"))
+
+    def bucket(self, start):
+        """
+
+        :param start: start of a bucket, seconds since epoch
+        :return: array of ROW_DTYPE, distinct rows of the bucket sorted by ip
+        """
+        rows = self._loaded.get(start)
+        if rows is None:
+            rows = self._loaded[start] = np.load(self._bucket_path(start), mmap_mode="r")
+        return rows
+
+    def days(self):
+        """
+
+        :return: list of the starts of all buckets, in format %Y-%m-%dT%H:%M:%SZ
+        """
+        return mirai_cache.format_times(np.array(self.buckets, dtype=np.int64))
+
+    def rows(self, start=None, end=None, ports=None):
+        """
+
+        :param start: optional string in format %Y-%m-%dT%H:%M:%SZ, the start of a bucket
+        :param end: optional string in format %Y-%m-%dT%H:%M:%SZ, the start of a bucket, excluded
+        :param ports: optional list of ports, other rows are left out
+        :return: array of ROW_DTYPE, rows of the buckets in [start, end)
+        """
+        low = self._boundary(start) if start is not None else None
+        high = self._boundary(end) if end is not None else None
+        parts = [self.bucket(b) for b in self.buckets
+                 if (low is None or b >= low) and (high is None or b < high)]
+        rows = np.concatenate(parts) if parts else np.empty(0, dtype=ROW_DTYPE)
+        if ports is not None:
+            rows = rows[np.isin(rows["port"], [int(p) for p in ports])]
+        return rows
+
+    def ips(self, start=None, end=None, ports=None):
+        """
+
+        :param start: see rows
+        :param end: see rows
+        :param ports: see rows
+        :return: ipset.IPSet of the ips with rows in the range
+        """
+        return ipset.IPSet.from_ints(self.rows(start, end, ports)["ip"])
+
+    def infected(self, censys_ips, start=None, end=None, ports=None):
+        """
+        Counterpart of the mirai filters of a report: ports=[23, 2323] is filter_port,
+        start=date_limit is filter_date (with the seen of the timeline).
+
+        :param censys_ips: set (or ipset.IPSet) of censys ips
+        :param start: see rows
+        :param end: see rows
+        :param ports: see rows
+        :return: ipset.IPSet of the infected ips with rows in the range
+        """
+        return self.ips(start, end, ports).intersection(_as_ipset(censys_ips))
+
+    def counts_by(self, name, start=None, end=None, ports=None, infected_ips=None):
+        """
+
+        :param name: asn, country, prefix or port
+        :param start: see rows
+        :param end: see rows
+        :param ports: see rows
+        :param infected_ips: optional set (or ipset.IPSet) of ips, rows of other ips are left out
+        :return: Counter value (as in the csv) --> number of distinct ips with rows in the range
+        """
+        rows = self.rows(start, end, ports)
+        if infected_ips is not None:
+            rows = rows[_as_ipset(infected_ips).isin(rows["ip"])]
+        pairs = np.unique((rows["ip"].astype(np.int64) << 32) | (rows[name].astype(np.int64) & 0xFFFFFFFF))
+        codes, counts = np.unique((pairs & 0xFFFFFFFF).astype(np.uint32).astype(np.int32), return_counts=True)
+        if name in self.vocabularies:
+            keys = [self.vocabularies[name][code] for code in codes.tolist()]
+        else:
+            keys = codes.tolist()
+        return Counter(dict(zip(keys, counts.tolist())))
+
+    def _code(self, name, text):
+        code = self.codes[name].get(text)
+        if code is None:
+            code = self.codes[name][text] = len(self.vocabularies[name])
+            self.vocabularies[name].append(text)
+        return code
+
+    def _bucket_of(self, seconds):
+        return (np.asarray(seconds, dtype=np.int64) // self.bucket_seconds) * self.bucket_seconds
+
+    def _boundary(self, date):
+        seconds = self._parse(date)
+        if seconds % self.bucket_seconds != 0:
+            raise ValueError("%s is not the start of a bucket of %d seconds" % (date, self.bucket_seconds))
+        return seconds
+
+    def _parse(self, date):
+        return calendar.timegm(time.strptime(date, mirai_cache.TIME_FORMAT))
+
+    def _bucket_path(self, start):
+        return os.path.join(self.dir, "bucket_%d.npy" % start)
+
+
+def _as_ipset(ips):
+    if isinstance(ips, ipset.IPSet):
+        return ips
+    values = ipset.ips_to_array(ips, strict=False)
+    return ipset.IPSet.from_ints(values[values >= 0])